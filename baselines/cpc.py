@@ -7,14 +7,19 @@ import matplotlib.pyplot as plt
 import seaborn as sns; sns.set()
 import argparse
 
-from tnc.models import RnnEncoder, WFEncoder
+from tnc.models import RnnEncoder, WFEncoder, TCNEncoder, TCN_CONFIGS
 from tnc.utils import plot_distribution, model_distribution
 from tnc.evaluations import ClassificationPerformanceExperiment, WFClassificationExperiment
+from tnc.shards import ShardedTimeSeries
+from tnc.labels import load_states
+from tnc.precision import autocast
+from tnc.autotune import apply_profile, dataset_name
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
 
-def epoch_run(data, ds_estimator, auto_regressor, encoder, device, window_size, n_size=5, optimizer=None, train=True):
+def epoch_run(data, ds_estimator, auto_regressor, encoder, device, window_size, n_size=5, optimizer=None, train=True,
+              precision='fp32'):
     if train:
         encoder.train()
         ds_estimator.train()
@@ -29,18 +34,26 @@ def epoch_run(data, ds_estimator, auto_regressor, encoder, device, window_size,
 
     epoch_loss = 0
     acc = 0
-    for sample in data:
+    if isinstance(data, ShardedTimeSeries):
+        # Draw recordings in proportion to their length, so that time points are sampled uniformly
+        samples = (data[data.sample_index()] for _ in range(len(data)))
+    else:
+        samples = data
+    for sample in samples:
         rnd_t = np.random.randint(5*window_size,sample.shape[-1]-5*window_size)
         sample = torch.Tensor(sample[:,max(0,(rnd_t-20*window_size)):min(sample.shape[-1], rnd_t+20*window_size)])
 
         T = sample.shape[-1]
         windowed_sample = np.split(sample[:, :(T // window_size) * window_size], (T // window_size), -1)
         windowed_sample = torch.tensor(np.stack(windowed_sample, 0), device=device)
-        encodings = encoder(windowed_sample)
-        window_ind = torch.randint(2,len(encodings)-2, size=(1,))
-        _, c_t = auto_regressor(encodings[max(0, window_ind[0]-10):window_ind[0]+1].unsqueeze(0))
-        density_ratios = torch.bmm(encodings.unsqueeze(1),
+        window_ind = torch.randint(2,len(windowed_sample)-2, size=(1,))
+        # The forwards run in bfloat16 with precision='bf16', the density ratios and the loss in fp32
+        with autocast(precision, device):
+            encodings = encoder(windowed_sample)
+            _, c_t = auto_regressor(encodings[max(0, window_ind[0]-10):window_ind[0]+1].unsqueeze(0))
+            density_ratios = torch.bmm(encodings.unsqueeze(1),
                                        ds_estimator(c_t.squeeze(1).squeeze(0)).expand_as(encodings).unsqueeze(-1)).view(-1,)
+        density_ratios = density_ratios.float()
         r = set(range(0, window_ind[0] - 2))
         r.update(set(range(window_ind[0] + 3, len(encodings))))
         rnd_n = np.random.choice(list(r), n_size)
@@ -58,22 +71,30 @@ def epoch_run(data, ds_estimator, auto_regressor, encoder, device, window_size,
     return epoch_loss / len(data), acc/(len(data))
 
 
-def learn_encoder(x, window_size, lr=0.001, decay=0, n_size=5, n_epochs=50, data='simulation', device='cpu', n_cross_val=1):
+def learn_encoder(x, window_size, lr=0.001, decay=0, n_size=5, n_epochs=50, data='simulation', device='cpu', n_cross_val=1,
+                  encoder_type='rnn', reduced_channels=None, reduction='linear', precision='fp32'):
     if not os.path.exists("./plots/%s_cpc/"%data):
         os.mkdir("./plots/%s_cpc/"%data)
     if not os.path.exists("./ckpt/%s_cpc/"%data):
         os.mkdir("./ckpt/%s_cpc/"%data)
+    # Number of threads of python -m tnc.autotune --method cpc, when it was run on this machine
+    apply_profile('cpc', dataset_name(data), encoder_type, reduced_channels, reduction)
     accuracies = []
     for cv in range(n_cross_val):
         if 'waveform' in data:
             encoding_size = 64
             encoder = WFEncoder(encoding_size=64).to(device)
+        elif encoder_type == 'tcn':
+            encoding_size = 10
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS['har' if 'har' in data else 'simulation'])
         elif 'simulation' in data:
             encoding_size = 10
-            encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device)
+            encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device,
+                                 reduced_channels=reduced_channels, reduction=reduction)
         elif 'har' in data:
             encoding_size = 10
-            encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device)
+            encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device,
+                                 reduced_channels=reduced_channels, reduction=reduction)
         ds_estimator = torch.nn.Linear(encoder.encoding_size, encoder.encoding_size)
         auto_regressor = torch.nn.GRU(input_size=encoding_size, hidden_size=encoding_size, batch_first=True)
         params = list(ds_estimator.parameters()) + list(encoder.parameters()) + list(auto_regressor.parameters())
@@ -82,13 +103,16 @@ def learn_encoder(x, window_size, lr=0.001, decay=0, n_size=5, n_epochs=50, data
         random.shuffle(inds)
         x = x[inds]
         n_train = int(0.8*len(x))
+        if getattr(encoder, 'reduction', None) == 'pca' and encoder.reduced_channels is not None:
+            encoder.fit_reduction(x[:n_train])
         best_acc = 0
         best_loss = np.inf
         train_loss, test_loss = [], []
         for epoch in range(n_epochs):
             epoch_loss, acc = epoch_run(x[:n_train], ds_estimator, auto_regressor, encoder, device, window_size, optimizer=optimizer,
-                                        n_size=n_size, train=True)
-            epoch_loss_test, acc_test = epoch_run(x[n_train:], ds_estimator, auto_regressor, encoder, device, window_size, n_size=n_size, train=False)
+                                        n_size=n_size, train=True, precision=precision)
+            epoch_loss_test, acc_test = epoch_run(x[n_train:], ds_estimator, auto_regressor, encoder, device, window_size, n_size=n_size, train=False,
+                                                  precision=precision)
             print('\nEpoch ', epoch)
             print('Train ===> Loss: ', epoch_loss, '\t Accuracy: ', acc)
             print('Test ===> Loss: ', epoch_loss_test, '\t Accuracy: ', acc_test)
@@ -114,7 +138,14 @@ def learn_encoder(x, window_size, lr=0.001, decay=0, n_size=5, n_epochs=50, data
     print('Accuracy: %.2f +- %.2f' % (100 * np.mean(accuracies), 100 * np.std(accuracies)))
 
 
-def main(is_train, data_type, lr,  cv):
+def main(is_train, data_type, lr,  cv, encoder_type='rnn', reduced_channels=None, reduction='linear', precision='fp32'):
+    if reduced_channels is not None and encoder_type != 'rnn':
+        raise ValueError('The channel reduction front-end is only available for the RnnEncoder')
+    # Encoders other than the RnnEncoder are saved under <data>_<encoder_type>_cpc, and RnnEncoders with a channel
+    # reduction front-end under <data>_r<reduced_channels>_cpc (<data>_pca<reduced_channels>_cpc for PCA)
+    name = data_type if encoder_type == 'rnn' else '%s_%s' % (data_type, encoder_type)
+    if reduced_channels is not None:
+        name += '_%s%d' % ('pca' if reduction == 'pca' else 'r', reduced_channels)
     if not os.path.exists("./plots"):
         os.mkdir("./plots")
     if not os.path.exists("./ckpt/"):
@@ -131,13 +162,12 @@ def main(is_train, data_type, lr,  cv):
             T = x.shape[-1]
             x_window = np.concatenate(np.split(x[:, :, :T // 5 * 5], 5, -1), 0)
             learn_encoder(x_window, window_size, n_epochs=100, lr=lr, decay=1e-5,  n_size=10,
-                          device=device, data=data_type, n_cross_val=cv)
+                          device=device, data=data_type, n_cross_val=cv, precision=precision)
 
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
             for cv_ind in range(cv):
                 plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_cpc' % data_type,
                                   device=device, augment=100, cv=cv_ind, title='CPC')
@@ -147,50 +177,58 @@ def main(is_train, data_type, lr,  cv):
     elif data_type == 'simulation':
         path = './data/simulated_data/'
         window_size = 50
-        encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device)
+        encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device,
+                             reduced_channels=reduced_channels, reduction=reduction)
+        if encoder_type == 'tcn':
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS['simulation'])
         if is_train:
             with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
                 x = pickle.load(f)
-            learn_encoder(x, window_size, n_epochs=400, lr=lr, decay=1e-4, n_size=15, data=data_type,
-                          device=device, n_cross_val=cv)
+            learn_encoder(x, window_size, n_epochs=400, lr=lr, decay=1e-4, n_size=15, data=name,
+                          device=device, n_cross_val=cv, encoder_type=encoder_type,
+                          reduced_channels=reduced_channels, reduction=reduction, precision=precision)
 
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
             for cv_ind in range(cv):
-                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_cpc' % data_type,
+                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_cpc' % name,
                                   title='CPC', device=device, cv=cv_ind)
-                exp = ClassificationPerformanceExperiment(path='simulation_cpc', cv=cv_ind)
+                exp = ClassificationPerformanceExperiment(path='%s_cpc' % name, cv=cv_ind, encoder_type=encoder_type,
+                                                          reduced_channels=reduced_channels, reduction=reduction)
                 # Run cross validation for classification
                 for lr in [0.001, 0.01, 0.1]:
                     print('===> lr: ', lr)
-                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='%s_cpc'%data_type, n_epochs=50, lr_e2e=lr, lr_cls=lr)
+                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='%s_cpc'%name, n_epochs=50, lr_e2e=lr, lr_cls=lr)
                     print('TNC acc: %.2f \t TNC auc: %.2f \t E2E acc: %.2f \t E2E auc: %.2f' % (
                     tnc_acc, tnc_auc, e2e_acc, e2e_auc))
 
     elif data_type == 'har':
         window_size = 4
         path = './data/HAR_data/'
-        encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device)
+        encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device,
+                             reduced_channels=reduced_channels, reduction=reduction)
+        if encoder_type == 'tcn':
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS['har'])
 
         if is_train:
             with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
                 x = pickle.load(f)
             learn_encoder(x, window_size, n_epochs=300, lr=lr, decay=1e-4, n_size=15,
-                          data=data_type, device=device, n_cross_val=cv)
+                          data=name, device=device, n_cross_val=cv, encoder_type=encoder_type,
+                          reduced_channels=reduced_channels, reduction=reduction, precision=precision)
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
 
             for cv_ind in range(cv):
-                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='har_cpc',
+                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_cpc' % name,
                                   device=device, augment=100, cv=cv_ind, title='CPC')
-                exp = ClassificationPerformanceExperiment(n_states=6, encoding_size=10, path='har_cpc', hidden_size=100,
-                                                        in_channel=561, window_size=5, cv=cv_ind)
+                exp = ClassificationPerformanceExperiment(n_states=6, encoding_size=10, path='%s_cpc' % name, hidden_size=100,
+                                                        in_channel=561, window_size=5, cv=cv_ind, encoder_type=encoder_type,
+                                                        reduced_channels=reduced_channels, reduction=reduction)
                 # Run cross validation for classification
                 for lr in [0.001, 0.01, 0.1]:
                     print('===> lr: ', lr)
@@ -205,6 +243,12 @@ if __name__=="__main__":
     parser.add_argument('--cv', type=int, default=1)
     parser.add_argument('--lr', type=float, default=1e-4)
     parser.add_argument('--train', action='store_true')
+    parser.add_argument('--encoder', type=str, default='rnn', help='Encoder of the simulation and HAR data, {rnn, tcn}')
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Project the input channels to this dimension before the GRU (simulation, har)')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    parser.add_argument('--precision', type=str, default='fp32', help='Precision of the forwards, one of {fp32, bf16}')
     args = parser.parse_args()
-    main(args.train, args.data, args.lr, args.cv)
+    main(args.train, args.data, args.lr, args.cv, encoder_type=args.encoder, reduced_channels=args.reduced_channels,
+         reduction=args.reduction, precision=args.precision)
 
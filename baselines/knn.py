@@ -8,7 +8,9 @@ import pickle
 from tslearn.neighbors import KNeighborsTimeSeries
 from tslearn.clustering import TimeSeriesKMeans
 from sklearn.metrics import accuracy_score, roc_auc_score, average_precision_score
-from sklearn.metrics import silhouette_score, davies_bouldin_score
+from sklearn.metrics import davies_bouldin_score
+from evaluations.clusterability import silhouette_score_blocked, sampled_silhouette
+from tnc.labels import load_states
 
 
 def main(args):
@@ -30,12 +32,10 @@ def main(args):
 
     with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
         x = pickle.load(f)
-    with open(os.path.join(path, 'state_train.pkl'), 'rb') as f:
-        y = pickle.load(f)
+    y = load_states(path, 'train')
     with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
         x_test = pickle.load(f)
-    with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-        y_test = pickle.load(f)
+    y_test = load_states(path, 'test')
 
     T = x.shape[-1]
     t = np.random.randint(window_size,  T- window_size, len(x)*augment)
@@ -96,7 +96,11 @@ def main(args):
         accuracy.append(accuracy_score(y_test, predictions))
         auc.append(roc_auc_score(y_onehot, prediction_onehot))
         auprc.append(average_precision_score(y_onehot, prediction_onehot))
-        s_score.append(silhouette_score(x_test.reshape((len(x_test), -1)), cluster_labels))
+        if args.sample_size > 0:
+            s_score.append(sampled_silhouette(x_test.reshape((len(x_test), -1)), cluster_labels,
+                                              sample_size=args.sample_size, random_state=cv)[0])
+        else:
+            s_score.append(silhouette_score_blocked(x_test.reshape((len(x_test), -1)), cluster_labels))
         db_score.append(davies_bouldin_score(x_test.reshape((len(x_test), -1)), cluster_labels))
 
     print('\nSummary performance:')
@@ -112,5 +116,6 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Run KNN')
     parser.add_argument('--data', type=str, default='simulation')
     parser.add_argument('--K', type=int, default=10)
+    parser.add_argument('--sample_size', type=int, default=0, help='Silhouette sample size, 0 for the exact score')
     args = parser.parse_args()
     main(args)
\ No newline at end of file
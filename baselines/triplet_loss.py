@@ -12,9 +12,13 @@ import pickle
 import matplotlib.pyplot as plt
 import seaborn as sns; sns.set()
 
-from tnc.models import RnnEncoder, WFEncoder
+from tnc.models import RnnEncoder, WFEncoder, TCNEncoder, TCN_CONFIGS
 from tnc.utils import plot_distribution, model_distribution
 from tnc.evaluations import ClassificationPerformanceExperiment, WFClassificationExperiment
+from tnc.shards import ShardedTimeSeries
+from tnc.labels import load_states
+from tnc.precision import MixedPrecision
+from tnc.autotune import apply_profile, dataset_name
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
@@ -156,7 +160,7 @@ class TripletLoss(torch.nn.modules.loss._Loss):
         return loss
 
 
-def epoch_run(data, encoder, device, window_size, optimizer=None, train=True):
+def epoch_run(data, encoder, device, window_size, optimizer=None, train=True, precision='fp32', batch_size=20):
     if train:
         encoder.train()
     else:
@@ -166,11 +170,17 @@ def epoch_run(data, encoder, device, window_size, optimizer=None, train=True):
 
     epoch_loss = 0
     acc = 0
+    if isinstance(data, ShardedTimeSeries):
+        # Anchors, positives and negatives are taken from the first 3 windows of each series, so it is enough to
+        # draw crops of that length uniformly over time
+        data = data.sample_crops(len(data), 3*window_size)
     dataset = torch.utils.data.TensorDataset(torch.Tensor(data).to(device), torch.zeros((len(data),1)).to(device))
-    data_loader = torch.utils.data.DataLoader(dataset, batch_size=20, shuffle=True)
+    data_loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    # With precision='bf16' the encoder runs in bfloat16 and returns fp32 representations for the loss
+    mixed_encoder = MixedPrecision(encoder, precision, device)
     i = 0
     for x_batch,y in data_loader:
-        loss = loss_criterion(x_batch.to(device), encoder, torch.Tensor(data).to(device))
+        loss = loss_criterion(x_batch.to(device), mixed_encoder, torch.Tensor(data).to(device))
         epoch_loss += loss.item()
         i += 1
         if train:
@@ -180,18 +190,26 @@ def epoch_run(data, encoder, device, window_size, optimizer=None, train=True):
     return epoch_loss/i, acc/i
 
 
-def learn_encoder(x, window_size, data, lr=0.001, decay=0, n_epochs=100, device='cpu', n_cross_val=1):
+def learn_encoder(x, window_size, data, lr=0.001, decay=0, n_epochs=100, device='cpu', n_cross_val=1, encoder_type='rnn',
+                  reduced_channels=None, reduction='linear', precision='fp32'):
     if not os.path.exists("./plots/%s_trip/"%data):
         os.mkdir("./plots/%s_trip/"%data)
     if not os.path.exists("./ckpt/%s_trip/"%data):
         os.mkdir("./ckpt/%s_trip/"%data)
+    # Batch size and threads of python -m tnc.autotune --method triplet, when it was run on this machine
+    batch_size = apply_profile('triplet', dataset_name(data), encoder_type, reduced_channels, reduction).get(
+        'batch_size', 20)
     for cv in range(n_cross_val):
         if 'waveform' in data:
             encoder = WFEncoder(encoding_size=64).to(device)
+        elif encoder_type == 'tcn':
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS['har' if 'har' in data else 'simulation'])
         elif 'simulation' in data:
-            encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device).to(device)
+            encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device,
+                                 reduced_channels=reduced_channels, reduction=reduction).to(device)
         elif 'har' in data:
-            encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device).to(device)
+            encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device,
+                                 reduced_channels=reduced_channels, reduction=reduction).to(device)
 
         params = encoder.parameters()
         optimizer = torch.optim.Adam(params, lr=lr, weight_decay=decay)
@@ -199,11 +217,15 @@ def learn_encoder(x, window_size, data, lr=0.001, decay=0, n_epochs=100, device=
         random.shuffle(inds)
         x = x[inds]
         n_train = int(0.8*len(x))
+        if getattr(encoder, 'reduction', None) == 'pca' and encoder.reduced_channels is not None:
+            encoder.fit_reduction(x[:n_train])
         train_loss, test_loss = [], []
         best_loss = np.inf
         for epoch in range(n_epochs):
-            epoch_loss, acc = epoch_run(x[:n_train], encoder, device, window_size, optimizer=optimizer, train=True)
-            epoch_loss_test, acc_test = epoch_run(x[n_train:], encoder, device, window_size, optimizer=optimizer, train=False)
+            epoch_loss, acc = epoch_run(x[:n_train], encoder, device, window_size, optimizer=optimizer, train=True,
+                                        precision=precision, batch_size=batch_size)
+            epoch_loss_test, acc_test = epoch_run(x[n_train:], encoder, device, window_size, optimizer=optimizer, train=False,
+                                                  precision=precision, batch_size=batch_size)
             print('\nEpoch ', epoch)
             print('Train ===> Loss: ', epoch_loss)
             print('Test ===> Loss: ', epoch_loss_test)
@@ -225,7 +247,14 @@ def learn_encoder(x, window_size, data, lr=0.001, decay=0, n_epochs=100, device=
         plt.savefig(os.path.join("./plots/%s_trip/loss_%d.pdf"%(data,cv)))
 
 
-def main(is_train, data, cv):
+def main(is_train, data, cv, encoder_type='rnn', reduced_channels=None, reduction='linear', precision='fp32'):
+    if reduced_channels is not None and encoder_type != 'rnn':
+        raise ValueError('The channel reduction front-end is only available for the RnnEncoder')
+    # Encoders other than the RnnEncoder are saved under <data>_<encoder_type>_trip, and RnnEncoders with a channel
+    # reduction front-end under <data>_r<reduced_channels>_trip (<data>_pca<reduced_channels>_trip for PCA)
+    name = data if encoder_type == 'rnn' else '%s_%s' % (data, encoder_type)
+    if reduced_channels is not None:
+        name += '_%s%d' % ('pca' if reduction == 'pca' else 'r', reduced_channels)
     if not os.path.exists("./plots"):
         os.mkdir("./plots")
     if not os.path.exists("./ckpt/"):
@@ -240,12 +269,12 @@ def main(is_train, data, cv):
                 x = pickle.load(f)
             T = x.shape[-1]
             x_window = np.concatenate(np.split(x[:, :, :T // 5 * 5], 5, -1), 0)
-            learn_encoder(x_window, window_size, n_epochs=150, lr=1e-4, decay=1e-4, data='waveform', n_cross_val=cv)
+            learn_encoder(x_window, window_size, n_epochs=150, lr=1e-4, decay=1e-4, data='waveform', n_cross_val=cv,
+                          precision=precision)
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
             for cv_ind in range(cv):
                 plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_trip' % data,
                                   device=device, augment=100, cv=cv_ind, title='Triplet Loss')
@@ -255,50 +284,60 @@ def main(is_train, data, cv):
     elif data == 'simulation':
         path = './data/simulated_data/'
         window_size = 50
-        encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device).to(device)
+        encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device,
+                             reduced_channels=reduced_channels, reduction=reduction).to(device)
+        if encoder_type == 'tcn':
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS['simulation'])
         if is_train:
             with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
                 x = pickle.load(f)
-            learn_encoder(x, window_size, lr=1e-3, decay=1e-5, data=data, n_epochs=150, device=device, n_cross_val=cv)
+            learn_encoder(x, window_size, lr=1e-3, decay=1e-5, data=name, n_epochs=150, device=device, n_cross_val=cv,
+                          encoder_type=encoder_type, reduced_channels=reduced_channels, reduction=reduction,
+                          precision=precision)
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
             for cv_ind in range(cv):
-                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_trip' % data,
+                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_trip' % name,
                                   title='Triplet Loss', device=device, cv=cv_ind)
-                exp = ClassificationPerformanceExperiment(path='simulation_trip', cv=cv_ind)
+                exp = ClassificationPerformanceExperiment(path='%s_trip' % name, cv=cv_ind, encoder_type=encoder_type,
+                                                          reduced_channels=reduced_channels, reduction=reduction)
                 # Run cross validation for classification
                 for lr in [0.001, 0.01, 0.1]:
                     print('===> lr: ', lr)
-                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='simulation_trip', n_epochs=50, lr_e2e=lr, lr_cls=lr)
+                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='%s_trip' % name, n_epochs=50, lr_e2e=lr, lr_cls=lr)
                     print('TNC acc: %.2f \t TNC auc: %.2f \t E2E acc: %.2f \t E2E auc: %.2f' % (
                         tnc_acc, tnc_auc, e2e_acc, e2e_auc))
 
     elif data == 'har':
         window_size = 4
         path = './data/HAR_data/'
-        encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device)
+        encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device,
+                             reduced_channels=reduced_channels, reduction=reduction)
+        if encoder_type == 'tcn':
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS['har'])
 
         if is_train:
             with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
                 x = pickle.load(f)
-            learn_encoder(x, window_size, lr=1e-5, decay=0.001, data=data, n_epochs=300, device=device, n_cross_val=cv)
+            learn_encoder(x, window_size, lr=1e-5, decay=0.001, data=name, n_epochs=300, device=device, n_cross_val=cv,
+                          encoder_type=encoder_type, reduced_channels=reduced_channels, reduction=reduction,
+                          precision=precision)
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
             for cv_ind in range(cv):
-                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='har_trip',
+                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='%s_trip' % name,
                                   device=device, augment=100, cv=cv_ind, title='Triplet Loss')
-                exp = ClassificationPerformanceExperiment(n_states=6, encoding_size=10, path='har_trip', hidden_size=100,
-                                                      in_channel=561, window_size=5, cv=cv_ind)
+                exp = ClassificationPerformanceExperiment(n_states=6, encoding_size=10, path='%s_trip' % name, hidden_size=100,
+                                                      in_channel=561, window_size=5, cv=cv_ind, encoder_type=encoder_type,
+                                                      reduced_channels=reduced_channels, reduction=reduction)
                 # Run cross validation for classification
                 for lr in [0.001, 0.01, 0.1]:
                     print('===> lr: ', lr)
-                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='har_trip', n_epochs=100, lr_e2e=lr, lr_cls=lr)
+                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='%s_trip' % name, n_epochs=100, lr_e2e=lr, lr_cls=lr)
                     print('TNC acc: %.2f \t TNC auc: %.2f \t E2E acc: %.2f \t E2E auc: %.2f' % (
                     tnc_acc, tnc_auc, e2e_acc, e2e_auc))
 
@@ -309,5 +348,11 @@ if __name__=="__main__":
     parser.add_argument('--data', type=str, default='simulation')
     parser.add_argument('--cv', type=int, default=1)
     parser.add_argument('--train', action='store_true')
+    parser.add_argument('--encoder', type=str, default='rnn', help='Encoder of the simulation and HAR data, {rnn, tcn}')
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Project the input channels to this dimension before the GRU (simulation, har)')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    parser.add_argument('--precision', type=str, default='fp32', help='Precision of the forwards, one of {fp32, bf16}')
     args = parser.parse_args()
-    main(args.train, args.data, args.cv)
\ No newline at end of file
+    main(args.train, args.data, args.cv, encoder_type=args.encoder, reduced_channels=args.reduced_channels,
+         reduction=args.reduction, precision=args.precision)
\ No newline at end of file
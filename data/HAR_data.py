@@ -2,52 +2,71 @@
 Preprocess the HAR data to concatenate individual measurements
 '''
 
+import os
+import json
 import pandas as pd
 import numpy as np
 import pickle
 
-trainX = pd.read_csv('./data/HAR_data/train/X_train.txt', delim_whitespace=True,header=None)
-trainy = pd.read_csv('./data/HAR_data/train/y_train.txt',delim_whitespace=True,header=None)
-train_subj = pd.read_csv('./data/HAR_data/train/subject_train.txt', delim_whitespace=True,header=None)
-testX = pd.read_csv('./data/HAR_data/test/X_test.txt',delim_whitespace=True,header=None)
-testy = pd.read_csv('./data/HAR_data/test/y_test.txt',delim_whitespace=True,header=None)
-test_subj = pd.read_csv('./data/HAR_data/test/subject_test.txt', delim_whitespace=True,header=None)
-
-train_ids = np.unique(train_subj)
-x_train, y_train = [], []
-lens = []
-for i, ids in enumerate(train_ids):
-    inds = np.where(train_subj == ids)[0]
-    ts = np.take(trainX, inds, 0).to_numpy()
-    ts_labels = np.take(trainy, inds, 0).to_numpy().reshape(-1,1)
-    lens.append(len(ts))
-    x_train.append(ts.T)
-    y_train.append(ts_labels.reshape(-1, ))
-
-x_train = np.stack([x[:, :min(lens)] for x in x_train])
-y_train = np.stack([y[:min(lens)] for y in y_train])
-
-test_ids = np.unique(test_subj)
-x_test, y_test = [], []
-lens = []
-for i, ids in enumerate(test_ids):
-    inds = np.where(test_subj == ids)[0]
-    ts = np.take(testX, inds, 0).to_numpy()
-    # ts_labels = np.repeat(np.take(testy, inds, 0).to_numpy().reshape(-1,1), testX.shape[1], -1)
-    ts_labels = np.take(testy, inds, 0).to_numpy().reshape(-1,1)
-    lens.append(len(ts))
-    x_test.append(ts.T)
-    y_test.append(ts_labels.reshape(-1, ))
-
-x_test = np.stack([x[:, :min(lens)] for x in x_test])
-y_test = np.stack([y[:min(lens)] for y in y_test])
-
-## Save signals to file
-with open('./data/HAR_data/x_train.pkl', 'wb') as f:
-    pickle.dump(x_train, f)
-with open('./data/HAR_data/x_test.pkl', 'wb') as f:
-    pickle.dump(x_test, f)
-with open('./data/HAR_data/state_train.pkl', 'wb') as f:
-    pickle.dump(y_train-1, f)
-with open('./data/HAR_data/state_test.pkl', 'wb') as f:
-    pickle.dump(y_test-1, f)
\ No newline at end of file
+DATA_DIR = './data/HAR_data'
+
+
+def read_table(path, cache_dir):
+    """
+    Parse a whitespace separated text file into an array. The parsed array is cached as .npy and reused as long as
+    the size and modification time of the text file are unchanged
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    cache_file = os.path.join(cache_dir, os.path.basename(path).replace('.txt', '.npy'))
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime}
+    if os.path.exists(cache_file) and os.path.exists(cache_file + '.json'):
+        with open(cache_file + '.json') as f:
+            if json.load(f) == signature:
+                return np.load(cache_file)
+    table = pd.read_csv(path, sep=r'\s+', header=None, dtype=np.float64).to_numpy()
+    np.save(cache_file, table)
+    with open(cache_file + '.json', 'w') as f:
+        json.dump(signature, f)
+    return table
+
+
+def group_by_subject(x, y, subjects):
+    """
+    Assemble the measurements of each subject into one recording with a single sort. Returns the recordings padded
+    to the longest one (NaN for signals, -1 for labels) and the length of each recording
+    """
+    subjects = subjects.reshape(-1)
+    order = np.argsort(subjects, kind='stable')
+    _, starts, lengths = np.unique(subjects[order], return_index=True, return_counts=True)
+    x_padded = np.full((len(lengths), x.shape[-1], lengths.max()), np.nan)
+    y_padded = np.full((len(lengths), lengths.max()), -1, dtype=int)
+    for i, (x_subj, y_subj) in enumerate(zip(np.split(x[order], starts[1:]), np.split(y[order], starts[1:]))):
+        x_padded[i, :, :lengths[i]] = x_subj.T
+        y_padded[i, :lengths[i]] = y_subj.reshape(-1)
+    return x_padded, y_padded, lengths
+
+
+def main(data_dir=DATA_DIR):
+    cache_dir = os.path.join(data_dir, 'cache')
+    for split in ['train', 'test']:
+        x = read_table(os.path.join(data_dir, split, 'X_%s.txt' % split), cache_dir)
+        y = read_table(os.path.join(data_dir, split, 'y_%s.txt' % split), cache_dir).astype(int)
+        subjects = read_table(os.path.join(data_dir, split, 'subject_%s.txt' % split), cache_dir).astype(int)
+        x_padded, y_padded, lengths = group_by_subject(x, y, subjects)
+
+        # Full length recordings
+        np.save(os.path.join(data_dir, 'x_%s_padded.npy' % split), x_padded)
+        np.save(os.path.join(data_dir, 'state_%s_padded.npy' % split), np.where(y_padded >= 0, y_padded - 1, -1))
+        np.save(os.path.join(data_dir, 'lengths_%s.npy' % split), lengths)
+
+        ## Save signals to file, truncated to the shortest recording
+        with open(os.path.join(data_dir, 'x_%s.pkl' % split), 'wb') as f:
+            pickle.dump(x_padded[:, :, :lengths.min()], f)
+        with open(os.path.join(data_dir, 'state_%s.pkl' % split), 'wb') as f:
+            pickle.dump(y_padded[:, :lengths.min()] - 1, f)
+
+
+if __name__ == '__main__':
+    main()
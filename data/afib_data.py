@@ -10,13 +10,17 @@ from __future__ import absolute_import, division, print_function
 
 # 3rd party imports
 import os
+import json
 import wfdb
 import numpy as np
+import multiprocessing
 import pandas as pd
 import pickle
 import matplotlib.pyplot as plt
 from scipy import interpolate
 
+from tnc.labels import segments_from_onsets, rle_decode, save_label_segments
+
 # Local imports
 # from deepecg.config.config import DATA_DIR
 DATA_DIR = "./data/waveform_data"
@@ -29,11 +33,13 @@ class AFDB(object):
         https://physionet.org/physiobank/database/afdb/
         """
 
-    def __init__(self):
+    def __init__(self, data_dir=DATA_DIR, n_jobs=None):
         # Set attributes
         self.db_name = 'afdb'
-        self.raw_path = os.path.join(DATA_DIR, 'raw')
-        self.processed_path = os.path.join(DATA_DIR, 'processed')
+        self.raw_path = os.path.join(data_dir, 'raw')
+        self.processed_path = os.path.join(data_dir, 'processed')
+        self.records_path = os.path.join(self.processed_path, 'records')
+        self.n_jobs = n_jobs
         self.label_dict = {'AFIB': 'atrial fibrillation', 'AFL': 'atrial flutter', 'J': 'AV junctional rhythm'}
         self.fs = 300
         self.length = 60
@@ -65,33 +71,62 @@ class AFDB(object):
     def generate_processed_db(self):
         """Generate the processed version of the MIT-BIH Atrial Fibrillation database in the 'processed' folder."""
         print('Generating Processed MIT-BIH Atrial Fibrillation Database ...')
-        all_signals, all_labels = self._get_sections()
-
-        signal_lens = [len(sig) for sig in all_labels]
-        all_signals = np.array([sig[:,:min(signal_lens)] for sig in all_signals])
-        all_labels = np.array([sig[:min(signal_lens)] for sig in all_labels])
+        # Records are read in parallel and written one by one to the records folder, together with their statistics
+        if not os.path.exists(self.records_path):
+            os.makedirs(self.records_path)
+        n_train = int(0.8*len(self.record_ids))
+        lengths, stats = [], None
+        tasks = [(self.raw_path, self.records_path, record_id) for record_id in self.record_ids]
+        with multiprocessing.Pool(self.n_jobs) as pool:
+            for i, (length, record_stats) in enumerate(pool.imap(_process_record, tasks)):
+                lengths.append(length)
+                if i < n_train:
+                    stats = record_stats if stats is None else _merge_stats(stats, record_stats)
+        count, feature_means, m2 = stats
+        feature_std = np.sqrt(m2 / count)
+        with open(os.path.join(self.records_path, 'stats.json'), 'w') as f:
+            json.dump({'record_ids': self.record_ids, 'lengths': lengths, 'n_train': n_train,
+                       'mean': feature_means.tolist(), 'std': feature_std.tolist()}, f)
+
+        # The dense signal datasets truncate all the recordings to the shortest one, labels are kept as segments of
+        # the full recordings (tnc.labels.load_states rebuilds the truncated dense arrays)
+        min_len = min(lengths)
+        all_signals, all_segments = [], []
+        for record_id in self.record_ids:
+            signal, segments = self._load_record(record_id, mmap=True)
+            all_signals.append(signal[:, :min_len])
+            all_segments.append(segments)
+        all_signals = np.array(all_signals)
 
-        n_train = int(0.8*len(all_signals))
         train_data = all_signals[:n_train]
         test_data = all_signals[n_train:]
-        train_state = all_labels[:n_train]
-        test_state = all_labels[n_train:]
-
-        # Normalize signals
-        train_data_n, test_data_n = self._normalize(train_data, test_data)
 
+        # Normalize signals with the statistics of the full training recordings
+        feature_std = np.where(feature_std == 0, 1, feature_std)[np.newaxis, :, np.newaxis]
+        train_data_n = (train_data - feature_means[np.newaxis, :, np.newaxis]) / feature_std
+        test_data_n = (test_data - feature_means[np.newaxis, :, np.newaxis]) / feature_std
 
         # Save signals to file
-        if not os.path.exists(self.processed_path):
-            os.mkdir(self.processed_path)
         with open(os.path.join(self.processed_path, 'x_train.pkl'), 'wb') as f:
             pickle.dump(train_data_n, f)
         with open(os.path.join(self.processed_path, 'x_test.pkl'), 'wb') as f:
             pickle.dump(test_data_n, f)
-        with open(os.path.join(self.processed_path, 'state_train.pkl'), 'wb') as f:
-            pickle.dump(train_state, f)
-        with open(os.path.join(self.processed_path, 'state_test.pkl'), 'wb') as f:
-            pickle.dump(test_state, f)
+        save_label_segments(os.path.join(self.processed_path, 'state_train_segments.npz'), all_segments[:n_train],
+                            lengths[:n_train], dense_length=min_len)
+        save_label_segments(os.path.join(self.processed_path, 'state_test_segments.npz'), all_segments[n_train:],
+                            lengths[n_train:], dense_length=min_len)
+
+    def _load_record(self, record_id, mmap=False):
+        """Load a preprocessed record (signal of shape (n_channels, length) and its label segments)"""
+        mmap_mode = 'r' if mmap else None
+        signal = np.load(os.path.join(self.records_path, '%s_signal.npy' % record_id), mmap_mode=mmap_mode)
+        segments = np.load(os.path.join(self.records_path, '%s_segments.npy' % record_id))
+        return signal, segments
+
+    def load_labels(self, record_id):
+        """Dense per sample labels of a preprocessed record"""
+        _, segments = self._load_record(record_id, mmap=True)
+        return rle_decode(segments, dtype=float)
 
     def _normalize(self, train_data, test_data):
         """ Calculate the mean and std of each feature from the training set
@@ -104,43 +139,38 @@ class AFDB(object):
                       np.where(feature_std == 0, 1, feature_std)[np.newaxis, :, np.newaxis]
         return train_data_n, test_data_n
 
-    def _get_sections(self):
-        """Collect continuous arrhythmia sections."""
-        # Empty dictionary for arrhythmia sections
-        all_signals = []
-        all_labels = []
-
-        # Loop through records
-        for record_id in self.record_ids:
-            # Import recording
-            record = wfdb.rdrecord(os.path.join(self.raw_path, record_id))
 
-            # Import annotations
-            annotation = wfdb.rdann(os.path.join(self.raw_path, record_id), 'atr')
+def _label_segments(samples, labels, length):
+    """Label segments (start, length, class) from the annotation onsets, starting at the first annotation"""
+    codes = np.array([afib_dict[l] for l in labels])
+    return segments_from_onsets(samples - samples[0], codes, length - samples[0])
 
-            # Get sample frequency
-            fs = record.__dict__['fs']
 
-            # Get waveform
-            waveform = record.__dict__['p_signal']  #shape: (length, n_channels=2)
+def _merge_stats(a, b):
+    """Combine the (count, mean, M2) channel statistics of two sets of samples (Chan et al. update of Welford)"""
+    count_a, mean_a, m2_a = a
+    count_b, mean_b, m2_b = b
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    return count, mean_a + delta*count_b/count, m2_a + m2_b + delta**2*count_a*count_b/count
 
-            # labels
-            labels = [label[1:] for label in annotation.__dict__['aux_note']]
 
-            # Samples
-            sample = annotation.__dict__['sample']
+def _process_record(task):
+    """Read a record, encode its annotations as segments and write both to the records folder. Returns length, stats"""
+    raw_path, records_path, record_id = task
+    record = wfdb.rdrecord(os.path.join(raw_path, record_id))
+    annotation = wfdb.rdann(os.path.join(raw_path, record_id), 'atr')
 
-            padded_labels = np.zeros(len(waveform))
-            for i,l in enumerate(labels):
-                if i==len(labels)-1:
-                    padded_labels[sample[i]:] = afib_dict[l]
-                else:
-                    padded_labels[sample[i]:sample[i+1]] = afib_dict[l]
-            padded_labels = padded_labels[sample[0]:]
-            all_labels.append(padded_labels)
-            all_signals.append(waveform[sample[0]:,:].T)
+    waveform = record.__dict__['p_signal']  #shape: (length, n_channels=2)
+    labels = [label[1:] for label in annotation.__dict__['aux_note']]
+    sample = annotation.__dict__['sample']
 
-        return all_signals, all_labels
+    segments = _label_segments(sample, labels, len(waveform))
+    signal = waveform[sample[0]:, :].T
+    np.save(os.path.join(records_path, '%s_signal.npy' % record_id), signal)
+    np.save(os.path.join(records_path, '%s_segments.npy' % record_id), segments)
+    mean = np.mean(signal, axis=-1)
+    return signal.shape[-1], (signal.shape[-1], mean, np.sum((signal - mean[:, np.newaxis])**2, axis=-1))
 
 
 if __name__=="__main__":
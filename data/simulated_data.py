@@ -5,6 +5,9 @@ import seaborn as sns; sns.set()
 
 import os
 import pickle
+import argparse
+import multiprocessing
+from functools import lru_cache
 
 n_signals = 5
 n_states = 4
@@ -17,16 +20,8 @@ transition_matrix[2,1] = transition_matrix[1,2] = 0.05
 transition_matrix[3,1] = transition_matrix[1,3] = 0.05
 
 
-def main(n_samples, sig_len):
-    all_signals = []
-    all_states = []
-    for _ in range(n_samples):
-        sample_signal, sample_state = create_signal(sig_len)
-        all_signals.append(sample_signal)
-        all_states.append(sample_state)
-
-    dataset = np.array(all_signals)
-    states = np.array(all_states)
+def main(n_samples, sig_len, n_jobs=None, seed=0):
+    dataset, states = generate_signals(n_samples, sig_len, n_jobs=n_jobs, seed=seed)
     n_train = int(len(dataset) * 0.8)
     train_data = dataset[:n_train]
     test_data = dataset[n_train:]
@@ -87,6 +82,97 @@ def create_signal(sig_len, window_size=50):
     return signals, states
 
 
+def generate_signals(n_samples, sig_len, window_size=50, n_jobs=None, seed=0, chunk_size=50):
+    """
+    Vectorized and parallel equivalent of calling create_signal n_samples times.
+    Samples are generated in chunks on a process pool, each chunk with its own RNG seeded from `seed`, and written
+    into preallocated arrays. Returns the signals (n_samples, 3, T) and the states (n_samples, T).
+    """
+    n_windows = sig_len // window_size
+    signals = np.empty((n_samples, 3, n_windows*window_size))
+    states = np.empty((n_samples, n_windows*window_size), dtype=int)
+    chunks = list(range(0, n_samples, chunk_size))
+    seeds = np.random.SeedSequence(seed).spawn(len(chunks))
+    tasks = [(min(chunk_size, n_samples - start), n_windows, window_size, chunk_seed)
+             for start, chunk_seed in zip(chunks, seeds)]
+    with multiprocessing.Pool(n_jobs) as pool:
+        for start, (chunk_signals, chunk_states) in zip(chunks, pool.imap(_generate_chunk, tasks)):
+            signals[start:start + len(chunk_signals)] = chunk_signals
+            states[start:start + len(chunk_states)] = chunk_states
+    return signals, states
+
+
+def _generate_chunk(task):
+    n, n_windows, window_size, chunk_seed = task
+    rng = np.random.default_rng(chunk_seed)
+    # Markov chain of the window states, one step for all the samples at once
+    cumulative_transitions = np.cumsum(transition_matrix, -1)
+    window_states = np.empty((n, n_windows), dtype=int)
+    window_states[:, 0] = rng.integers(0, n_states, n)
+    for w in range(1, n_windows):
+        u = rng.random(n)
+        next_state = (u[:, np.newaxis] > cumulative_transitions[window_states[:, w - 1]]).sum(-1)
+        window_states[:, w] = np.minimum(next_state, n_states - 1)
+
+    sig_1 = np.empty((n, n_windows, window_size))
+    sig_3 = np.empty((n, n_windows, window_size))
+    for state in range(n_states):
+        mask = window_states == state
+        sig_1[mask] = _state_windows(state, mask.sum(), window_size, rng)
+        mask = (window_states + 2) % 4 == state
+        sig_3[mask] = _state_windows(state, mask.sum(), window_size, rng)
+    sig_2 = sig_1*0.9 + .03 + rng.standard_normal(sig_1.shape)*0.4
+    signals = np.stack([sig_1, sig_2, sig_3], 1).reshape((n, 3, -1))
+    return signals, np.repeat(window_states, window_size, -1)
+
+
+def _state_windows(state, n, window_size, rng):
+    """n windows of the signal of a state (as in ts_generator), with the white noise of the TimeSynth samples"""
+    if state in [0, 2]:
+        factor = _gp_factor('Periodic' if state == 0 else 'SE', window_size)
+        windows = rng.standard_normal((n, window_size)).dot(factor.T)
+    else:
+        windows = np.broadcast_to(_narma_trajectory(state, window_size), (n, window_size))
+    return windows + rng.standard_normal((n, window_size))*0.3
+
+
+@lru_cache(maxsize=None)
+def _gp_factor(kernel, window_size):
+    """Factor L of the GP covariance (L L^T = K) on the fixed window grid, computed once per process"""
+    t = np.linspace(0, window_size, window_size)
+    diff = t[:, np.newaxis] - t[np.newaxis, :]
+    if kernel == 'Periodic':
+        cov = .1*np.exp(-2*np.square(np.sin(np.pi*np.abs(diff)/5)))
+    else:
+        cov = .1*np.exp(-np.square(diff)/2)
+    cov[np.diag_indices_from(cov)] += 1e-12
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        # The periodic kernel is rank deficient on this grid, fall back to the symmetric square root
+        eigval, eigvec = np.linalg.eigh(cov)
+        return eigvec*np.sqrt(np.maximum(eigval, 0))
+
+
+@lru_cache(maxsize=None)
+def _narma_trajectory(state, window_size):
+    """
+    Noise-free NARMA window of states 1 and 3. TimeSynth seeds every NARMA generator with the same seed, so this
+    trajectory is identical for all the windows and is computed once, following the TimeSynth recursion
+    """
+    if state == 1:
+        order, a, init = 5, [0.3, 0.05, 1.5, 0.1], [0.671, 0.682, 0.675, 0.687, 0.69]
+    else:
+        order, a, init = 3, [0.1, 0.25, 2.5, -0.005], [1, 0.97, 0.96]
+    random = np.random.RandomState(42)
+    u = np.concatenate([random.uniform(0, 0.5, size=order), random.uniform(0, .5, size=window_size)])
+    y = np.concatenate([np.array(init, dtype=float), np.zeros(window_size)])
+    for i in range(order, order + window_size):
+        y[i] = a[0]*y[i-1] + a[1]*y[i-1]*np.sum(y[i-order:order]) + a[2]*u[i-order]*u[i] + a[3]
+    y.setflags(write=False)
+    return y[order:]
+
+
 def ts_generator(state, window_size):
     time_sampler = ts.TimeSampler(stop_time=window_size)
     sampler = time_sampler.sample_regular_time(num_points=window_size)
@@ -129,4 +215,10 @@ def normalize(train_data, test_data, config='mean_normalized'):
 
 
 if __name__ == '__main__':
-    main(n_samples=500, sig_len=2000)
+    parser = argparse.ArgumentParser(description='Generate the simulated dataset')
+    parser.add_argument('--n_samples', type=int, default=500)
+    parser.add_argument('--sig_len', type=int, default=2000)
+    parser.add_argument('--n_jobs', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    main(n_samples=args.n_samples, sig_len=args.sig_len, n_jobs=args.n_jobs, seed=args.seed)
@@ -1,145 +1,184 @@
+"""
+Anomaly detection in the encoding space of the waveform data
+"""
+
 import torch
 import os
 import pickle
 import numpy as np
 import random
+import argparse
 
-from tnc.models import WFEncoder
+from tnc.models import WFEncoder, StudentWFEncoder
+from tnc.utils import knn_search
+from tnc.labels import chopped_window_labels
 from sklearn.metrics import roc_auc_score, average_precision_score
+from sklearn.neighbors import KDTree, BallTree
 from sklearn.utils import column_or_1d
-from baselines.dtw import DTWDistance, cluster
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-encoder = WFEncoder(encoding_size=64)
-tcl_checkpoint = torch.load('./ckpt/waveform/checkpoint_1.pth.tar')
-# tcl_checkpoint = torch.load('./ckpt/waveform_trip/checkpoint.pth.tar')
-encoder.load_state_dict(tcl_checkpoint['encoder_state_dict'])
-encoder.eval()
-encoder.to(device)
-
-window_size = 2500
-path = './data/waveform_data/processed'
-
-
-with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
-    x_test = pickle.load(f)
-with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-    y_test = pickle.load(f)
-
-# with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
-#     x_train = pickle.load(f)
-# with open(os.path.join(path, 'state_train.pkl'), 'rb') as f:
-#     y_train = pickle.load(f)
-
-T = x_test.shape[-1]
-x_window = np.split(x_test[:, :, :window_size * (T // window_size)], (T // window_size), -1)
-x_window = np.concatenate(x_window, 0)
-y_window = np.concatenate(np.split(y_test[:, :window_size * (T // window_size)], (T // window_size), -1),0).astype(int)
-y_window = np.array([np.bincount(yy).argmax() for yy in y_window])
-
-T = x_test.shape[-1]
-# x_window_train = np.split(x_train[:, :, :window_size * (T // window_size)], (T // window_size), -1)
-# x_window_train = np.concatenate(x_window_train, 0)
-# y_window_train = np.concatenate(np.split(y_train[:, :window_size * (T // window_size)], (T // window_size), -1),0).astype(int)
-# y_window_train = np.array([np.bincount(yy).argmax() for yy in y_window_train])
-# shuffled_inds_train = list(range(len(x_window_train)))
-# random.shuffle(shuffled_inds_train)
-shuffled_inds_test = list(range(len(x_window)))
-random.shuffle(shuffled_inds_test)
-
-# print(x_window.shape, y_window.shape)
-testset = torch.utils.data.TensorDataset(torch.Tensor(x_window), torch.Tensor(y_window))
-test_loader = torch.utils.data.DataLoader(testset, batch_size=100, shuffle=True)
-# trainset = torch.utils.data.TensorDataset(torch.Tensor(x_window_train), torch.Tensor(y_window_train))
-# train_loader = torch.utils.data.DataLoader(trainset, batch_size=100, shuffle=True)
-
-is_anomaly = y_window.copy()
-is_anomaly = np.logical_or(is_anomaly==1, is_anomaly==2).astype(int)
-
-encodings_train = []
-for x,_ in test_loader:
-    encodings_train.append(encoder(x.to(device)).detach().cpu().numpy())
-encodings_train = np.concatenate(encodings_train, 0)
-print(encodings_train.shape)
-
-# train the KNN detector
-from pyod.models.knn import KNN
-from pyod.models.pca import PCA
-from pyod.models.lof import LOF
-from pyod.models.cblof import CBLOF
-from pyod.models.mcd import MCD
-from pyod.models.lscp import LSCP
-# from pyod.models.auto_encoder import AutoEncoder
-
-clf_knn = KNN()
-clf_pca = PCA()
-clf_mcd = MCD()
-clf_lof = LOF()
-clf_cblof = CBLOF()
-# clf_lscp = LSCP([clf_knn, clf_pca, clf_mcd ])
-# clf_ae = AutoEncoder(epochs=50)
-
-clf_mcd.fit(encodings_train)
-clf_pca.fit(encodings_train)
-clf_knn.fit(encodings_train)
-clf_lof.fit(encodings_train)
-clf_cblof.fit(encodings_train)
-# clf_lscp.fit(encodings_train)
-# clf_ae.fit(encodings_train)
-
-anomaly_scores_mcd = clf_mcd.decision_function(encodings_train)
-anomaly_scores_pca = clf_pca.decision_function(encodings_train)
-anomaly_scores_knn = clf_knn.decision_function(encodings_train)
-anomaly_scores_lof = clf_lof.decision_function(encodings_train)
-anomaly_scores_cblof = clf_cblof.decision_function(encodings_train)
-# anomaly_scores_lscp = clf_lscp.decision_function(encodings_train)
-# anomaly_scores_ae = clf_ae.predict_proba(encodings_train)
-
-
-# y_test_scores = []
-# for x,_ in test_loader:
-#     encodings_test = encoder(torch.Tensor(x).to(device))
-#     probs = clf.predict_proba(encodings_test.detach().cpu().numpy())
-#     y_test_scores.extend(probs[:,0])
-# y_test_scores = np.array(y_test_scores)
-
-y_ind_1 = np.argwhere(y_window.reshape(-1, ) == 1)
-y_ind_3 = np.argwhere(y_window.reshape(-1, ) == 3)
-
-for i, anomaly_scores in enumerate([anomaly_scores_knn, anomaly_scores_lof, anomaly_scores_cblof, anomaly_scores_mcd, anomaly_scores_pca]):
-    method = ['KNN', 'LOF', 'CBLOF', 'MCD', 'PCA'][i]
-    print('********** Results for ', method)
-    auc = roc_auc_score(column_or_1d(is_anomaly), column_or_1d(anomaly_scores))#[:,0])
-    auprc = average_precision_score(column_or_1d(is_anomaly), column_or_1d(anomaly_scores))#[:,0])
-    print('Anomaly detection AUC: ', auc)
-    print('Anomaly detection AUPRC: ', auprc)
-    print('Label 1: ', np.mean(anomaly_scores[y_ind_1.reshape(-1,)]), '+-',
-          np.std(anomaly_scores[y_ind_1.reshape(-1,)]))
-    print('Label 3: ', np.mean(anomaly_scores[y_ind_3.reshape(-1,)]), '+-',
-          np.std(anomaly_scores[y_ind_3.reshape(-1,)]))
-
-
-# train_data = np.transpose(x_window, (0,2,1))
-
-# Calculate distances using DTW
-# dtw_distances = np.zeros((100,100))
-# w = 2500
-# for ind, i in enumerate(train_data[shuffled_inds[:100]]):
-#     for c_ind, j in enumerate(train_data[shuffled_inds[:100]]):
-#         cur_dist = 0.0
-#         # Find sum of distances along each dimension
-#         for z in range(np.shape(train_data)[2]):
-#             cur_dist += DTWDistance(i[:, z], j[:, z], w)
-#         print(cur_dist)
-#         dtw_distances[ind, c_ind] = cur_dist
-# clusters, curr_medoids = cluster(dtw_distances, 4)
-#
-# encoding_distances = torch.matmul(encodings, encodings.permute(1,0)).detach().cpu().numpy()
-# encoding_distances = np.min(abs(encoding_distances), -1)
-#
-# # print('Distance distribution in DTW: ', np.mean(dtw_distances), ' += ', np.std(dtw_distances))
-# print('Distance distribution in encoding space: ', np.mean(encoding_distances).item(), ' += ', np.std(encoding_distances).item())
-#
-# y_ind_1 = np.argwhere(y_window.reshape(-1,)==1)
-# print(y_ind_1)
\ No newline at end of file
+
+class AnomalyScorer():
+    """
+    Neighbour based anomaly scores (KNN distance and LOF) that share a single neighbour index over the encodings.
+
+    The k-nearest neighbour graph of the reference encodings is computed once in `fit`. `score` only queries the
+    index for the new windows, and `partial_fit` adds windows to the reference set by merging the new points into
+    the existing neighbour lists instead of recomputing the whole graph.
+    Scores follow the pyod convention: the higher, the more anomalous.
+    """
+    def __init__(self, n_neighbors=10, algorithm='auto', block_size=1024):
+        if algorithm not in ['auto', 'kd_tree', 'ball_tree', 'brute']:
+            raise ValueError('Algorithm must be one of the following {auto, kd_tree, ball_tree, brute}')
+        self.n_neighbors = n_neighbors
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.x = None
+        self.tree = None
+
+    def _build_tree(self, x):
+        algorithm = self.algorithm
+        if algorithm == 'auto':
+            # Space partitioning stops paying off in high dimensions, a blocked GEMM is faster there
+            algorithm = 'kd_tree' if x.shape[-1] <= 16 else 'brute'
+        if algorithm == 'kd_tree':
+            return KDTree(x)
+        elif algorithm == 'ball_tree':
+            return BallTree(x)
+        return None
+
+    def _query(self, queries, k, tree=None, data=None, exclude_self=False):
+        data = self.x if data is None else data
+        if tree is None:
+            return knn_search(queries, data, k, block_size=self.block_size, exclude_self=exclude_self)
+        if not exclude_self:
+            return tree.query(queries, k=min(k, len(data)))
+        dist, ind = tree.query(queries, k=min(k + 1, len(data)))
+        # Drop each point from its own neighbour list (or the farthest neighbour if a duplicate displaced it)
+        is_self = ind == np.arange(len(queries))[:, np.newaxis]
+        is_self[~is_self.any(-1), -1] = True
+        keep = ~is_self
+        return dist[keep].reshape((len(ind), -1)), ind[keep].reshape((len(ind), -1))
+
+    def _update_density(self):
+        self.k_distance = self.neigh_dist[:, -1]
+        self.lrd = self._local_reachability_density(self.neigh_dist, self.neigh_ind)
+        self.decision_scores_ = {'knn': self.neigh_dist[:, -1],
+                                 'mean': np.mean(self.neigh_dist, -1),
+                                 'lof': np.mean(self.lrd[self.neigh_ind], -1) / self.lrd}
+
+    def _local_reachability_density(self, dist, ind):
+        reach_dist = np.maximum(dist, self.k_distance[ind])
+        return 1. / (np.mean(reach_dist, -1) + 1e-10)
+
+    def fit(self, x):
+        """Build the neighbour index and the neighbour graph of the reference encodings x"""
+        self.x = np.asarray(x, dtype=np.float32)
+        self.tree = self._build_tree(self.x)
+        self.neigh_dist, self.neigh_ind = self._query(self.x, self.n_neighbors, tree=self.tree, exclude_self=True)
+        self._update_density()
+        return self
+
+    def partial_fit(self, x):
+        """Add new encodings to the reference set, updating the neighbour graph incrementally"""
+        if self.x is None:
+            return self.fit(x)
+        x = np.asarray(x, dtype=np.float32)
+        n_old = len(self.x)
+        # Neighbours of the new points among the old ones and among themselves
+        dist_old, ind_old = self._query(x, self.n_neighbors, tree=self.tree)
+        new_tree = self._build_tree(x)
+        dist_new, ind_new = self._query(x, self.n_neighbors, tree=new_tree, data=x, exclude_self=True)
+        new_dist, new_ind = self._merge(dist_old, ind_old, dist_new, ind_new + n_old)
+        # The new points can only displace the farthest neighbours of the old points
+        dist_cand, ind_cand = self._query(self.x, self.n_neighbors, tree=new_tree, data=x)
+        old_dist, old_ind = self._merge(self.neigh_dist, self.neigh_ind, dist_cand, ind_cand + n_old)
+
+        self.x = np.concatenate([self.x, x], 0)
+        self.tree = self._build_tree(self.x)
+        self.neigh_dist = np.concatenate([old_dist, new_dist], 0)
+        self.neigh_ind = np.concatenate([old_ind, new_ind], 0)
+        self._update_density()
+        return self
+
+    def _merge(self, dist_a, ind_a, dist_b, ind_b):
+        dist = np.concatenate([dist_a, dist_b], -1)
+        ind = np.concatenate([ind_a, ind_b], -1)
+        order = np.argsort(dist, axis=-1)[:, :self.n_neighbors]
+        return np.take_along_axis(dist, order, -1), np.take_along_axis(ind, order, -1)
+
+    def score(self, x, method='knn'):
+        """Anomaly score of new encodings x with respect to the reference set, one of {knn, mean, lof}"""
+        dist, ind = self._query(np.asarray(x, dtype=np.float32), self.n_neighbors, tree=self.tree)
+        if method == 'knn':
+            return dist[:, -1]
+        elif method == 'mean':
+            return np.mean(dist, -1)
+        elif method == 'lof':
+            return np.mean(self.lrd[ind], -1) / self._local_reachability_density(dist, ind)
+        raise ValueError('Scoring method not defined, must be one of the following {knn, mean, lof}')
+
+
+def main(args):
+    encoder = (StudentWFEncoder if 'student' in args.path else WFEncoder)(encoding_size=64)
+    checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar' % (args.path, args.cv))
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    encoder.eval()
+    encoder.to(device)
+
+    window_size = 2500
+    path = './data/waveform_data/processed'
+    with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
+        x_test = pickle.load(f)
+
+    T = x_test.shape[-1]
+    x_window = np.split(x_test[:, :, :window_size * (T // window_size)], (T // window_size), -1)
+    x_window = np.concatenate(x_window, 0)
+    y_window = chopped_window_labels(path, 'test', window_size, T).astype(int)
+    testset = torch.utils.data.TensorDataset(torch.Tensor(x_window), torch.Tensor(y_window))
+    test_loader = torch.utils.data.DataLoader(testset, batch_size=100)
+
+    encodings = []
+    with torch.no_grad():
+        for x, _ in test_loader:
+            encodings.append(encoder(x.to(device)).cpu().numpy())
+    encodings = np.concatenate(encodings, 0)
+    print(encodings.shape)
+
+    is_anomaly = np.logical_or(y_window == 1, y_window == 2).astype(int)
+    scorer = AnomalyScorer(n_neighbors=args.K, algorithm=args.algorithm).fit(encodings)
+    all_scores = {'KNN': scorer.decision_scores_['knn'], 'Mean KNN': scorer.decision_scores_['mean'],
+                  'LOF': scorer.decision_scores_['lof']}
+    if args.pyod:
+        # Detectors that do not rely on the neighbour graph
+        from pyod.models.pca import PCA
+        from pyod.models.cblof import CBLOF
+        from pyod.models.mcd import MCD
+        for method, clf in [('CBLOF', CBLOF()), ('MCD', MCD()), ('PCA', PCA())]:
+            all_scores[method] = clf.fit(encodings).decision_function(encodings)
+
+    y_ind_1 = np.argwhere(y_window.reshape(-1, ) == 1)
+    y_ind_3 = np.argwhere(y_window.reshape(-1, ) == 3)
+    for method, anomaly_scores in all_scores.items():
+        print('********** Results for ', method)
+        auc = roc_auc_score(column_or_1d(is_anomaly), column_or_1d(anomaly_scores))
+        auprc = average_precision_score(column_or_1d(is_anomaly), column_or_1d(anomaly_scores))
+        print('Anomaly detection AUC: ', auc)
+        print('Anomaly detection AUPRC: ', auprc)
+        print('Label 1: ', np.mean(anomaly_scores[y_ind_1.reshape(-1,)]), '+-',
+              np.std(anomaly_scores[y_ind_1.reshape(-1,)]))
+        print('Label 3: ', np.mean(anomaly_scores[y_ind_3.reshape(-1,)]), '+-',
+              np.std(anomaly_scores[y_ind_3.reshape(-1,)]))
+
+
+if __name__ == '__main__':
+    random.seed(1234)
+    parser = argparse.ArgumentParser(description='Anomaly detection in the encoding space')
+    parser.add_argument('--path', type=str, default='waveform')
+    parser.add_argument('--cv', type=int, default=1)
+    parser.add_argument('--K', type=int, default=10)
+    parser.add_argument('--algorithm', type=str, default='auto')
+    parser.add_argument('--pyod', action='store_true', help='Also run the CBLOF, MCD and PCA detectors from pyod')
+    args = parser.parse_args()
+    main(args)
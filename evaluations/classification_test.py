@@ -6,7 +6,9 @@ import random
 import argparse
 import matplotlib.pyplot as plt
 
-from tnc.models import RnnEncoder, StateClassifier, E2EStateClassifier, WFEncoder, WFClassifier
+from tnc.models import RnnEncoder, StateClassifier, E2EStateClassifier, WFEncoder, WFClassifier, TCNEncoder, TCN_CONFIGS, \
+    StudentWFEncoder
+from tnc.labels import load_states
 from sklearn.metrics import roc_auc_score, confusion_matrix, accuracy_score
 from sklearn.metrics import average_precision_score
 
@@ -147,16 +149,23 @@ def train(train_loader, valid_loader, classifier, lr, data_type, encoder=None, n
     return best_acc, best_auc, best_aupc
 
 
-def run_test(data, e2e_lr, tnc_lr, cpc_lr, trip_lr, data_path, window_size, n_cross_val):
+def _sequence_encoder(data, encoder_type, encoding_size):
+    if encoder_type == 'tcn':
+        return TCNEncoder(device=device, **TCN_CONFIGS[data])
+    return RnnEncoder(hidden_size=100, in_channel=TCN_CONFIGS[data]['in_channel'], encoding_size=encoding_size,
+                      device=device)
+
+
+def run_test(data, e2e_lr, tnc_lr, cpc_lr, trip_lr, data_path, window_size, n_cross_val, encoder_type='rnn'):
+    # Encoders other than the RnnEncoder are loaded from <data>_<encoder_type>, <data>_<encoder_type>_cpc, ...
+    name = data if encoder_type == 'rnn' else '%s_%s' % (data, encoder_type)
     # Load data
     with open(os.path.join(data_path, 'x_train.pkl'), 'rb') as f:
         x = pickle.load(f)
-    with open(os.path.join(data_path, 'state_train.pkl'), 'rb') as f:
-        y = pickle.load(f)
+    y = load_states(data_path, 'train')
     with open(os.path.join(data_path, 'x_test.pkl'), 'rb') as f:
         x_test = pickle.load(f)
-    with open(os.path.join(data_path, 'state_test.pkl'), 'rb') as f:
-        y_test = pickle.load(f)
+    y_test = load_states(data_path, 'test')
     T = x.shape[-1]
     x_window = np.split(x[:, :, :window_size * (T // window_size)], (T // window_size), -1)
     y_window = np.concatenate(np.split(y[:, :window_size * (T // window_size)], (T // window_size), -1), 0).astype(int)
@@ -198,10 +207,12 @@ def run_test(data, e2e_lr, tnc_lr, cpc_lr, trip_lr, data_path, window_size, n_cr
 
             e2e_model = WFEncoder(encoding_size=encoding_size, classify=True, n_classes=n_classes).to(device)
 
-            tnc_encoder = WFEncoder(encoding_size=encoding_size).to(device)
-            if not os.path.exists('./ckpt/waveform/checkpoint_%d.pth.tar'%cv):
+            # The distilled student (tnc.distillation) replaces the TNC encoder only
+            wf_encoder, tnc_path = (StudentWFEncoder, 'waveform_student') if encoder_type == 'student' else (WFEncoder, 'waveform')
+            tnc_encoder = wf_encoder(encoding_size=encoding_size).to(device)
+            if not os.path.exists('./ckpt/%s/checkpoint_%d.pth.tar'%(tnc_path, cv)):
                 RuntimeError('Checkpoint for TNC encoder does not exist!')
-            tnc_checkpoint = torch.load('./ckpt/waveform/checkpoint_%d.pth.tar'%cv)
+            tnc_checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(tnc_path, cv))
             tnc_encoder.load_state_dict(tnc_checkpoint['encoder_state_dict'])
             tnc_classifier = WFClassifier(encoding_size=encoding_size, output_size=4)
             tnc_model = torch.nn.Sequential(tnc_encoder, tnc_classifier).to(device)
@@ -229,20 +240,20 @@ def run_test(data, e2e_lr, tnc_lr, cpc_lr, trip_lr, data_path, window_size, n_cr
             e2e_model = E2EStateClassifier(hidden_size=100, in_channel=3, encoding_size=encoding_size,
                                            output_size=4, device=device)
 
-            tnc_encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=encoding_size, device=device)
-            tnc_checkpoint = torch.load('./ckpt/simulation/checkpoint_%d.pth.tar'%cv)
+            tnc_encoder = _sequence_encoder('simulation', encoder_type, encoding_size)
+            tnc_checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(name, cv))
             tnc_encoder.load_state_dict(tnc_checkpoint['encoder_state_dict'])
             tnc_classifier = StateClassifier(input_size=encoding_size, output_size=4).to(device)
             tnc_model = torch.nn.Sequential(tnc_encoder, tnc_classifier).to(device)
 
-            cpc_encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=encoding_size, device=device)
-            cpc_checkpoint = torch.load('./ckpt/simulation_cpc/checkpoint_%d.pth.tar'%cv)
+            cpc_encoder = _sequence_encoder('simulation', encoder_type, encoding_size)
+            cpc_checkpoint = torch.load('./ckpt/%s_cpc/checkpoint_%d.pth.tar'%(name, cv))
             cpc_encoder.load_state_dict(cpc_checkpoint['encoder_state_dict'])
             cpc_classifier = StateClassifier(input_size=encoding_size, output_size=4).to(device)
             cpc_model = torch.nn.Sequential(cpc_encoder, cpc_classifier).to(device)
 
-            trip_encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=encoding_size, device=device)
-            trip_checkpoint = torch.load('./ckpt/simulation_trip/checkpoint_%d.pth.tar'%cv)
+            trip_encoder = _sequence_encoder('simulation', encoder_type, encoding_size)
+            trip_checkpoint = torch.load('./ckpt/%s_trip/checkpoint_%d.pth.tar'%(name, cv))
             trip_encoder.load_state_dict(trip_checkpoint['encoder_state_dict'])
             trip_classifier = StateClassifier(input_size=encoding_size, output_size=4).to(device)
             trip_model = torch.nn.Sequential(trip_encoder, trip_classifier).to(device)
@@ -254,20 +265,20 @@ def run_test(data, e2e_lr, tnc_lr, cpc_lr, trip_lr, data_path, window_size, n_cr
             e2e_model = E2EStateClassifier(hidden_size=100, in_channel=561, encoding_size=encoding_size,
                                            output_size=6, device=device)
 
-            tnc_encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=encoding_size, device=device)
-            tnc_checkpoint = torch.load('./ckpt/har/checkpoint_%d.pth.tar'%cv)
+            tnc_encoder = _sequence_encoder('har', encoder_type, encoding_size)
+            tnc_checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(name, cv))
             tnc_encoder.load_state_dict(tnc_checkpoint['encoder_state_dict'])
             tnc_classifier = StateClassifier(input_size=encoding_size, output_size=6).to(device)
             tnc_model = torch.nn.Sequential(tnc_encoder, tnc_classifier).to(device)
 
-            cpc_encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=encoding_size, device=device)
-            cpc_checkpoint = torch.load('./ckpt/har_cpc/checkpoint_%d.pth.tar'%cv)
+            cpc_encoder = _sequence_encoder('har', encoder_type, encoding_size)
+            cpc_checkpoint = torch.load('./ckpt/%s_cpc/checkpoint_%d.pth.tar'%(name, cv))
             cpc_encoder.load_state_dict(cpc_checkpoint['encoder_state_dict'])
             cpc_classifier = StateClassifier(input_size=encoding_size, output_size=6).to(device)
             cpc_model = torch.nn.Sequential(cpc_encoder, cpc_classifier).to(device)
 
-            trip_encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=encoding_size, device=device)
-            trip_checkpoint = torch.load('./ckpt/har_trip/checkpoint_%d.pth.tar'%cv)
+            trip_encoder = _sequence_encoder('har', encoder_type, encoding_size)
+            trip_checkpoint = torch.load('./ckpt/%s_trip/checkpoint_%d.pth.tar'%(name, cv))
             trip_encoder.load_state_dict(trip_checkpoint['encoder_state_dict'])
             trip_classifier = StateClassifier(input_size=encoding_size, output_size=6).to(device)
             trip_model = torch.nn.Sequential(trip_encoder, trip_classifier).to(device)
@@ -353,6 +364,7 @@ if __name__=='__main__':
     parser = argparse.ArgumentParser(description='Run classification test')
     parser.add_argument('--data', type=str, default='simulation')
     parser.add_argument('--cv', type=int, default=1)
+    parser.add_argument('--encoder', type=str, default='rnn', help='Encoder of the simulation and HAR data, {rnn, tcn}, or student for the waveform data')
     args = parser.parse_args()
 
     if not os.path.exists('./ckpt/classifier_test'):
@@ -362,10 +374,13 @@ if __name__=='__main__':
     f.close()
     if args.data=='simulation':
         run_test(data='simulation', e2e_lr=0.01, tnc_lr=0.01, cpc_lr=0.1, trip_lr=0.1,
-                 data_path='./data/simulated_data/', window_size=50, n_cross_val=args.cv)
+                 data_path='./data/simulated_data/', window_size=50, n_cross_val=args.cv,
+                 encoder_type=args.encoder)
     elif args.data=='waveform':
         run_test(data='waveform', e2e_lr=0.0001, tnc_lr=0.01, cpc_lr=0.01, trip_lr=0.01,
-                 data_path='./data/waveform_data/processed', window_size=2500, n_cross_val=args.cv)
+                 data_path='./data/waveform_data/processed', window_size=2500, n_cross_val=args.cv,
+                 encoder_type=args.encoder)
     elif args.data=='har':
         run_test(data='har', e2e_lr=0.001, tnc_lr=0.1, cpc_lr=0.1, trip_lr=0.1,
-                 data_path='./data/HAR_data/', window_size=4, n_cross_val=args.cv)
+                 data_path='./data/HAR_data/', window_size=4, n_cross_val=args.cv,
+                 encoder_type=args.encoder)
@@ -4,166 +4,188 @@ Measure clusterability performance on multiple baselines and for different datas
 
 import torch
 import os
-from tnc.models import WFEncoder, RnnEncoder
+import argparse
+from tnc.models import WFEncoder, RnnEncoder, TCNEncoder, TCN_CONFIGS, StudentWFEncoder
+from tnc.labels import chopped_window_labels
 import pickle
 import numpy as np
-from sklearn.metrics import silhouette_score, davies_bouldin_score
-from sklearn.cluster import KMeans
+from scipy.stats import norm
+from sklearn.metrics import davies_bouldin_score
+from sklearn.cluster import KMeans, MiniBatchKMeans
 
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
-### Clusterability on Waveform
-encoder = WFEncoder(encoding_size=64)
-window_size = 2500
-datapath = './data/waveform_data/processed'
-with open(os.path.join(datapath, 'x_test.pkl'), 'rb') as f:
-    x_test = pickle.load(f)
-with open(os.path.join(datapath, 'state_test.pkl'), 'rb') as f:
-    y_test = pickle.load(f)
-
-T = x_test.shape[-1]
-x_chopped_test = np.split(x_test[:, :, :window_size * (T // window_size)], (T // window_size), -1)
-y_chopped_test = np.concatenate(np.split(y_test[:, :window_size * (T // window_size)], (T // window_size), -1),
-                                   0).astype(int)
-x_chopped_test = torch.Tensor(np.concatenate(x_chopped_test, 0))
-y_chopped_test = torch.Tensor(np.array([np.bincount(yy).argmax() for yy in y_chopped_test]))
-testset = torch.utils.data.TensorDataset(x_chopped_test, y_chopped_test)
-loader = torch.utils.data.DataLoader(testset, batch_size=100)
-
-n_test = len(x_test)
-inds = np.random.randint(0, x_test.shape[-1] - window_size, n_test * 200)
-windows = np.array([x_test[int(i % n_test), :, ind:ind + window_size] for i, ind in enumerate(inds)])
-windows = torch.Tensor(windows).to(device)
-y_window = np.array([y_test[i % n_test, ind:ind + window_size] for i, ind in enumerate(inds)]).astype(int)
-windows_state = np.array([np.bincount(yy).argmax() for yy in y_window])
-
-print('\nWAVEFORM DATASET')
-for i, path in enumerate(['waveform','waveform_cpc','waveform_trip']):
-    print('Score for ', path)
-    s_score = []
-    db_score = []
-    for cv in range(3):
-        checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
-        encoder.load_state_dict(checkpoint['encoder_state_dict'])
-        encoder = encoder.to(device)
-        encoder.eval()
-        encodings = []
-        for windows, _ in loader:
-            windows = windows.to(device)
-            encoding = encoder(windows).detach().cpu().numpy()
-            encodings.append(encoding)
-        encodings = np.concatenate(encodings, 0)
-        kmeans = KMeans(n_clusters=4, random_state=1).fit(encodings)
-        cluster_labels = kmeans.labels_
-        s_score.append(silhouette_score(encodings, cluster_labels))
-        db_score.append(davies_bouldin_score(encodings, cluster_labels))
-        del encodings
-    print('Silhouette score: ', np.mean(s_score),'+-', np.std(s_score))
-    print('Davies Bouldin score: ', np.mean(db_score),'+-', np.std(db_score))
-
-
-### Clusterability on Simulation
-encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device)
-window_size = 50
-datapath = './data/simulated_data/'
-with open(os.path.join(datapath, 'x_test.pkl'), 'rb') as f:
-    x_test = pickle.load(f)
-with open(os.path.join(datapath, 'state_test.pkl'), 'rb') as f:
-    y_test = pickle.load(f)
-
-T = x_test.shape[-1]
-x_chopped_test = np.split(x_test[:, :, :window_size * (T // window_size)], (T // window_size), -1)
-y_chopped_test = np.concatenate(np.split(y_test[:, :window_size * (T // window_size)], (T // window_size), -1),
-                                   0).astype(int)
-x_chopped_test = torch.Tensor(np.concatenate(x_chopped_test, 0))
-y_chopped_test = torch.Tensor(np.array([np.bincount(yy).argmax() for yy in y_chopped_test]))
-testset = torch.utils.data.TensorDataset(x_chopped_test, y_chopped_test)
-loader = torch.utils.data.DataLoader(testset, batch_size=100)
-
-n_test = len(x_test)
-inds = np.random.randint(0, x_test.shape[-1] - window_size, n_test * 100)
-windows = np.array([x_test[int(i % n_test), :, ind:ind + window_size] for i, ind in enumerate(inds)])
-windows = torch.Tensor(windows).to(device)
-y_window = np.array([y_test[i % n_test, ind:ind + window_size] for i, ind in enumerate(inds)]).astype(int)
-windows_state = np.array([np.bincount(yy).argmax() for yy in y_window])
-
-print('\nSIMULATION DATASET')
-for i, path in enumerate(['simulation','simulation_cpc','simulation_trip']):
-    print('Score for ', path)
-    s_score = []
-    db_score = []
-    for cv in range(4):
-        if not os.path.exists('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv)):
-            continue
-        checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
-        encoder.load_state_dict(checkpoint['encoder_state_dict'])
-        encoder = encoder.to(device)
-        encoder.eval()
-        encodings = []
-        for windows, _ in loader:
-            windows = windows.to(device)
-            encoding = encoder(windows).detach().cpu().numpy()
-            encodings.append(encoding)
-        encodings = np.concatenate(encodings, 0)
-
-        kmeans = KMeans(n_clusters=4, random_state=1).fit(encodings)
-        cluster_labels = kmeans.labels_
-        s_score.append(silhouette_score(encodings, cluster_labels))
-        db_score.append(davies_bouldin_score(encodings, cluster_labels))
-        del encodings
-    print('Silhouette score: ', np.mean(s_score),'+-', np.std(s_score))
-    print('Davies Bouldin score: ', np.mean(db_score),'+-', np.std(db_score))
-
-
-### Clusterability on HAR data
-encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device)
-window_size = 5
-datapath = './data/HAR_data/'
-with open(os.path.join(datapath, 'x_test.pkl'), 'rb') as f:
-    x_test = pickle.load(f)
-with open(os.path.join(datapath, 'state_test.pkl'), 'rb') as f:
-    y_test = pickle.load(f)
-
-T = x_test.shape[-1]
-x_chopped_test = np.split(x_test[:, :, :window_size * (T // window_size)], (T // window_size), -1)
-y_chopped_test = np.concatenate(np.split(y_test[:, :window_size * (T // window_size)], (T // window_size), -1),
-                                   0).astype(int)
-x_chopped_test = torch.Tensor(np.concatenate(x_chopped_test, 0))
-y_chopped_test = torch.Tensor(np.array([np.bincount(yy).argmax() for yy in y_chopped_test]))
-testset = torch.utils.data.TensorDataset(x_chopped_test, y_chopped_test)
-loader = torch.utils.data.DataLoader(testset, batch_size=100)
-
-n_test = len(x_test)
-inds = np.random.randint(0, x_test.shape[-1] - window_size, n_test * 100)
-windows = np.array([x_test[int(i % n_test), :, ind:ind + window_size] for i, ind in enumerate(inds)])
-windows = torch.Tensor(windows).to(device)
-y_window = np.array([y_test[i % n_test, ind:ind + window_size] for i, ind in enumerate(inds)]).astype(int)
-windows_state = np.array([np.bincount(yy).argmax() for yy in y_window])
-
-print('\nHAR DATASET')
-for i, path in enumerate(['har','har_cpc','har_trip']):
-    print('Score for ', path)
-    s_score = []
-    db_score = []
-    for cv in range(4):
-        if not os.path.exists('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv)):
-            continue
-        checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
-        encoder.load_state_dict(checkpoint['encoder_state_dict'])
-        encoder = encoder.to(device)
-        encoder.eval()
-        encodings = []
-        for windows, _ in loader:
-            windows = windows.to(device)
-            encoding = encoder(windows).detach().cpu().numpy()
-            encodings.append(encoding)
-        encodings = np.concatenate(encodings, 0)
-
-        kmeans = KMeans(n_clusters=6, random_state=1).fit(encodings)
-        cluster_labels = kmeans.labels_
-        s_score.append(silhouette_score(encodings, cluster_labels))
-        db_score.append(davies_bouldin_score(encodings, cluster_labels))
-        del encodings
-    print('Silhouette score: ', np.mean(s_score),'+-', np.std(s_score))
-    print('Davies Bouldin score: ', np.mean(db_score),'+-', np.std(db_score))
\ No newline at end of file
+
+def _rows_per_block(n_cols, max_memory):
+    """Number of rows of a float64 (rows, n_cols) distance block that fit in `max_memory` MB"""
+    return max(1, int(max_memory * 2**20) // (8 * max(n_cols, 1)))
+
+
+def cluster_encodings(x, n_clusters, minibatch=False, batch_size=1024, random_state=1):
+    """Cluster the rows of x with KMeans, or with mini-batch KMeans that only touches `batch_size` rows per update"""
+    if minibatch:
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, n_init=3, random_state=random_state)
+    else:
+        kmeans = KMeans(n_clusters=n_clusters, random_state=random_state)
+    return kmeans.fit_predict(x)
+
+
+def silhouette_samples_blocked(x, labels, indices=None, max_memory=256):
+    """
+    Exact silhouette coefficient of the points in `indices` (all points by default) against the full dataset.
+    Distances are computed for one block of rows at a time, so the n x n distance matrix is never built and the
+    working memory stays around `max_memory` MB.
+    """
+    x = np.asarray(x, dtype=np.float64).reshape((len(x), -1))
+    _, labels = np.unique(labels, return_inverse=True)
+    n_clusters = labels.max() + 1
+    if not 1 < n_clusters < len(x):
+        # Same check and message as sklearn's silhouette_score
+        raise ValueError('Number of labels is %d. Valid values are 2 to n_samples - 1 (inclusive)' % n_clusters)
+    counts = np.bincount(labels, minlength=n_clusters)
+    onehot = np.zeros((len(x), n_clusters))
+    onehot[np.arange(len(x)), labels] = 1
+    sq_norms = np.einsum('ij,ij->i', x, x)
+    if indices is None:
+        indices = np.arange(len(x))
+    # A block holds the distance matrix plus one temporary of the same size
+    step = _rows_per_block(2*len(x), max_memory)
+    s = np.zeros(len(indices))
+    for start in range(0, len(indices), step):
+        ind = indices[start:start + step]
+        dist = sq_norms[ind, np.newaxis] + sq_norms[np.newaxis, :] - 2*np.dot(x[ind], x.T)
+        np.sqrt(np.maximum(dist, 0, out=dist), out=dist)
+        cluster_dist = np.dot(dist, onehot)
+        del dist
+        own = labels[ind]
+        rows = np.arange(len(ind))
+        a = cluster_dist[rows, own] / np.maximum(counts[own] - 1, 1)
+        cluster_dist /= counts[np.newaxis, :]
+        cluster_dist[rows, own] = np.inf
+        b = cluster_dist.min(-1)
+        denom = np.maximum(a, b)
+        s_block = np.where(denom > 0, (b - a) / np.where(denom > 0, denom, 1), 0)
+        # Same convention as sklearn: points in singleton clusters get a score of 0
+        s_block[counts[own] == 1] = 0
+        s[start:start + len(ind)] = s_block
+    return s
+
+
+def silhouette_score_blocked(x, labels, max_memory=256):
+    """Exact mean silhouette coefficient, equivalent to sklearn's silhouette_score but with bounded memory"""
+    return np.mean(silhouette_samples_blocked(x, labels, max_memory=max_memory))
+
+
+def sampled_silhouette(x, labels, sample_size=2000, stratify=True, confidence=0.95, max_memory=256, random_state=None):
+    """
+    Estimate the mean silhouette coefficient from a sample of the points.
+
+    Each sampled point is scored exactly against the full dataset. With `stratify`, the sample is allocated to the
+    clusters in proportion to their size and the stratified estimator is used, which keeps small clusters represented.
+    Returns the estimate and its (lower, upper) normal confidence interval.
+    """
+    labels = np.asarray(labels)
+    n = len(labels)
+    if sample_size >= n:
+        score = silhouette_score_blocked(x, labels, max_memory=max_memory)
+        return score, (score, score)
+    rng = np.random.RandomState(random_state)
+    if stratify:
+        strata = [np.where(labels == c)[0] for c in np.unique(labels)]
+    else:
+        strata = [np.arange(n)]
+    sizes = np.array([len(members) for members in strata])
+    alloc = np.minimum(sizes, np.maximum(2, np.round(sample_size*sizes/n).astype(int)))
+    sample = [rng.choice(members, m, replace=False) for members, m in zip(strata, alloc)]
+    s = silhouette_samples_blocked(x, labels, indices=np.concatenate(sample), max_memory=max_memory)
+
+    score, var, offset = 0., 0., 0
+    for size, m in zip(sizes, alloc):
+        s_stratum = s[offset:offset + m]
+        offset += m
+        weight = size / n
+        score += weight*np.mean(s_stratum)
+        if m > 1:
+            # Finite population correction, the variance vanishes when a stratum is fully sampled
+            var += weight**2 * np.var(s_stratum, ddof=1) / m * (1 - m/size)
+    z = norm.ppf(0.5 + confidence/2)
+    return score, (score - z*np.sqrt(var), score + z*np.sqrt(var))
+
+
+def _chopped_test_loader(datapath, window_size):
+    with open(os.path.join(datapath, 'x_test.pkl'), 'rb') as f:
+        x_test = pickle.load(f)
+
+    T = x_test.shape[-1]
+    x_chopped_test = np.split(x_test[:, :, :window_size * (T // window_size)], (T // window_size), -1)
+    x_chopped_test = torch.Tensor(np.concatenate(x_chopped_test, 0))
+    y_chopped_test = torch.Tensor(chopped_window_labels(datapath, 'test', window_size, T))
+    testset = torch.utils.data.TensorDataset(x_chopped_test, y_chopped_test)
+    return torch.utils.data.DataLoader(testset, batch_size=100)
+
+
+def main(args):
+    configs = {
+        'waveform': (WFEncoder(encoding_size=64), 2500, './data/waveform_data/processed', 4, 3),
+        'simulation': (RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device), 50,
+                       './data/simulated_data/', 4, 4),
+        'har': (RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device), 5,
+                './data/HAR_data/', 6, 4)
+    }
+    datasets = list(configs.keys()) if args.data == 'all' else [args.data]
+    for data_type in datasets:
+        encoder, window_size, datapath, n_clusters, n_cv = configs[data_type]
+        loader = _chopped_test_loader(datapath, window_size)
+        name = data_type
+        if args.encoder == 'tcn' and data_type in TCN_CONFIGS:
+            encoder = TCNEncoder(device=device, **TCN_CONFIGS[data_type])
+            name = '%s_tcn' % data_type
+        elif args.encoder == 'student' and data_type == 'waveform':
+            encoder = StudentWFEncoder(encoding_size=64)
+            name = 'waveform_student'
+
+        print('\n%s DATASET' % data_type.upper())
+        for path in [name, '%s_cpc' % name, '%s_trip' % name]:
+            print('Score for ', path)
+            s_score = []
+            db_score = []
+            for cv in range(n_cv):
+                if not os.path.exists('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv)):
+                    continue
+                checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
+                encoder.load_state_dict(checkpoint['encoder_state_dict'])
+                encoder = encoder.to(device)
+                encoder.eval()
+                encodings = []
+                with torch.no_grad():
+                    for windows, _ in loader:
+                        windows = windows.to(device)
+                        encoding = encoder(windows).cpu().numpy()
+                        encodings.append(encoding)
+                encodings = np.concatenate(encodings, 0)
+
+                cluster_labels = cluster_encodings(encodings, n_clusters, minibatch=args.minibatch)
+                if args.sample_size > 0:
+                    score, (lower, upper) = sampled_silhouette(encodings, cluster_labels, sample_size=args.sample_size,
+                                                               max_memory=args.max_memory, random_state=cv)
+                    print('\t(cv:%d) Sampled silhouette score: %.4f [%.4f, %.4f]' % (cv, score, lower, upper))
+                else:
+                    score = silhouette_score_blocked(encodings, cluster_labels, max_memory=args.max_memory)
+                s_score.append(score)
+                db_score.append(davies_bouldin_score(encodings, cluster_labels))
+                del encodings
+            print('Silhouette score: ', np.mean(s_score),'+-', np.std(s_score))
+            print('Davies Bouldin score: ', np.mean(db_score),'+-', np.std(db_score))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Clusterability of the learned encodings')
+    parser.add_argument('--data', type=str, default='all')
+    parser.add_argument('--minibatch', action='store_true',
+                        help='Cluster with mini-batch KMeans instead of KMeans, for large test sets')
+    parser.add_argument('--encoder', type=str, default='rnn', help='Encoder of the simulation and HAR data, {rnn, tcn}, or student for the waveform data')
+    parser.add_argument('--sample_size', type=int, default=0, help='Silhouette sample size, 0 for the exact score')
+    parser.add_argument('--max_memory', type=float, default=256, help='Memory budget (MB) for distance blocks')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,104 @@
+"""
+Throughput and quality of the TCN encoder and of GRU encoders with a channel reduction front-end against the GRU
+encoder on the simulation and HAR data
+"""
+
+import os
+import time
+import argparse
+import numpy as np
+import torch
+
+from tnc.models import RnnEncoder, TCNEncoder, TCN_CONFIGS
+from tnc.utils import chopped_windows, linear_probe_accuracy
+
+DATA = {'simulation': ('./data/simulated_data/', 50), 'har': ('./data/HAR_data/', 4)}
+
+
+def _encoders(data, reduced_channels=()):
+    """
+    Encoders to compare, by checkpoint folder suffix: 'r<k>' and 'pca<k>' are GRU encoders with a learned and a PCA
+    front-end to k channels
+    """
+    in_channel = TCN_CONFIGS[data]['in_channel']
+    encoders = {'rnn': RnnEncoder(hidden_size=100, in_channel=in_channel, encoding_size=10),
+                'tcn': TCNEncoder(**TCN_CONFIGS[data])}
+    for k in reduced_channels:
+        for reduction, prefix in [('linear', 'r'), ('pca', 'pca')]:
+            encoders['%s%d' % (prefix, k)] = RnnEncoder(hidden_size=100, in_channel=in_channel, encoding_size=10,
+                                                        reduced_channels=k, reduction=reduction)
+    return encoders
+
+
+def throughput(encoder, in_channel, window_size, batch_size=100, n_batches=10, train=False):
+    """Windows encoded per second on random inputs, with a backward pass when `train`"""
+    x = torch.randn(batch_size, in_channel, window_size)
+    encoder.train(train)
+    with torch.set_grad_enabled(train):
+        encoder(x)
+        start = time.time()
+        for _ in range(n_batches):
+            encodings = encoder(x)
+            if train:
+                encodings.sum().backward()
+    return batch_size * n_batches / (time.time() - start)
+
+
+def probe_accuracy(encoder, data, cv=0, name=None):
+    """
+    Linear probe accuracy (see tnc.utils.linear_probe_accuracy) of the encodings of the chopped test windows, with
+    the checkpoint of ./ckpt/<name>. None when there is no checkpoint for the encoder
+    """
+    if name is None:
+        name = data if isinstance(encoder, RnnEncoder) else '%s_tcn' % data
+    if not os.path.exists('./ckpt/%s/checkpoint_%d.pth.tar' % (name, cv)):
+        return None
+    checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar' % (name, cv), map_location='cpu')
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    encoder.eval()
+    path, window_size = DATA[data]
+    x_window, y_window, recordings = chopped_windows(path, 'test', window_size)
+    with torch.no_grad():
+        encodings = np.concatenate([encoder(batch).numpy() for batch in torch.split(x_window, 500)], 0)
+    return linear_probe_accuracy(encodings, y_window, recordings)
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    for data in args.data.split(','):
+        in_channel = TCN_CONFIGS[data]['in_channel']
+        window_sizes = [DATA[data][1]] + [int(w) for w in args.window_sizes.split(',') if w]
+        reduced_channels = [int(k) for k in args.reduced_channels.split(',') if k and int(k) < in_channel]
+        encoders = _encoders(data, reduced_channels)
+        print('\n%s DATASET (TCN receptive field: %d)' % (data.upper(), encoders['tcn'].receptive_field))
+        for window_size in window_sizes:
+            for mode in ['inference', 'training']:
+                speed = {name: throughput(encoder, in_channel, window_size, args.batch_size, args.n_batches,
+                                          train=mode == 'training') for name, encoder in encoders.items()}
+                print('window %5d %-10s %s' % (window_size, mode, ' \t '.join(
+                    '%s: %9.1f windows/s (x%.2f)' % (name.upper(), speed[name], speed[name] / speed['rnn'])
+                    for name in encoders)))
+        for name, encoder in encoders.items():
+            accuracy = probe_accuracy(encoder, data, args.cv, name=data if name == 'rnn' else '%s_%s' % (data, name))
+            if accuracy is None:
+                options = '--encoder tcn' if name == 'tcn' else '' if name == 'rnn' else '--reduced_channels %d %s' \
+                    % (encoder.reduced_channels, '--reduction pca' if encoder.reduction == 'pca' else '')
+                print(('%s: no checkpoint, train it with python -m tnc.tnc --data %s --train %s'
+                       % (name.upper(), data, options)).rstrip())
+            else:
+                print('%s linear probe accuracy: %.2f' % (name.upper(), 100 * accuracy))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the TCN and GRU encoders')
+    parser.add_argument('--data', type=str, default='simulation', help='Comma separated datasets, {simulation, har}')
+    parser.add_argument('--window_sizes', type=str, default='200,1000', help='Window sizes to time besides the default')
+    parser.add_argument('--batch_size', type=int, default=100)
+    parser.add_argument('--n_batches', type=int, default=10)
+    parser.add_argument('--reduced_channels', type=str, default='32',
+                        help='Comma separated front-end sizes to compare, for inputs with more channels')
+    parser.add_argument('--threads', type=int, default=0, help='Number of CPU threads, 0 for the torch default')
+    parser.add_argument('--cv', type=int, default=0)
+    args = parser.parse_args()
+    main(args)
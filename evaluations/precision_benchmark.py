@@ -0,0 +1,111 @@
+"""
+Speed and numerics of bfloat16 autocast (--precision bf16) against fp32, for TNC training and for encoding, on the
+simulation data by default
+"""
+
+import os
+import copy
+import time
+import pickle
+import random
+import argparse
+import numpy as np
+import torch
+from torch.utils import data
+
+from tnc.tnc import TNCDataset, Discriminator, epoch_run
+from tnc.export import build_encoder, load_trained_encoder, WINDOW_SIZES
+from tnc.precision import encode
+from tnc.utils import chopped_windows, linear_probe_accuracy
+
+DATA_PATHS = {'simulation': './data/simulated_data/', 'har': './data/HAR_data/'}
+
+
+def _seed(seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+
+def training_run(encoder, x, window_size, precision, n_epochs=2, mc_sample_size=20, batch_size=10, seed=0):
+    """
+    Seconds per epoch and losses of TNC training from a copy of `encoder`, and the validation loss of the initial
+    encoder, with the forwards in `precision`. Runs with the same seed sample the same windows in every precision
+    """
+    encoder = copy.deepcopy(encoder)
+    _seed(seed)
+    disc_model = Discriminator(encoder.encoding_size, 'cpu')
+    optimizer = torch.optim.Adam(list(disc_model.parameters()) + list(encoder.parameters()), lr=1e-3)
+    dataset = TNCDataset(x=torch.Tensor(x), mc_sample_size=mc_sample_size, window_size=window_size, augmentation=1)
+    loader = data.DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    _seed(seed)
+    initial_loss, _ = epoch_run(loader, disc_model, encoder, 'cpu', train=False, precision=precision)
+    losses, start = [], time.time()
+    for _ in range(n_epochs):
+        losses.append(epoch_run(loader, disc_model, encoder, 'cpu', optimizer=optimizer, train=True,
+                                precision=precision)[0])
+    return (time.time() - start) / n_epochs, initial_loss, losses
+
+
+def encoding_run(encoder, x, precision, batch_size=500):
+    """Windows encoded per second and the fp32 encodings of x, with the forward in `precision`"""
+    encode(encoder, x[:batch_size], precision, batch_size=batch_size)
+    start = time.time()
+    encodings = encode(encoder, x, precision, batch_size=batch_size)
+    return len(x) / (time.time() - start), encodings
+
+
+def main(args):
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    window_size = WINDOW_SIZES[args.data]
+    try:
+        encoder, path = load_trained_encoder(args.data, args.cv, args.encoder, reduced_channels=args.reduced_channels,
+                                             reduction=args.reduction)
+        print('Encoder of ./ckpt/%s' % path)
+    except FileNotFoundError:
+        encoder = build_encoder(args.data, args.encoder, reduced_channels=args.reduced_channels,
+                                reduction=args.reduction)
+        print('No checkpoint, using a randomly initialized encoder')
+    with open(os.path.join(DATA_PATHS[args.data], 'x_train.pkl'), 'rb') as f:
+        x = pickle.load(f)[:args.n_recordings]
+
+    train_results = {precision: training_run(encoder, x, window_size, precision, args.n_epochs)
+                     for precision in ['fp32', 'bf16']}
+    for precision, (epoch_time, initial_loss, losses) in train_results.items():
+        print('TNC training %s: %7.2f s/epoch \t initial loss %.5f \t training losses %s'
+              % (precision, epoch_time, initial_loss, ' '.join('%.5f' % loss for loss in losses)))
+    print('Training speedup x%.2f \t initial loss difference %.2e'
+          % (train_results['fp32'][0] / train_results['bf16'][0],
+             abs(train_results['bf16'][1] - train_results['fp32'][1])))
+
+    if os.path.exists(os.path.join(DATA_PATHS[args.data], 'x_test.pkl')):
+        x_test, y_test, recordings = chopped_windows(DATA_PATHS[args.data], 'test', window_size)
+    else:
+        x_test, y_test = torch.Tensor(np.concatenate(np.split(x[:, :, :x.shape[-1] // window_size * window_size],
+                                                              x.shape[-1] // window_size, -1), 0)), None
+    encode_results = {precision: encoding_run(encoder, x_test, precision) for precision in ['fp32', 'bf16']}
+    encodings, bf16_encodings = encode_results['fp32'][1], encode_results['bf16'][1]
+    similarity = torch.nn.functional.cosine_similarity(encodings, bf16_encodings, dim=-1)
+    for precision, (speed, precision_encodings) in encode_results.items():
+        accuracy = '' if y_test is None else '\t probe accuracy %.2f' % \
+            (100*linear_probe_accuracy(precision_encodings.numpy(), y_test, recordings))
+        print('Encoding %s: %9.1f windows/s %s' % (precision, speed, accuracy))
+    print('Encoding speedup x%.2f \t cosine similarity to fp32: mean %.4f min %.4f \t max abs error %.2e'
+          % (encode_results['bf16'][0] / encode_results['fp32'][0], similarity.mean().item(), similarity.min().item(),
+             torch.max(torch.abs(bf16_encodings - encodings)).item()))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare bfloat16 autocast with fp32 on CPU')
+    parser.add_argument('--data', type=str, default='simulation', help='One of {simulation, har}')
+    parser.add_argument('--encoder', type=str, default='rnn', help='One of {rnn, tcn, causal}')
+    parser.add_argument('--cv', type=int, default=0)
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Channel reduction front-end of the RnnEncoder, as in tnc.tnc')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    parser.add_argument('--n_recordings', type=int, default=50, help='Training recordings used to time training')
+    parser.add_argument('--n_epochs', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=0, help='Number of CPU threads, 0 for the torch default')
+    args = parser.parse_args()
+    main(args)
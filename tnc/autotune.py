@@ -0,0 +1,225 @@
+"""
+Throughput autotuning of the training loops.
+For a training method, dataset and encoder, a short grid of batch sizes, DataLoader workers and intra-op threads is
+benchmarked, every configuration in its own process so that its peak memory can be measured. The fastest
+configuration (training samples per second) that fits in the memory budget is saved in a per-machine profile, which
+tnc.tnc and the CPC and Triplet Loss baselines load at the start of training. An explicit --batch_size still takes
+precedence over the profile.
+
+    python -m tnc.autotune --method tnc --data simulation --memory_budget 8000
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import pickle
+import resource
+import argparse
+import itertools
+import multiprocessing
+import numpy as np
+import torch
+
+PROFILE_DIR = './ckpt/autotune'
+DATA_PATHS = {'simulation': './data/simulated_data/', 'waveform': './data/waveform_data/processed',
+              'har': './data/HAR_data/'}
+WINDOW_SIZES = {'simulation': 50, 'waveform': 2500, 'har': 4}
+# mc_sample_size and augmentation of the TNC training of every dataset, see tnc.tnc.main
+TNC_SAMPLING = {'simulation': (40, 5), 'waveform': (10, 7), 'har': (20, 5)}
+METHODS = ['tnc', 'cpc', 'triplet']
+
+
+def profile_path():
+    """Profile of this machine, ./ckpt/autotune/<hostname>.json"""
+    return os.path.join(PROFILE_DIR, '%s.json' % socket.gethostname())
+
+
+def profile_key(method, data, encoder_type='rnn', reduced_channels=None, reduction='linear'):
+    """
+    Key of a configuration in the profile, such as tnc/har/rnn. Encoders with a channel reduction front-end get the
+    suffix of their checkpoint folder, e.g. tnc/har/rnn_r32 or tnc/har/rnn_pca32
+    """
+    key = '%s/%s/%s' % (method, data, encoder_type)
+    if reduced_channels is not None:
+        key += '_%s%d' % ('pca' if reduction == 'pca' else 'r', reduced_channels)
+    return key
+
+
+def load_profile(method, data, encoder_type='rnn', reduced_channels=None, reduction='linear'):
+    """Tuned configuration (batch_size, num_workers, threads, ...) of this machine, an empty dict if it was not tuned"""
+    if not os.path.exists(profile_path()):
+        return {}
+    with open(profile_path()) as f:
+        return json.load(f).get(profile_key(method, data, encoder_type, reduced_channels, reduction), {})
+
+
+def dataset_name(path):
+    """Dataset of a checkpoint folder name such as simulation_tcn"""
+    return next((data for data in DATA_PATHS if data in path), path)
+
+
+def apply_profile(method, data, encoder_type='rnn', reduced_channels=None, reduction='linear'):
+    """Load the tuned configuration of this machine and set its number of threads. Returns the configuration"""
+    config = load_profile(method, data, encoder_type, reduced_channels, reduction)
+    if config:
+        torch.set_num_threads(config['threads'])
+        print('Autotuned configuration from %s: batch size %s, %d loader workers, %d threads'
+              % (profile_path(), config['batch_size'], config['num_workers'], config['threads']))
+    return config
+
+
+def save_profile(method, data, encoder_type, config, reduced_channels=None, reduction='linear'):
+    profiles = {}
+    if os.path.exists(profile_path()):
+        with open(profile_path()) as f:
+            profiles = json.load(f)
+    profiles[profile_key(method, data, encoder_type, reduced_channels, reduction)] = config
+    if not os.path.exists(PROFILE_DIR):
+        os.makedirs(PROFILE_DIR)
+    with open(profile_path(), 'w') as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+
+
+def _training_data(data):
+    with open(os.path.join(DATA_PATHS[data], 'x_train.pkl'), 'rb') as f:
+        x = np.asarray(pickle.load(f), dtype=np.float32)
+    if data == 'waveform':
+        # Same 5 way split of the recordings as the training scripts
+        T = x.shape[-1]
+        x = np.concatenate(np.split(x[:, :, :T // 5 * 5], 5, -1), 0)
+    return x
+
+
+def _subset(x, n):
+    """n recordings of x, cycling through x when it has less"""
+    return x[np.arange(n) % len(x)]
+
+
+def _run(method, data, encoder_type, batch_size, num_workers, n_batches, neighborhood, reduced_channels=None,
+         reduction='linear'):
+    """Number of training samples processed and the time of n_batches training steps of `method`"""
+    from torch.utils import data as torch_data
+    from tnc.export import build_encoder
+    x = _training_data(data)
+    window_size = WINDOW_SIZES[data]
+    encoder = build_encoder(data, encoder_type, reduced_channels=reduced_channels, reduction=reduction)
+    if method == 'tnc':
+        from tnc.tnc import TNCDataset, Discriminator, epoch_run
+        mc_sample_size, augmentation = TNC_SAMPLING[data]
+        n_samples = batch_size * n_batches
+        x = torch.Tensor(_subset(x, -(-n_samples // augmentation)))
+        dataset = TNCDataset(x=x, mc_sample_size=mc_sample_size, window_size=window_size, augmentation=augmentation,
+                             adf=neighborhood == 'adf')
+        loader = torch_data.DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers)
+        disc_model = Discriminator(encoder.encoding_size, 'cpu')
+        optimizer = torch.optim.Adam(list(disc_model.parameters()) + list(encoder.parameters()), lr=1e-4)
+        # The DataLoader is created every epoch in tnc.tnc.learn_encoder, so the worker start up is timed as well
+        start = time.time()
+        epoch_run(loader, disc_model, encoder, 'cpu', w=0.05, optimizer=optimizer, train=True)
+        return len(dataset), time.time() - start
+    elif method == 'cpc':
+        from baselines.cpc import epoch_run
+        ds_estimator = torch.nn.Linear(encoder.encoding_size, encoder.encoding_size)
+        auto_regressor = torch.nn.GRU(input_size=encoder.encoding_size, hidden_size=encoder.encoding_size,
+                                      batch_first=True)
+        params = list(ds_estimator.parameters()) + list(encoder.parameters()) + list(auto_regressor.parameters())
+        optimizer = torch.optim.Adam(params, lr=1e-4)
+        x = _subset(x, n_batches)
+        start = time.time()
+        epoch_run(x, ds_estimator, auto_regressor, encoder, 'cpu', window_size, optimizer=optimizer, train=True)
+        return len(x), time.time() - start
+    elif method == 'triplet':
+        from baselines.triplet_loss import epoch_run
+        optimizer = torch.optim.Adam(encoder.parameters(), lr=1e-4)
+        x = _subset(x, batch_size * n_batches)
+        start = time.time()
+        epoch_run(x, encoder, 'cpu', window_size, optimizer=optimizer, train=True, batch_size=batch_size)
+        return len(x), time.time() - start
+    raise ValueError('Method not defined, must be one of the following {tnc, cpc, triplet}')
+
+
+def _trial(queue, method, data, encoder_type, config, n_batches, neighborhood, reduced_channels, reduction):
+    torch.set_num_threads(config['threads'])
+    try:
+        n_samples, duration = _run(method, data, encoder_type, config['batch_size'], config['num_workers'], n_batches,
+                                   neighborhood, reduced_channels, reduction)
+        # ru_maxrss is in kB on Linux: peak of the trial process plus its largest loader worker
+        memory = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+                  resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024.
+        queue.put(dict(config, samples_per_sec=n_samples / duration, memory=memory))
+    except Exception as e:
+        queue.put(dict(config, error=repr(e)))
+
+
+def grid(method, batch_sizes, workers, threads):
+    """Configurations to benchmark, CPC trains on one recording at a time and Triplet Loss without loader workers"""
+    if method == 'cpc':
+        batch_sizes, workers = [None], [0]
+    elif method == 'triplet':
+        workers = [0]
+    return [{'batch_size': b, 'num_workers': n, 'threads': t}
+            for b, n, t in itertools.product(batch_sizes, workers, threads)]
+
+
+def autotune(method, data, encoder_type='rnn', memory_budget=None, batch_sizes=(5, 10, 20, 40), workers=(0, 1, 3),
+             threads=(1, 2, 4), n_batches=10, neighborhood='adf', reduced_channels=None, reduction='linear',
+             verbose=True):
+    """
+    Benchmark the configurations of grid() and return the results, and the fastest configuration whose peak memory
+    (MB) is within `memory_budget`
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for config in grid(method, batch_sizes, workers, threads):
+        queue = context.Queue()
+        process = context.Process(target=_trial, args=(queue, method, data, encoder_type, config, n_batches,
+                                                       neighborhood, reduced_channels, reduction))
+        process.start()
+        process.join()
+        # A trial killed for running out of memory exits without a result
+        result = queue.get() if process.exitcode == 0 else dict(config, error='exit code %d' % process.exitcode)
+        results.append(result)
+        if verbose:
+            if 'error' in result:
+                print('batch size %-4s workers %d threads %2d: failed with %s'
+                      % (result['batch_size'], result['num_workers'], result['threads'], result['error']))
+            else:
+                print('batch size %-4s workers %d threads %2d: %9.1f samples/s \t peak memory %7.0f MB'
+                      % (result['batch_size'], result['num_workers'], result['threads'], result['samples_per_sec'],
+                         result['memory']))
+    candidates = [r for r in results if 'error' not in r and (memory_budget is None or r['memory'] <= memory_budget)]
+    if not candidates:
+        raise ValueError('No configuration fits in the memory budget of %s MB' % memory_budget)
+    return max(candidates, key=lambda r: r['samples_per_sec']), results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Tune the batch size, loader workers and threads of training')
+    parser.add_argument('--method', type=str, default='tnc', help='One of {tnc, cpc, triplet}')
+    parser.add_argument('--data', type=str, default='simulation')
+    parser.add_argument('--encoder', type=str, default='rnn', help='One of {rnn, tcn, causal}')
+    parser.add_argument('--memory_budget', type=float, default=None, help='Peak memory budget in MB')
+    parser.add_argument('--batch_sizes', type=str, default='5,10,20,40')
+    parser.add_argument('--workers', type=str, default='0,1,3')
+    parser.add_argument('--threads', type=str, default=','.join(str(2**i) for i in range(
+        int(np.log2(os.cpu_count())) + 1)))
+    parser.add_argument('--n_batches', type=int, default=10, help='Training steps timed per configuration')
+    parser.add_argument('--neighborhood', type=str, default='adf', help='Neighborhood of the TNC samples, {adf, fixed}')
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Channel reduction front-end of the RnnEncoder, as in tnc.tnc')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    args = parser.parse_args()
+    if args.method not in METHODS:
+        sys.exit('Method not defined, must be one of the following {tnc, cpc, triplet}')
+
+    best, results = autotune(args.method, args.data, args.encoder, args.memory_budget,
+                             [int(b) for b in args.batch_sizes.split(',')], [int(n) for n in args.workers.split(',')],
+                             [int(t) for t in args.threads.split(',')], args.n_batches, args.neighborhood,
+                             args.reduced_channels, args.reduction)
+    save_profile(args.method, args.data, args.encoder,
+                 dict(best, memory_budget=args.memory_budget, cpu_count=os.cpu_count()), args.reduced_channels,
+                 args.reduction)
+    print('Best configuration: batch size %s, %d workers, %d threads, %.1f samples/s, saved to %s'
+          % (best['batch_size'], best['num_workers'], best['threads'], best['samples_per_sec'], profile_path()))
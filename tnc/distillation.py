@@ -0,0 +1,137 @@
+"""
+Knowledge distillation of a trained waveform encoder into a StudentWFEncoder.
+The student is trained to reproduce the encodings of the teacher on unlabeled windows drawn with the TNC sampling
+pipeline: the anchor, neighbor and non-neighbor windows of every TNCDataset sample, so that the student is fit on the
+windows the teacher was trained on. The student checkpoint is saved in ./ckpt/waveform_student, and the evaluation
+scripts load it with --encoder student.
+
+    python -m tnc.distillation --train --cv 1
+    python -m tnc.distillation --cv 1
+"""
+
+import os
+import time
+import pickle
+import random
+import argparse
+import numpy as np
+import torch
+from torch.utils import data
+
+from tnc.tnc import TNCDataset
+from tnc.models import StudentWFEncoder
+from tnc.export import load_trained_encoder
+from tnc.utils import chopped_windows, linear_probe_accuracy
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def distillation_loss(encodings, teacher_encodings):
+    """Mean squared error to the teacher encodings, plus one minus their cosine similarity"""
+    cosine = torch.nn.functional.cosine_similarity(encodings, teacher_encodings, dim=-1)
+    return torch.nn.functional.mse_loss(encodings, teacher_encodings) + torch.mean(1 - cosine), torch.mean(cosine)
+
+
+def epoch_run(loader, teacher, student, device, optimizer=None, train=True):
+    student.train(train)
+    teacher.eval()
+    epoch_loss, epoch_cosine, batch_count = 0, 0, 0
+    for x_t, x_p, x_n, _ in loader:
+        windows = torch.cat([x_t.unsqueeze(1), x_p, x_n], 1).reshape((-1,) + x_t.shape[1:]).float().to(device)
+        with torch.no_grad():
+            teacher_encodings = teacher(windows)
+        with torch.set_grad_enabled(train):
+            loss, cosine = distillation_loss(student(windows), teacher_encodings)
+        if train:
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+        epoch_loss += loss.item()
+        epoch_cosine += cosine.item()
+        batch_count += 1
+    return epoch_loss/batch_count, epoch_cosine/batch_count
+
+
+def distill_encoder(x, teacher, window_size, lr=0.001, decay=1e-5, n_epochs=50, mc_sample_size=2, batch_size=5,
+                    augmentation=7, epsilon=3, path='waveform_student', cv=0, device='cpu'):
+    """
+    Train a StudentWFEncoder on the recordings x to match the encodings of `teacher`. Windows are drawn by TNCDataset
+    with a fixed neighborhood range `epsilon`, the student with the lowest validation loss is saved
+    """
+    student = StudentWFEncoder(encoding_size=teacher.encoding_size).to(device)
+    teacher = teacher.to(device)
+    optimizer = torch.optim.Adam(student.parameters(), lr=lr, weight_decay=decay)
+    if not os.path.exists('./ckpt/%s' % path):
+        os.mkdir('./ckpt/%s' % path)
+    inds = list(range(len(x)))
+    random.shuffle(inds)
+    x = torch.Tensor(x[inds])
+    n_train = int(0.8*len(x))
+    trainset = TNCDataset(x=x[:n_train], mc_sample_size=mc_sample_size, window_size=window_size,
+                          augmentation=augmentation, epsilon=epsilon)
+    validset = TNCDataset(x=x[n_train:], mc_sample_size=mc_sample_size, window_size=window_size,
+                          augmentation=augmentation, epsilon=epsilon)
+    train_loader = data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=3)
+    valid_loader = data.DataLoader(validset, batch_size=batch_size, shuffle=True)
+    best_loss = np.inf
+    for epoch in range(n_epochs):
+        epoch_loss, epoch_cosine = epoch_run(train_loader, teacher, student, device, optimizer=optimizer, train=True)
+        test_loss, test_cosine = epoch_run(valid_loader, teacher, student, device, train=False)
+        if epoch % 5 == 0:
+            print('(cv:%s)Epoch %d =====> Training Loss: %.5f \t Training Cosine: %.4f \t Test Loss: %.5f \t Test Cosine: %.4f'
+                  % (cv, epoch, epoch_loss, epoch_cosine, test_loss, test_cosine))
+        if test_loss < best_loss:
+            best_loss = test_loss
+            state = {
+                'epoch': epoch,
+                'encoder_state_dict': student.state_dict(),
+                'channels': student.channels,
+                'teacher_cosine': test_cosine
+            }
+            torch.save(state, './ckpt/%s/checkpoint_%d.pth.tar' % (path, cv))
+    return student
+
+
+def compare(teacher, student, x, labels, recordings, batch_size=50):
+    """Throughput (windows/s), probe accuracy and similarity to the teacher of the teacher and student encodings"""
+    results = {}
+    for name, encoder in [('teacher', teacher), ('student', student)]:
+        encoder.eval()
+        with torch.no_grad():
+            encoder(x[:batch_size].to(device))
+            start = time.time()
+            encodings = torch.cat([encoder(batch.to(device)).cpu() for batch in torch.split(x, batch_size)], 0)
+        results[name] = {'throughput': len(x) / (time.time() - start), 'encodings': encodings,
+                         'accuracy': linear_probe_accuracy(encodings.numpy(), labels, recordings)}
+    results['cosine'] = torch.nn.functional.cosine_similarity(results['teacher']['encodings'],
+                                                              results['student']['encodings'], dim=-1).mean().item()
+    return results
+
+
+if __name__ == '__main__':
+    random.seed(1234)
+    parser = argparse.ArgumentParser(description='Distill a waveform TNC encoder into a compact student')
+    parser.add_argument('--cv', type=int, default=1, help='Number of folds to train, or the fold to report on')
+    parser.add_argument('--train', action='store_true')
+    parser.add_argument('--teacher', type=str, default='waveform', help='Checkpoint folder of the teacher in ./ckpt')
+    parser.add_argument('--n_epochs', type=int, default=50)
+    args = parser.parse_args()
+    path, window_size = './data/waveform_data/processed', 2500
+    if args.train:
+        with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
+            x = pickle.load(f)
+        T = x.shape[-1]
+        x_window = np.concatenate(np.split(x[:, :, :T // 5 * 5], 5, -1), 0)
+        for cv in range(args.cv):
+            teacher, _ = load_trained_encoder('waveform', cv, path=args.teacher, device=device)
+            distill_encoder(x_window, teacher, window_size, n_epochs=args.n_epochs, cv=cv, device=device)
+    else:
+        teacher, _ = load_trained_encoder('waveform', args.cv, path=args.teacher, device=device)
+        student, _ = load_trained_encoder('waveform', args.cv, encoder_type='student', device=device)
+        x_test, y_test, recordings = chopped_windows(path, 'test', window_size)
+        results = compare(teacher, student, x_test, y_test, recordings)
+        for name in ['teacher', 'student']:
+            print('%s: %9.1f windows/s \t probe accuracy %.2f'
+                  % (name, results[name]['throughput'], 100*results[name]['accuracy']))
+        print('Student speedup x%.2f \t cosine similarity to the teacher %.4f'
+              % (results['student']['throughput'] / results['teacher']['throughput'], results['cosine']))
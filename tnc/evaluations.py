@@ -7,20 +7,31 @@ import pickle
 import pandas as pd
 import random
 
-from tnc.models import RnnEncoder, StateClassifier, E2EStateClassifier, WFEncoder
+from tnc.models import RnnEncoder, StateClassifier, E2EStateClassifier, WFEncoder, TCNEncoder, TCN_CONFIGS, \
+    StreamingRnnEncoder
 from tnc.utils import create_simulated_dataset
+from tnc.labels import load_states
 
 from sklearn.metrics import roc_auc_score
 from sklearn.metrics import confusion_matrix
 
 
 class ClassificationPerformanceExperiment():
-    def __init__(self, n_states=4, encoding_size=10, path='simulation', cv=0, hidden_size=100, in_channel=3, window_size=50):
-        # Load or train a TNC encoder
+    def __init__(self, n_states=4, encoding_size=10, path='simulation', cv=0, hidden_size=100, in_channel=3, window_size=50,
+                 encoder_type='rnn', reduced_channels=None, reduction='linear', causal=False):
+        # Load or train a TNC encoder, built like the encoder it was trained with (see tnc.tnc._sequence_encoder)
         if not os.path.exists("./ckpt/%s/checkpoint_%d.pth.tar"%(path,cv)):
             raise ValueError("No checkpoint for an encoder")
         checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
-        self.encoder = RnnEncoder(hidden_size=hidden_size, in_channel=in_channel, encoding_size=encoding_size)
+        if encoder_type == 'tcn':
+            config = TCN_CONFIGS['har' if 'har' in path else 'simulation']
+            self.encoder = TCNEncoder(in_channel=in_channel, encoding_size=encoding_size,
+                                      kernel_size=config['kernel_size'], n_levels=config['n_levels'])
+        elif causal:
+            self.encoder = StreamingRnnEncoder(hidden_size=hidden_size, in_channel=in_channel, encoding_size=encoding_size)
+        else:
+            self.encoder = RnnEncoder(hidden_size=hidden_size, in_channel=in_channel, encoding_size=encoding_size,
+                                      reduced_channels=reduced_channels, reduction=reduction)
         self.encoder.load_state_dict(checkpoint['encoder_state_dict'])
         self.classifier = StateClassifier(input_size=encoding_size, output_size=n_states)
 
@@ -213,8 +224,7 @@ class WFClassificationExperiment(ClassificationPerformanceExperiment):
         wf_datapath = './data/waveform_data/processed'
         with open(os.path.join(wf_datapath, 'x_train.pkl'), 'rb') as f:
             x = pickle.load(f)
-        with open(os.path.join(wf_datapath, 'state_train.pkl'), 'rb') as f:
-            y = pickle.load(f)
+        y = load_states(wf_datapath, 'train')
 
         T = x.shape[-1]
         x_window = np.split(x[:, :, :window_size * (T // window_size)],(T//window_size), -1)
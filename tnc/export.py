@@ -0,0 +1,125 @@
+"""
+Export trained encoders to frozen TorchScript artifacts for inference.
+The encoder of a checkpoint is traced on a batch of windows, frozen and optimized for inference on a fixed device and
+dtype. The artifact is loaded with tnc.inference.load_encoder, which only needs torch.
+
+    python -m tnc.export --data simulation --cv 0 --benchmark
+"""
+
+import os
+import json
+import time
+import argparse
+import torch
+
+from tnc.models import RnnEncoder, WFEncoder, StudentWFEncoder, StreamingRnnEncoder, TCNEncoder, TCN_CONFIGS
+from tnc.inference import load_encoder
+from tnc.tnc import _reduction_suffix
+
+WINDOW_SIZES = {'simulation': 50, 'waveform': 2500, 'har': 4}
+IN_CHANNELS = {'simulation': 3, 'waveform': 2, 'har': 561}
+
+
+def build_encoder(data, encoder_type='rnn', device='cpu', reduced_channels=None, reduction='linear'):
+    """
+    Encoder architecture trained by tnc.tnc for a dataset, `encoder_type` is one of {rnn, tcn, causal} for the
+    simulation and HAR data, and `student` for the distilled waveform encoder. `reduced_channels` adds the channel
+    reduction front-end to the RnnEncoder
+    """
+    if data == 'waveform':
+        return (StudentWFEncoder if encoder_type == 'student' else WFEncoder)(encoding_size=64).to(device)
+    if encoder_type == 'tcn':
+        return TCNEncoder(device=device, **TCN_CONFIGS[data])
+    if encoder_type == 'causal':
+        return StreamingRnnEncoder(hidden_size=100, in_channel=TCN_CONFIGS[data]['in_channel'], encoding_size=10,
+                                   device=device)
+    return RnnEncoder(hidden_size=100, in_channel=TCN_CONFIGS[data]['in_channel'], encoding_size=10, device=device,
+                      reduced_channels=reduced_channels, reduction=reduction)
+
+
+def export_encoder(encoder, example, path, metadata=None):
+    """Trace `encoder` on the example batch, freeze it and save it with its metadata. Returns the frozen module"""
+    encoder.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(encoder, example)
+    frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    metadata = dict(metadata or {}, device=str(example.device), dtype=str(example.dtype).replace('torch.', ''),
+                    in_channel=example.shape[1], window_size=example.shape[-1])
+    torch.jit.save(frozen, path, _extra_files={'metadata.json': json.dumps(metadata)})
+    return frozen
+
+
+def load_trained_encoder(data, cv=0, encoder_type='rnn', path=None, device='cpu', reduced_channels=None,
+                         reduction='linear'):
+    """
+    Encoder of ./ckpt/<path>/checkpoint_<cv>.pth.tar, where path defaults to the checkpoint folder of tnc.tnc for the
+    dataset, encoder type and channel reduction. Returns the encoder in eval mode and the checkpoint folder
+    """
+    if path is None:
+        path = data if encoder_type == 'rnn' else '%s_%s' % (data, encoder_type)
+        path += _reduction_suffix(reduced_channels, reduction)
+    encoder = build_encoder(data, encoder_type, device, reduced_channels, reduction)
+    checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar' % (path, cv), map_location=device)
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    encoder.eval()
+    return encoder, path
+
+
+def export_checkpoint(data, cv=0, encoder_type='rnn', path=None, out=None, device='cpu', dtype='float32',
+                      batch_size=10, reduced_channels=None, reduction='linear'):
+    """Export a trained encoder (see load_trained_encoder) to `out`, ./ckpt/<path>/encoder_<cv>_<dtype>.pt by default"""
+    encoder, path = load_trained_encoder(data, cv, encoder_type, path, device, reduced_channels, reduction)
+    out = out or './ckpt/%s/encoder_%d_%s.pt' % (path, cv, dtype)
+    encoder = encoder.to(dtype=getattr(torch, dtype))
+    example = torch.randn(batch_size, IN_CHANNELS[data], WINDOW_SIZES[data], device=device, dtype=getattr(torch, dtype))
+    export_encoder(encoder, example, out, {'data': data, 'encoder_type': encoder_type, 'checkpoint': path, 'cv': cv,
+                                           'encoding_size': encoder.encoding_size})
+    return encoder, out
+
+
+def _time(fn, x, n_runs):
+    with torch.no_grad():
+        fn(x)
+        start = time.time()
+        for _ in range(n_runs):
+            fn(x)
+    return (time.time() - start) / n_runs
+
+
+def benchmark(eager, exported, in_channel, window_size, batch_size=256, n_runs=20, dtype='float32'):
+    """
+    Single window latency (ms) and throughput (windows/s) of the eager and the exported encoder on CPU, on inputs of
+    `dtype`, the dtype the encoder was exported in
+    """
+    eager.eval()
+    dtype = getattr(torch, dtype)
+    results = {}
+    for name, fn in [('eager', eager), ('scripted', exported)]:
+        latency = _time(fn, torch.randn(1, in_channel, window_size, dtype=dtype), n_runs)
+        batch_time = _time(fn, torch.randn(batch_size, in_channel, window_size, dtype=dtype), max(1, n_runs // 4))
+        results[name] = (1000*latency, batch_size/batch_time)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export an encoder checkpoint to TorchScript')
+    parser.add_argument('--data', type=str, default='simulation')
+    parser.add_argument('--cv', type=int, default=0)
+    parser.add_argument('--encoder', type=str, default='rnn', help='One of {rnn, tcn, causal, student}')
+    parser.add_argument('--path', type=str, default=None, help='Checkpoint folder in ./ckpt, if not the default one')
+    parser.add_argument('--out', type=str, default=None)
+    parser.add_argument('--dtype', type=str, default='float32')
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Channel reduction front-end of the RnnEncoder, as in tnc.tnc')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    parser.add_argument('--benchmark', action='store_true', help='Compare the latency and throughput with eager mode')
+    args = parser.parse_args()
+    encoder, out = export_checkpoint(args.data, args.cv, args.encoder, args.path, args.out, dtype=args.dtype,
+                                     reduced_channels=args.reduced_channels, reduction=args.reduction)
+    print('Exported to %s (%.1f MB)' % (out, os.path.getsize(out) / 2.**20))
+    exported = load_encoder(out)
+    if args.benchmark:
+        # The eager encoder is timed in the exported dtype, export_checkpoint returns it cast to it
+        results = benchmark(encoder, exported, IN_CHANNELS[args.data], WINDOW_SIZES[args.data], dtype=args.dtype)
+        for name, (latency, throughput) in results.items():
+            print('%-8s latency: %8.3f ms \t throughput: %9.1f windows/s' % (name, latency, throughput))
@@ -0,0 +1,246 @@
+"""
+Approximate nearest neighbour index over window encodings, for retrieving past segments similar to a query window.
+The index combines an inverted file (IVF) coarse quantizer with product quantization (PQ) of the residuals, and
+stores the compressed codes in .npy files that are memory-mapped at search time.
+"""
+
+import os
+import json
+import time
+import argparse
+import numpy as np
+
+from tnc.utils import knn_search
+
+
+def _kmeans(x, n_clusters, n_iter=20, random_state=0):
+    rng = np.random.RandomState(random_state)
+    centroids = x[rng.choice(len(x), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        _, assign = knn_search(x, centroids, 1)
+        assign = assign[:, 0]
+        counts = np.bincount(assign, minlength=n_clusters)
+        for d in range(x.shape[-1]):
+            centroids[:, d] = np.bincount(assign, weights=x[:, d], minlength=n_clusters)
+        centroids[counts > 0] /= counts[counts > 0, np.newaxis]
+        # Re-seed empty clusters with random points
+        empty = np.where(counts == 0)[0]
+        centroids[empty] = x[rng.choice(len(x), len(empty), replace=False)]
+    return centroids
+
+
+class IVFPQIndex():
+    """
+    IVF-PQ index for euclidean search over encodings.
+
+    Every vector is assigned to its closest of `n_lists` coarse centroids, and the residual to that centroid is
+    compressed to `n_subvectors` bytes by product quantization. Search scans only the `n_probe` lists closest to the
+    query, so n_probe is the recall/latency knob. Codes of each list are stored contiguously; vectors added after the
+    last merge are kept in a small pending buffer that is scanned alongside the lists until `merge` is called.
+    """
+    def __init__(self, n_lists=256, n_subvectors=8, n_bits=8, n_probe=8, merge_threshold=100000):
+        if n_bits > 8:
+            raise ValueError('Product quantization codes are stored as bytes, n_bits must be at most 8')
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.n_probe = n_probe
+        self.merge_threshold = merge_threshold
+        self.dim = None
+        self.centroids = None
+        self.codebooks = None
+        self._reset_storage()
+
+    def _reset_storage(self):
+        self.codes = np.zeros((0, self.n_subvectors), dtype=np.uint8)
+        self.ids = np.zeros(0, dtype=np.int64)
+        self.norm_terms = np.zeros(0, dtype=np.float32)
+        self.list_offsets = np.zeros(self.n_lists + 1, dtype=np.int64)
+        self._pending = {'codes': self.codes, 'ids': self.ids, 'norm_terms': self.norm_terms,
+                         'lists': np.zeros(0, dtype=np.int64)}
+
+    def __len__(self):
+        return len(self.ids) + len(self._pending['ids'])
+
+    def _pad(self, x):
+        x = np.asarray(x, dtype=np.float32).reshape((len(x), -1))
+        padded_dim = self.codebooks.shape[0]*self.codebooks.shape[-1] if self.codebooks is not None else \
+            int(np.ceil(x.shape[-1] / self.n_subvectors))*self.n_subvectors
+        if padded_dim == x.shape[-1]:
+            return x
+        return np.concatenate([x, np.zeros((len(x), padded_dim - x.shape[-1]), dtype=np.float32)], -1)
+
+    def train(self, x, n_iter=20, sample_size=100000, random_state=0):
+        """Learn the coarse centroids and the PQ codebooks from (a sample of) the encodings x"""
+        rng = np.random.RandomState(random_state)
+        if len(x) > sample_size:
+            x = x[np.sort(rng.choice(len(x), sample_size, replace=False))]
+        self.dim = x.shape[-1]
+        self.codebooks = None
+        x = self._pad(x)
+        self.n_lists = min(self.n_lists, len(x))
+        self.centroids = _kmeans(x, self.n_lists, n_iter=n_iter, random_state=random_state)
+        _, assign = knn_search(x, self.centroids, 1)
+        residuals = (x - self.centroids[assign[:, 0]]).reshape((len(x), self.n_subvectors, -1))
+        n_codes = min(2**self.n_bits, len(x))
+        self.codebooks = np.stack([_kmeans(np.ascontiguousarray(residuals[:, m]), n_codes, n_iter=n_iter,
+                                           random_state=random_state + m) for m in range(self.n_subvectors)])
+        self._reset_storage()
+        return self
+
+    def _encode(self, x):
+        x = self._pad(x)
+        _, lists = knn_search(x, self.centroids, 1)
+        lists = lists[:, 0]
+        residuals = (x - self.centroids[lists]).reshape((len(x), self.n_subvectors, -1))
+        codes = np.stack([knn_search(np.ascontiguousarray(residuals[:, m]), self.codebooks[m], 1)[1][:, 0]
+                          for m in range(self.n_subvectors)], -1).astype(np.uint8)
+        # ||q - c - r||^2 = ||q - c||^2 + (||r||^2 + 2<c, r>) - 2<q, r>, the middle term is stored per vector
+        reconstructed = self.codebooks[np.arange(self.n_subvectors), codes].reshape((len(x), -1))
+        norm_terms = np.sum(reconstructed*(reconstructed + 2*self.centroids[lists]), -1).astype(np.float32)
+        return lists, codes, norm_terms
+
+    def add(self, x, ids=None):
+        """Add encodings to the index, with sequential ids by default"""
+        if self.centroids is None:
+            raise ValueError('The index has to be trained before adding vectors')
+        if ids is None:
+            ids = np.arange(len(self), len(self) + len(x))
+        lists, codes, norm_terms = self._encode(x)
+        for key, value in zip(['lists', 'codes', 'norm_terms', 'ids'], [lists, codes, norm_terms, ids]):
+            self._pending[key] = np.concatenate([self._pending[key], np.asarray(value, dtype=self._pending[key].dtype)])
+        if len(self._pending['ids']) > self.merge_threshold:
+            self.merge()
+        return self
+
+    def merge(self):
+        """Move the pending vectors into the contiguous per-list storage"""
+        if len(self._pending['ids']) == 0:
+            return
+        lists = np.concatenate([np.repeat(np.arange(self.n_lists), np.diff(self.list_offsets)), self._pending['lists']])
+        order = np.argsort(lists, kind='stable')
+        self.codes = np.concatenate([self.codes, self._pending['codes']])[order]
+        self.ids = np.concatenate([self.ids, self._pending['ids']])[order]
+        self.norm_terms = np.concatenate([self.norm_terms, self._pending['norm_terms']])[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(lists, minlength=self.n_lists))])
+        self._pending = {'codes': self._pending['codes'][:0], 'ids': self._pending['ids'][:0],
+                         'norm_terms': self._pending['norm_terms'][:0], 'lists': self._pending['lists'][:0]}
+
+    def search(self, queries, k=10, n_probe=None):
+        """Approximate k nearest neighbours of each query. Returns (distances, ids), padded with (inf, -1)"""
+        n_probe = min(self.n_probe if n_probe is None else n_probe, self.n_lists)
+        q = self._pad(queries)
+        coarse_dist, probes = knn_search(q, self.centroids, n_probe)
+        coarse_dist = coarse_dist**2
+        # Inner product of each query sub-vector with every codeword, shared by all the probed lists
+        tables = np.einsum('qmd,mkd->qmk', q.reshape((len(q), self.n_subvectors, -1)), self.codebooks)
+        sub_ind = np.arange(self.n_subvectors)[np.newaxis, :]
+        distances = np.full((len(q), k), np.inf, dtype=np.float32)
+        ids = np.full((len(q), k), -1, dtype=np.int64)
+        list_dist = np.full(self.n_lists, np.nan, dtype=np.float32)
+        for i in range(len(q)):
+            list_dist[probes[i]] = coarse_dist[i]
+            sizes = np.diff(self.list_offsets)[probes[i]]
+            codes = [self.codes[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probes[i]]
+            norm_terms = [self.norm_terms[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probes[i]]
+            cand_ids = [self.ids[self.list_offsets[l]:self.list_offsets[l + 1]] for l in probes[i]]
+            base = [np.repeat(coarse_dist[i], sizes)]
+            if len(self._pending['ids']):
+                pending = np.isin(self._pending['lists'], probes[i])
+                codes.append(self._pending['codes'][pending])
+                norm_terms.append(self._pending['norm_terms'][pending])
+                cand_ids.append(self._pending['ids'][pending])
+                base.append(list_dist[self._pending['lists'][pending]])
+            list_dist[probes[i]] = np.nan
+            codes = np.concatenate(codes)
+            if len(codes) == 0:
+                continue
+            dist = np.concatenate(base) + np.concatenate(norm_terms) - 2*tables[i][sub_ind, codes].sum(-1)
+            k_i = min(k, len(dist))
+            top = np.argpartition(dist, k_i - 1)[:k_i]
+            top = top[np.argsort(dist[top])]
+            distances[i, :k_i] = np.sqrt(np.maximum(dist[top], 0))
+            ids[i, :k_i] = np.concatenate(cand_ids)[top]
+        return distances, ids
+
+    def save(self, path):
+        """Write the index to a directory of .npy files. Files are replaced atomically, so an index that is
+        memory-mapped from the same directory can be saved in place"""
+        self.merge()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        arrays = {'centroids': self.centroids, 'codebooks': self.codebooks, 'codes': self.codes, 'ids': self.ids,
+                  'norm_terms': self.norm_terms, 'list_offsets': self.list_offsets}
+        for name, array in arrays.items():
+            with open(os.path.join(path, '%s.npy.tmp' % name), 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(os.path.join(path, '%s.npy.tmp' % name), os.path.join(path, '%s.npy' % name))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'n_lists': self.n_lists, 'n_subvectors': self.n_subvectors, 'n_bits': self.n_bits,
+                       'n_probe': self.n_probe, 'dim': self.dim, 'merge_threshold': self.merge_threshold}, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """Load an index saved with `save`. With mmap, the codes stay on disk and only probed lists are read"""
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        index = cls(n_lists=meta['n_lists'], n_subvectors=meta['n_subvectors'], n_bits=meta['n_bits'],
+                    n_probe=meta['n_probe'], merge_threshold=meta.get('merge_threshold', 100000))
+        index.dim = meta['dim']
+        mmap_mode = 'r' if mmap else None
+        index.centroids = np.load(os.path.join(path, 'centroids.npy'))
+        index.codebooks = np.load(os.path.join(path, 'codebooks.npy'))
+        index.list_offsets = np.load(os.path.join(path, 'list_offsets.npy'))
+        index.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode=mmap_mode)
+        index.ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode=mmap_mode)
+        index.norm_terms = np.load(os.path.join(path, 'norm_terms.npy'), mmap_mode=mmap_mode)
+        return index
+
+
+def build_index(embedding_path, index_path, n_lists=256, n_subvectors=8, n_probe=8, chunk_size=100000):
+    """Build an index from an (N, encoding_size) .npy file of encodings, reading it in chunks"""
+    x = np.load(embedding_path, mmap_mode='r')
+    index = IVFPQIndex(n_lists=n_lists, n_subvectors=n_subvectors, n_probe=n_probe, merge_threshold=len(x))
+    index.train(x)
+    for start in range(0, len(x), chunk_size):
+        index.add(np.asarray(x[start:start + chunk_size]))
+    index.save(index_path)
+    return index
+
+
+def benchmark(index, x, queries, k=10, n_probes=(1, 2, 4, 8, 16, 32)):
+    """Recall@k of the index against exact search over x, and search latency, for different n_probe values"""
+    _, exact = knn_search(queries, x, k)
+    results = []
+    for n_probe in n_probes:
+        start = time.time()
+        _, approx = index.search(queries, k=k, n_probe=n_probe)
+        latency = (time.time() - start) / len(queries)
+        recall = np.mean([len(np.intersect1d(a, e)) / k for a, e in zip(approx, exact)])
+        results.append((n_probe, recall, latency))
+        print('n_probe: %d \t Recall@%d: %.4f \t Latency: %.3f ms/query' % (n_probe, k, recall, 1000*latency))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and benchmark an IVF-PQ index over window encodings')
+    parser.add_argument('--embeddings', type=str, required=True, help='.npy file of shape (n_windows, encoding_size)')
+    parser.add_argument('--index', type=str, default='./ckpt/index')
+    parser.add_argument('--n_lists', type=int, default=256)
+    parser.add_argument('--n_subvectors', type=int, default=8)
+    parser.add_argument('--n_probe', type=int, default=8)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--benchmark', action='store_true')
+    parser.add_argument('--n_queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    if os.path.exists(os.path.join(args.index, 'meta.json')):
+        index = IVFPQIndex.load(args.index)
+    else:
+        index = build_index(args.embeddings, args.index, n_lists=args.n_lists, n_subvectors=args.n_subvectors,
+                            n_probe=args.n_probe)
+    print('Index with %d vectors in %d lists' % (len(index), index.n_lists))
+    if args.benchmark:
+        x = np.load(args.embeddings, mmap_mode='r')
+        queries = np.asarray(x[np.sort(np.random.choice(len(x), min(args.n_queries, len(x)), replace=False))])
+        benchmark(index, x, queries, k=args.k)
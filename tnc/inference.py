@@ -0,0 +1,38 @@
+"""
+Inference with exported encoders (see tnc/export.py).
+Only depends on torch, so that serving code can load an encoder artifact without importing the models and the
+training code of this package.
+"""
+
+import json
+import torch
+
+
+class ExportedEncoder():
+    """
+    Frozen TorchScript encoder with the device and dtype it was exported for. Calling it encodes a batch of windows
+    (batch_size, in_channel, window_size), converted to the device and dtype of the artifact.
+    """
+    def __init__(self, path):
+        extra_files = {'metadata.json': ''}
+        self.module = torch.jit.load(path, _extra_files=extra_files)
+        self.module.eval()
+        self.metadata = json.loads(extra_files['metadata.json'] or '{}')
+        self.device = self.metadata.get('device', 'cpu')
+        self.dtype = getattr(torch, self.metadata.get('dtype', 'float32'))
+        self.window_size = self.metadata.get('window_size')
+        self.encoding_size = self.metadata.get('encoding_size')
+
+    def __call__(self, x):
+        x = torch.as_tensor(x).to(device=self.device, dtype=self.dtype)
+        with torch.no_grad():
+            return self.module(x).reshape(x.shape[0], -1)
+
+    def encode(self, x, batch_size=500):
+        """Encodings of any number of windows, `batch_size` windows at a time"""
+        x = torch.as_tensor(x)
+        return torch.cat([self(batch) for batch in torch.split(x, batch_size)], 0)
+
+
+def load_encoder(path):
+    return ExportedEncoder(path)
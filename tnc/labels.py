@@ -0,0 +1,138 @@
+"""
+Run-length encoded state labels.
+States change only a few times in a recording, so labels are stored as segments, one (start, length, class) row per
+run of equal labels, instead of one value per time step. Window labels are computed directly from the segments, and
+the dense per time step arrays are only rebuilt when a caller needs them.
+"""
+
+import os
+import pickle
+import numpy as np
+
+
+def segments_from_onsets(onsets, values, length):
+    """
+    Segments of a recording of `length` samples, where label values[i] holds from onsets[i] to the next onset.
+    Onsets are clipped to the recording, empty runs are dropped and consecutive runs of the same class merged.
+    """
+    onsets = np.asarray(onsets, dtype=np.int64)
+    values = np.asarray(values)
+    bounds = np.clip(np.append(onsets, length), 0, length)
+    lengths = np.diff(bounds)
+    keep = lengths > 0
+    starts, lengths, values = bounds[:-1][keep], lengths[keep], values[keep]
+    if len(values) > 0:
+        first = np.concatenate([[True], values[1:] != values[:-1]])
+        lengths = np.add.reduceat(lengths, np.where(first)[0])
+        starts, values = starts[first], values[first]
+    return np.stack([starts, lengths, values.astype(np.int64)], -1).reshape((-1, 3))
+
+
+def rle_encode(labels):
+    """Segments (start, length, class) of a dense label array"""
+    labels = np.asarray(labels).reshape(-1)
+    if len(labels) == 0:
+        return np.zeros((0, 3), dtype=np.int64)
+    change = np.concatenate([[0], np.where(labels[1:] != labels[:-1])[0] + 1])
+    return segments_from_onsets(change, labels[change], len(labels))
+
+
+def rle_decode(segments, start=0, stop=None, fill=-1, dtype=np.int64):
+    """Dense labels between start and stop (the end of the last segment by default), `fill` outside the segments"""
+    segments = np.asarray(segments).reshape((-1, 3))
+    if stop is None:
+        stop = int(segments[-1, 0] + segments[-1, 1]) if len(segments) else start
+    out = np.full(max(0, stop - start), fill, dtype=dtype)
+    for seg_start, seg_length, value in segments[_overlapping(segments, start, stop)]:
+        a, b = max(seg_start, start), min(seg_start + seg_length, stop)
+        out[a - start:b - start] = value
+    return out
+
+
+def _overlapping(segments, start, stop):
+    ends = segments[:, 0] + segments[:, 1]
+    return slice(np.searchsorted(ends, start, side='right'), np.searchsorted(segments[:, 0], stop, side='left'))
+
+
+def _coverage(segments, t, classes):
+    """Number of samples of each class in [0, t), shape (len(t), len(classes))"""
+    starts, lengths, values = segments[:, 0], segments[:, 1], segments[:, 2]
+    is_class = values[np.newaxis, :] == classes[:, np.newaxis]
+    cumulative = np.concatenate([np.zeros((len(classes), 1)), np.cumsum(is_class*lengths, -1)], -1)
+    k = np.searchsorted(starts, t, side='right') - 1
+    inside = np.clip(t - starts[np.maximum(k, 0)], 0, lengths[np.maximum(k, 0)])
+    cov = cumulative[:, np.maximum(k, 0)] + is_class[:, np.maximum(k, 0)]*inside[np.newaxis, :]
+    return np.where(k[np.newaxis, :] >= 0, cov, 0).T
+
+
+def window_labels(segments, starts, window_size, reduce='majority'):
+    """
+    Label of the windows [starts[i], starts[i] + window_size) of one recording, computed from prefix sums over the
+    segments. `majority` returns the most frequent class (the smallest one on ties, like np.bincount(...).argmax()),
+    `mean` the average label. Samples outside the segments are ignored, windows without labels get -1.
+    """
+    segments = np.asarray(segments).reshape((-1, 3))
+    starts = np.asarray(starts, dtype=np.int64)
+    if len(segments) == 0:
+        return np.full(len(starts), -1.)
+    classes = np.unique(segments[:, 2])
+    counts = _coverage(segments, starts + window_size, classes) - _coverage(segments, starts, classes)
+    total = counts.sum(-1)
+    if reduce == 'majority':
+        labels = classes[np.argmax(counts, -1)].astype(float)
+    elif reduce == 'mean':
+        labels = np.dot(counts, classes) / np.maximum(total, 1)
+    else:
+        raise ValueError('Reduction not defined, must be one of the following {majority, mean}')
+    return np.where(total > 0, labels, -1.)
+
+
+def save_label_segments(path, segments, lengths, dtype='float64', dense_length=None):
+    """
+    Save the segments of a list of recordings of the given lengths, with the dtype and the length (the shortest
+    recording by default) of their dense arrays
+    """
+    offsets = np.cumsum([0] + [len(s) for s in segments])
+    dense_length = min(lengths) if dense_length is None else dense_length
+    np.savez(path, segments=np.concatenate([np.asarray(s).reshape((-1, 3)) for s in segments], 0).astype(np.int64),
+             offsets=offsets, lengths=np.asarray(lengths), dtype=np.dtype(dtype).name, dense_length=dense_length)
+
+
+def load_label_segments(path, split):
+    """
+    Segments of the recordings of a split ('train' or 'test') and their lengths. Reads state_<split>_segments.npz,
+    or encodes the dense state_<split>.pkl of datasets that are still stored densely.
+    """
+    segment_file = os.path.join(path, 'state_%s_segments.npz' % split)
+    if os.path.exists(segment_file):
+        with np.load(segment_file) as f:
+            segments, offsets, lengths = f['segments'], f['offsets'], f['lengths']
+        return [segments[offsets[i]:offsets[i + 1]] for i in range(len(lengths))], lengths
+    with open(os.path.join(path, 'state_%s.pkl' % split), 'rb') as f:
+        y = pickle.load(f)
+    return [rle_encode(yy) for yy in y], np.full(len(y), y.shape[-1])
+
+
+def load_states(path, split):
+    """
+    Dense (n_recordings, T) labels of a split, for code that expects state_<split>.pkl. Recordings stored as segments
+    are truncated to the length of the dense signal arrays.
+    """
+    segment_file = os.path.join(path, 'state_%s_segments.npz' % split)
+    if not os.path.exists(segment_file):
+        with open(os.path.join(path, 'state_%s.pkl' % split), 'rb') as f:
+            return pickle.load(f)
+    with np.load(segment_file) as f:
+        segments, offsets, dtype, T = f['segments'], f['offsets'], str(f['dtype']), int(f['dense_length'])
+    return np.stack([rle_decode(segments[offsets[i]:offsets[i + 1]], 0, T, dtype=dtype) for i in range(len(offsets) - 1)])
+
+
+def chopped_window_labels(path, split, window_size, T, reduce='majority'):
+    """
+    Labels of the non-overlapping windows obtained by splitting the first T samples of every recording into windows
+    of `window_size`, in the order of np.concatenate(np.split(x[:, :, :T], T // window_size, -1), 0)
+    """
+    segments, _ = load_label_segments(path, split)
+    starts = np.arange(T // window_size) * window_size
+    labels = np.stack([window_labels(s, starts, window_size, reduce=reduce) for s in segments])
+    return labels.T.reshape(-1)
@@ -1,9 +1,34 @@
+import contextlib
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.utils.checkpoint import checkpoint
+
+
+def _last_output(rnn, x, past, lengths=None):
+    """
+    Output of the recurrent layer at the last time step of each sequence, x is (seq_len, batch_size, in_channel).
+    With `lengths`, the padding is packed away and the output at step lengths[i]-1 is returned for both directions,
+    which is what out[-1] would be for the unpadded sequence.
+    """
+    if lengths is None:
+        out, _ = rnn(x, past)  # out shape = [seq_len, batch_size, num_directions*hidden_size]
+        return out[-1]
+    lengths = torch.as_tensor(lengths, dtype=torch.long).cpu()
+    out, _ = rnn(pack_padded_sequence(x, lengths, enforce_sorted=False), past)
+    out, _ = pad_packed_sequence(out)
+    return out[lengths - 1, torch.arange(out.shape[1])]
 
 
 class RnnEncoder(torch.nn.Module):
-    def __init__(self, hidden_size, in_channel, encoding_size, cell_type='GRU', num_layers=1, device='cpu', dropout=0, bidirectional=True):
+    """
+    With `reduced_channels`, a linear front-end projects the input channels to reduced_channels dimensions before the
+    recurrent layer, which makes its input projection much cheaper on high dimensional inputs. The projection is
+    learned with reduction='linear'. With reduction='pca' it is fixed to the principal components of the training
+    data, set with fit_reduction before training and saved with the rest of the state dict.
+    """
+    def __init__(self, hidden_size, in_channel, encoding_size, cell_type='GRU', num_layers=1, device='cpu', dropout=0, bidirectional=True,
+                 reduced_channels=None, reduction='linear'):
         super(RnnEncoder, self).__init__()
         self.hidden_size = hidden_size
         self.in_channel = in_channel
@@ -11,32 +36,181 @@ class RnnEncoder(torch.nn.Module):
         self.cell_type = cell_type
         self.encoding_size = encoding_size
         self.bidirectional = bidirectional
+        self.reduced_channels = reduced_channels
+        self.reduction = reduction
         self.device = device
 
+        self.front_end = None
+        if reduced_channels is not None:
+            if reduction not in ['linear', 'pca']:
+                raise ValueError('Channel reduction not defined, must be one of the following {linear, pca}')
+            self.front_end = torch.nn.Linear(self.in_channel, reduced_channels).to(self.device)
+            if reduction == 'pca':
+                self.front_end.requires_grad_(False)
+        rnn_input_size = self.in_channel if reduced_channels is None else reduced_channels
+
         self.nn = torch.nn.Sequential(torch.nn.Linear(self.hidden_size*(int(self.bidirectional) + 1), self.encoding_size)).to(self.device)
         if cell_type=='GRU':
-            self.rnn = torch.nn.GRU(input_size=self.in_channel, hidden_size=self.hidden_size, num_layers=num_layers,
+            self.rnn = torch.nn.GRU(input_size=rnn_input_size, hidden_size=self.hidden_size, num_layers=num_layers,
                                     batch_first=False, dropout=dropout, bidirectional=bidirectional).to(self.device)
 
         elif cell_type=='LSTM':
-            self.rnn = torch.nn.LSTM(input_size=self.in_channel, hidden_size=self.hidden_size, num_layers=num_layers,
+            self.rnn = torch.nn.LSTM(input_size=rnn_input_size, hidden_size=self.hidden_size, num_layers=num_layers,
                                     batch_first=False, dropout=dropout, bidirectional=bidirectional).to(self.device)
         else:
             raise ValueError('Cell type not defined, must be one of the following {GRU, LSTM, RNN}')
 
-    def forward(self, x):
-        x = x.permute(2,0,1)
-        if self.cell_type=='GRU':
-            past = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), x.shape[1], self.hidden_size).to(self.device)
-        elif self.cell_type=='LSTM':
-            h_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), (x.shape[1]), self.hidden_size).to(self.device)
-            c_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), (x.shape[1]), self.hidden_size).to(self.device)
-            past = (h_0, c_0)
-        out, _ = self.rnn(x.to(self.device), past)  # out shape = [seq_len, batch_size, num_directions*hidden_size]
-        encodings = self.nn(out[-1].squeeze(0))
+    def fit_reduction(self, x, max_recordings=100):
+        """
+        Set the front-end to the projection on the first reduced_channels principal components of the channels of x
+        (recordings of shape (in_channel, T), an array, tensor or ShardedTimeSeries), after centering them
+        """
+        # x[i][:, :] reads the whole recording, also when x[i] is the lazy RecordingView of a ShardedTimeSeries
+        samples = torch.cat([torch.as_tensor(x[i][:, :], dtype=torch.float32).reshape(self.in_channel, -1).t()
+                             for i in range(min(len(x), max_recordings))], 0)
+        samples = samples[torch.all(torch.isfinite(samples), -1)]
+        mean = samples.mean(0)
+        _, eigenvectors = torch.linalg.eigh(torch.matmul((samples - mean).t(), samples - mean) / len(samples))
+        components = eigenvectors[:, -self.reduced_channels:].flip(-1).t()
+        with torch.no_grad():
+            self.front_end.weight.copy_(components)
+            self.front_end.bias.copy_(-torch.matmul(components, mean))
+
+    def forward(self, x, lengths=None):
+        # The recurrent layer starts from a zero state when no initial state is given
+        x = x.permute(2,0,1).to(self.device)
+        if self.front_end is not None:
+            x = self.front_end(x)
+        encodings = self.nn(_last_output(self.rnn, x, None, lengths).squeeze(0))
         return encodings
 
 
+class StreamingRnnEncoder(torch.nn.Module):
+    """
+    Causal GRU encoder for online encoding. `step` consumes the new samples of each stream and carries the GRU state
+    from one call to the next, so updating the encoding costs O(1) per new sample instead of re-running the window.
+
+    With backward_step, the encoding also includes one step of a backward GRU cell on the last sample, started from
+    zeros. This is exactly what out[-1] holds for the backward direction of a bidirectional RnnEncoder, which makes
+    the conversion of single layer bidirectional checkpoints (from_rnn_encoder) exact for a stream that starts with the
+    window; on longer streams the forward state also carries the context before the window.
+    """
+    def __init__(self, hidden_size, in_channel, encoding_size, num_layers=1, device='cpu', dropout=0,
+                 backward_step=False):
+        super(StreamingRnnEncoder, self).__init__()
+        self.hidden_size = hidden_size
+        self.in_channel = in_channel
+        self.num_layers = num_layers
+        self.encoding_size = encoding_size
+        self.backward_step = backward_step
+        self.device = device
+
+        self.rnn = torch.nn.GRU(input_size=self.in_channel, hidden_size=self.hidden_size, num_layers=num_layers,
+                                batch_first=False, dropout=dropout).to(self.device)
+        self.backward_cell = None
+        if backward_step:
+            self.backward_cell = torch.nn.GRUCell(self.in_channel, self.hidden_size).to(self.device)
+        self.nn = torch.nn.Sequential(torch.nn.Linear(self.hidden_size*(int(self.backward_step) + 1), self.encoding_size)).to(self.device)
+
+    def _encode(self, out, x_last):
+        if self.backward_cell is not None:
+            out = torch.cat([out, self.backward_cell(x_last)], -1)
+        return self.nn(out)
+
+    def forward(self, x, lengths=None):
+        x = x.permute(2,0,1).to(self.device)
+        out = _last_output(self.rnn, x, None, lengths)
+        if lengths is None:
+            x_last = x[-1]
+        else:
+            x_last = x[torch.as_tensor(lengths, dtype=torch.long) - 1, torch.arange(x.shape[1])]
+        return self._encode(out, x_last)
+
+    def step(self, chunk, state=None):
+        """
+        Encode the streams after the new samples in chunk (batch_size, in_channel, n_samples). `state` is the GRU state
+        returned by the previous call (None at the start of the streams). Returns the encodings and the new state.
+        """
+        x = chunk.permute(2,0,1).to(self.device)
+        out, state = self.rnn(x, state)
+        return self._encode(out[-1], x[-1]), state
+
+    @classmethod
+    def from_rnn_encoder(cls, encoder):
+        """Streaming encoder with the weights of a single layer GRU RnnEncoder"""
+        if encoder.cell_type != 'GRU' or encoder.num_layers != 1:
+            raise ValueError('Only single layer GRU encoders can be converted to a streaming encoder')
+        streaming = cls(encoder.hidden_size, encoder.in_channel, encoder.encoding_size, device=encoder.device,
+                        backward_step=encoder.bidirectional)
+        with torch.no_grad():
+            for name in ['weight_ih', 'weight_hh', 'bias_ih', 'bias_hh']:
+                getattr(streaming.rnn, '%s_l0' % name).copy_(getattr(encoder.rnn, '%s_l0' % name))
+                if encoder.bidirectional:
+                    getattr(streaming.backward_cell, name).copy_(getattr(encoder.rnn, '%s_l0_reverse' % name))
+        streaming.nn.load_state_dict(encoder.nn.state_dict())
+        return streaming
+
+
+class _TemporalBlock(torch.nn.Module):
+    """Two causal dilated convolutions with a residual connection"""
+    def __init__(self, in_channel, out_channel, kernel_size, dilation, dropout=0):
+        super(_TemporalBlock, self).__init__()
+        padding = (kernel_size - 1) * dilation
+        self.net = nn.Sequential(nn.ConstantPad1d((padding, 0), 0.),
+                                 nn.Conv1d(in_channel, out_channel, kernel_size, dilation=dilation),
+                                 nn.ReLU(),
+                                 nn.Dropout(dropout),
+                                 nn.ConstantPad1d((padding, 0), 0.),
+                                 nn.Conv1d(out_channel, out_channel, kernel_size, dilation=dilation),
+                                 nn.ReLU(),
+                                 nn.Dropout(dropout))
+        self.downsample = nn.Conv1d(in_channel, out_channel, 1) if in_channel != out_channel else None
+
+    def forward(self, x):
+        residual = x if self.downsample is None else self.downsample(x)
+        return torch.relu(self.net(x) + residual)
+
+
+class TCNEncoder(torch.nn.Module):
+    """
+    Dilated causal temporal convolution encoder, a drop-in replacement for RnnEncoder that processes all the time
+    steps of a window in parallel. Level i doubles the dilation, and the encoding of a window is the output at its last
+    time step, which depends on the last `receptive_field` samples.
+
+    encode_series encodes every time step of a full recording in one pass. The encoding at step t is the encoding of
+    the window ending at t, exactly when the window is at least receptive_field long (shorter windows are zero padded).
+    """
+    def __init__(self, in_channel, encoding_size, hidden_size=64, kernel_size=3, n_levels=3, dropout=0, device='cpu'):
+        super(TCNEncoder, self).__init__()
+        self.in_channel = in_channel
+        self.encoding_size = encoding_size
+        self.hidden_size = hidden_size
+        self.kernel_size = kernel_size
+        self.n_levels = n_levels
+        self.receptive_field = 1 + 2*(kernel_size - 1)*(2**n_levels - 1)
+        self.device = device
+
+        self.network = nn.Sequential(*[_TemporalBlock(self.in_channel if level == 0 else self.hidden_size,
+                                                      self.hidden_size, kernel_size, 2**level, dropout)
+                                       for level in range(n_levels)]).to(self.device)
+        self.nn = torch.nn.Sequential(torch.nn.Linear(self.hidden_size, self.encoding_size)).to(self.device)
+
+    def forward(self, x, lengths=None):
+        out = self.network(x.to(self.device))  # out shape = [batch_size, hidden_size, seq_len]
+        if lengths is None:
+            return self.nn(out[:, :, -1])
+        lengths = torch.as_tensor(lengths, dtype=torch.long, device=out.device)
+        return self.nn(out[torch.arange(out.shape[0]), :, lengths - 1])
+
+    def encode_series(self, x):
+        """Encodings (batch_size, seq_len, encoding_size) of the windows ending at every time step of x"""
+        return self.nn(self.network(x.to(self.device)).transpose(1, 2))
+
+
+TCN_CONFIGS = {'simulation': {'in_channel': 3, 'encoding_size': 10, 'kernel_size': 4, 'n_levels': 3},
+               'har': {'in_channel': 561, 'encoding_size': 10, 'kernel_size': 2, 'n_levels': 1}}
+
+
 class StateClassifier(torch.nn.Module):
     def __init__(self, input_size, output_size):
         super(StateClassifier, self).__init__()
@@ -89,16 +263,9 @@ class E2EStateClassifier(torch.nn.Module):
         else:
             raise ValueError('Cell type not defined, must be one of the following {GRU, LSTM, RNN}')
 
-    def forward(self, x):
+    def forward(self, x, lengths=None):
         x = x.permute(2,0,1)
-        if self.cell_type=='GRU':
-            past = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), x.shape[1], self.hidden_size).to(self.device)
-        elif self.cell_type=='LSTM':
-            h_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), (x.shape[1]), self.hidden_size).to(self.device)
-            c_0 = torch.zeros(self.num_layers * (int(self.bidirectional) + 1), (x.shape[1]), self.hidden_size).to(self.device)
-            past = (h_0, c_0)
-        out, _ = self.rnn(x, past)  # out shape = [seq_len, batch_size, num_directions*hidden_size]
-        encodings = self.fc(out[-1].squeeze(0))
+        encodings = self.fc(_last_output(self.rnn, x, None, lengths).squeeze(0))
         return self.nn(encodings)
 
 
@@ -120,12 +287,39 @@ class MimicEncoder(torch.nn.Module):
         return encodings
 
 
+@contextlib.contextmanager
+def _frozen_running_stats(modules):
+    """
+    Keeps the running statistics and the num_batches_tracked counters of the BatchNorm layers of `modules` unchanged,
+    while a block is recomputed
+    """
+    norms = [m for m in modules if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momenta = [m.momentum for m in norms]
+    counts = [None if m.num_batches_tracked is None else m.num_batches_tracked.clone() for m in norms]
+    for m in norms:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, momentum, count in zip(norms, momenta, counts):
+            m.momentum = momentum
+            if count is not None:
+                m.num_batches_tracked.copy_(count)
+
+
 class WFEncoder(nn.Module):
-    def __init__(self, encoding_size, classify=False, n_classes=None):
+    """
+    With `checkpoint_activations`, the activations inside each convolution block of `features` (Conv1d, ELU,
+    BatchNorm1d and MaxPool1d) are not kept for the backward pass during training, only the block inputs are, and the
+    blocks are recomputed in the backward pass. This trades about one extra forward of the trunk for most of its
+    activation memory.
+    """
+    def __init__(self, encoding_size, classify=False, n_classes=None, checkpoint_activations=False):
         # Input x is (batch, 2, 256)
         super(WFEncoder, self).__init__()
 
         self.encoding_size = encoding_size
+        self.checkpoint_activations = checkpoint_activations
         self.n_classes = n_classes
         self.classify = classify
         self.classifier =None
@@ -165,6 +359,9 @@ class WFEncoder(nn.Module):
             nn.BatchNorm1d(256, eps=0.001),
             nn.MaxPool1d(kernel_size=2, stride=2)
             )
+        # Blocks of features, each starting at a convolution: in-place ELUs never modify a checkpointed block input
+        starts = [i for i, layer in enumerate(self.features) if isinstance(layer, nn.Conv1d)]
+        self._blocks = list(zip(starts, starts[1:] + [len(self.features)]))
 
         self.fc = nn.Sequential(
             nn.Dropout(0.5),
@@ -174,12 +371,67 @@ class WFEncoder(nn.Module):
             nn.Linear(2048, self.encoding_size)
         )
 
+    def _checkpointed_features(self, x):
+        for start, end in self._blocks:
+            block = self.features[start:end]
+            # The recomputation must not update the BatchNorm running statistics a second time
+            x = checkpoint(block, x, use_reentrant=False,
+                           context_fn=lambda: (contextlib.nullcontext(), _frozen_running_stats(block)))
+        return x
+
     def forward(self, x):
-        x = self.features(x)
+        if self.checkpoint_activations and self.training and torch.is_grad_enabled():
+            x = self._checkpointed_features(x)
+        else:
+            x = self.features(x)
         x = x.view(x.size(0), -1)
         encoding = self.fc(x)
         if self.classify:
             c = self.classifier(encoding)
             return c
         else:
-            return encoding
\ No newline at end of file
+            return encoding
+
+
+class StudentWFEncoder(nn.Module):
+    """
+    Compact waveform encoder distilled from a trained WFEncoder (see tnc/distillation.py). Strided convolutions
+    downsample the window 32 times, and the encoding is computed from the average and maximum of the last feature
+    maps over time, so the encoder does not depend on the window size.
+    """
+    def __init__(self, encoding_size, channels=(32, 64, 64, 128), classify=False, n_classes=None):
+        super(StudentWFEncoder, self).__init__()
+
+        self.encoding_size = encoding_size
+        self.channels = channels
+        self.n_classes = n_classes
+        self.classify = classify
+        self.classifier = None
+        if self.classify:
+            if self.n_classes is None:
+                raise ValueError('Need to specify the number of output classes for te encoder')
+            else:
+                self.classifier = nn.Sequential(
+                    nn.Dropout(0.5),
+                    nn.Linear(self.encoding_size, self.n_classes)
+                )
+                nn.init.xavier_uniform_(self.classifier[1].weight)
+
+        layers = []
+        for i, (kernel_size, stride) in enumerate([(8, 4), (5, 2), (5, 2), (3, 2)]):
+            layers += [nn.Conv1d(2 if i == 0 else channels[i - 1], channels[i], kernel_size=kernel_size, stride=stride,
+                                 padding=(kernel_size - 1)//2),
+                       nn.ELU(inplace=True),
+                       nn.BatchNorm1d(channels[i], eps=0.001)]
+        self.features = nn.Sequential(*layers)
+        self.fc = nn.Linear(2*channels[-1], self.encoding_size)
+
+    def forward(self, x):
+        x = self.features(x)
+        x = torch.cat([x.mean(-1), x.max(-1)[0]], -1)
+        encoding = self.fc(x)
+        if self.classify:
+            c = self.classifier(encoding)
+            return c
+        else:
+            return encoding
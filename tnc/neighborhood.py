@@ -0,0 +1,224 @@
+"""
+Neighborhood range estimators for TNC.
+
+The neighborhood of a window at time t spans epsilon window sizes around t. TNCDataset(adf=True) picks epsilon by
+running an ADF test on growing segments around every sampled t: epsilon is the first scale at which the segment is no
+longer stationary. The estimators in this module answer the same question with cheaper statistics computed for many
+windows at once, on a grid of centers, and store the result in an EpsilonTable that the dataset looks up.
+"""
+
+import os
+import sys
+import time
+import pickle
+import hashlib
+import argparse
+import numpy as np
+import torch
+from numpy.lib.stride_tricks import as_strided
+from statsmodels.tsa.stattools import adfuller
+
+from tnc.shards import ShardedTimeSeries
+
+N_SCALES = 3
+
+
+def _windows(x, starts, length):
+    """(n, n_channels, length) copies of x[:, s:s+length] for every start s, through a strided view of x"""
+    n_channels, T = x.shape
+    view = as_strided(x, shape=(T - length + 1, n_channels, length), strides=(x.strides[1], x.strides[0], x.strides[1]),
+                      writeable=False)
+    return view[starts]
+
+
+def adf_nonstationary(segments, window_size):
+    """Average ADF p-value of the channels >= 0.01, the criterion of TNCDataset(adf=True). One test per segment"""
+    p_values = np.zeros(len(segments))
+    for i, segment in enumerate(segments):
+        try:
+            p = [adfuller(channel)[1] for channel in segment]
+            p_values[i] = np.mean([0.01 if np.isnan(p_c) else p_c for p_c in p])
+        except Exception:
+            p_values[i] = 0.6
+    return p_values >= 0.01
+
+
+def variance_ratio_nonstationary(segments, window_size, critical_value=-2.326):
+    """
+    Lo-MacKinlay variance ratio test, VR = Var(x[t+q] - x[t]) / (q Var(x[t+1] - x[t])) with q = length/10. VR is 1
+    for a random walk and 1/q for white noise. Like the ADF criterion, the random walk is the null hypothesis and the
+    segment is non-stationary unless the test rejects it at the 1% level
+    """
+    length = segments.shape[-1]
+    q = max(2, length // 10)
+    var_1 = np.var(np.diff(segments, axis=-1), -1)
+    var_q = np.var(segments[..., q:] - segments[..., :-q], -1)
+    ratio = np.mean(var_q / np.maximum(q*var_1, 1e-12), -1)
+    z = (ratio - 1) / np.sqrt(2.*(2*q - 1)*(q - 1) / (3.*q*length))
+    return z > critical_value
+
+
+def acf_nonstationary(segments, window_size, threshold=0.3):
+    """
+    Autocorrelation at a lag of a tenth of the segment. It decays quickly for stationary segments and stays high for
+    trends and random walks
+    """
+    lag = max(1, segments.shape[-1] // 10)
+    centered = segments - np.mean(segments, -1, keepdims=True)
+    acov = np.mean(centered[..., lag:] * centered[..., :-lag], -1)
+    acf = acov / np.maximum(np.mean(centered**2, -1), 1e-12)
+    return np.mean(acf, -1) > threshold
+
+
+def kpss_nonstationary(segments, window_size, critical_value=0.739):
+    """
+    KPSS level stationarity statistic, with a Bartlett long run variance. Stationarity is rejected above the 1% critical
+    value, like the ADF criterion
+    """
+    length = segments.shape[-1]
+    centered = segments - np.mean(segments, -1, keepdims=True)
+    partial_sums = np.cumsum(centered, -1)
+    long_run_var = np.mean(centered**2, -1)
+    n_lags = int(4*(length/100.)**0.25)
+    for lag in range(1, n_lags + 1):
+        acov = np.sum(centered[..., lag:] * centered[..., :-lag], -1) / length
+        long_run_var += 2*(1 - lag/(n_lags + 1.))*acov
+    eta = np.sum(partial_sums**2, -1) / (length**2 * np.maximum(long_run_var, 1e-12))
+    return np.mean(eta, -1) > critical_value
+
+
+ESTIMATORS = {'adf': adf_nonstationary, 'variance_ratio': variance_ratio_nonstationary, 'acf': acf_nonstationary,
+              'kpss': kpss_nonstationary}
+
+
+class EpsilonTable():
+    """
+    Epsilon of every recording on a grid of centers t = k*stride, padded with -1 past the end of shorter recordings.
+    Indexing with an index array returns the table of the corresponding subset of recordings.
+    """
+    def __init__(self, epsilon, stride, window_size, estimator):
+        self.epsilon = np.asarray(epsilon, dtype=np.int8)
+        self.stride = stride
+        self.window_size = window_size
+        self.estimator = estimator
+
+    def __len__(self):
+        return len(self.epsilon)
+
+    def __getitem__(self, inds):
+        return EpsilonTable(self.epsilon[inds], self.stride, self.window_size, self.estimator)
+
+    def lookup(self, ind, t):
+        """Epsilon of recording `ind` at the grid center closest to t"""
+        row = self.epsilon[ind]
+        k = min(int(round(t / self.stride)), len(row) - 1)
+        while k > 0 and row[k] < 0:
+            k -= 1
+        return int(row[k])
+
+    def save(self, path, fingerprint=''):
+        np.savez(path, epsilon=self.epsilon, stride=self.stride, window_size=self.window_size,
+                 estimator=self.estimator, fingerprint=fingerprint)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as f:
+            table = EpsilonTable(f['epsilon'], int(f['stride']), int(f['window_size']), str(f['estimator']))
+            fingerprint = str(f['fingerprint'])
+        return table, fingerprint
+
+
+def _recordings(x):
+    """Iterate over the recordings of x as float64 (n_channels, length) arrays"""
+    for i in range(len(x)):
+        if isinstance(x, ShardedTimeSeries):
+            yield x.read(i, 0, int(x.lengths[i])).astype(np.float64)
+        else:
+            yield np.asarray(x[i], dtype=np.float64)
+
+
+def estimate_epsilon(x, window_size, estimator='kpss', stride=None, n_scales=N_SCALES, block_size=512):
+    """
+    Epsilon table of a dataset (array or tensor of shape (n, n_channels, T), or a ShardedTimeSeries).
+    Segments of 2*w_t samples around every grid center are tested at the scales w_t = window_size, ...,
+    n_scales*window_size, `block_size` centers at a time. Near the edges the segments are shifted inside the
+    recording instead of being truncated, so that all the segments of a scale have the same length.
+    """
+    if estimator not in ESTIMATORS:
+        raise ValueError('Neighborhood estimator not defined, must be one of the following {%s}' % ', '.join(ESTIMATORS))
+    is_nonstationary = ESTIMATORS[estimator]
+    stride = window_size if stride is None else stride
+    rows = []
+    for recording in _recordings(x):
+        T = recording.shape[-1]
+        centers = np.arange(0, T, stride)
+        first_nonstationary = np.full(len(centers), n_scales)
+        for scale in range(n_scales, 0, -1):
+            length = min(2*scale*window_size, T)
+            starts = np.clip(centers - length//2, 0, T - length)
+            flags = np.concatenate([is_nonstationary(_windows(recording, starts[i:i + block_size], length), window_size)
+                                    for i in range(0, len(starts), block_size)])
+            first_nonstationary[flags] = scale
+        rows.append(first_nonstationary)
+    epsilon = -np.ones((len(rows), max(len(row) for row in rows)), dtype=np.int8)
+    for i, row in enumerate(rows):
+        epsilon[i, :len(row)] = row
+    return EpsilonTable(epsilon, stride, window_size, estimator)
+
+
+def _fingerprint(x):
+    if isinstance(x, ShardedTimeSeries):
+        with open(os.path.join(x.path, 'manifest.json'), 'rb') as f:
+            return hashlib.md5(f.read() + x.inds.tobytes()).hexdigest()
+    x = x.numpy() if isinstance(x, torch.Tensor) else np.asarray(x)
+    return hashlib.md5(np.ascontiguousarray(x).tobytes() + str(x.shape).encode()).hexdigest()
+
+
+def epsilon_table(x, window_size, estimator='kpss', cache_dir=None, **kwargs):
+    """
+    Estimate the epsilon table of x, or load it from `cache_dir` when it was already computed for the same data,
+    window size and estimator
+    """
+    fingerprint = _fingerprint(x)
+    cache_file = None
+    if cache_dir is not None:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        cache_file = os.path.join(cache_dir, 'epsilon_%s_%d.npz' % (estimator, window_size))
+        if os.path.exists(cache_file):
+            table, cached_fingerprint = EpsilonTable.load(cache_file)
+            if cached_fingerprint == fingerprint:
+                return table
+    start = time.time()
+    table = estimate_epsilon(x, window_size, estimator, **kwargs)
+    valid = table.epsilon[table.epsilon > 0]
+    print('Estimated the %s neighborhood table in %.2fs, epsilon distribution: %s'
+          % (estimator, time.time() - start, np.bincount(valid, minlength=N_SCALES + 1)[1:].tolist()))
+    if cache_file is not None:
+        table.save(cache_file, fingerprint)
+    return table
+
+
+if __name__ == '__main__':
+    if not sys.warnoptions:
+        import warnings
+        warnings.simplefilter("ignore")
+    parser = argparse.ArgumentParser(description='Compare the cost and the agreement of the neighborhood estimators')
+    parser.add_argument('--x', type=str, default='./data/simulated_data/x_train.pkl')
+    parser.add_argument('--window_size', type=int, default=50)
+    parser.add_argument('--estimators', type=str, default='adf,variance_ratio,acf,kpss')
+    parser.add_argument('--n_samples', type=int, default=20, help='Number of recordings to use, 0 for all of them')
+    args = parser.parse_args()
+    with open(args.x, 'rb') as f:
+        x = pickle.load(f)
+    if args.n_samples > 0:
+        x = x[:args.n_samples]
+    tables = {}
+    for name in args.estimators.split(','):
+        start = time.time()
+        tables[name] = estimate_epsilon(x, args.window_size, name)
+        print('%s: %.2fs' % (name, time.time() - start))
+    if 'adf' in tables:
+        for name, table in tables.items():
+            valid = tables['adf'].epsilon > 0
+            print('%s agreement with adf: %.3f' % (name, np.mean(table.epsilon[valid] == tables['adf'].epsilon[valid])))
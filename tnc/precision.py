@@ -0,0 +1,38 @@
+"""
+Mixed precision forwards for training and inference.
+With precision='bf16', the encoder and discriminator forwards run under torch.autocast with bfloat16: matrix products
+and convolutions are computed in bf16 while the weights, and so the optimizer updates, stay in fp32. Their outputs are
+cast back to fp32 before the losses are computed.
+"""
+
+import torch
+
+PRECISIONS = ['fp32', 'bf16']
+
+
+def autocast(precision='fp32', device='cpu'):
+    """Autocast context of the forwards for a precision in PRECISIONS, disabled for fp32"""
+    if precision not in PRECISIONS:
+        raise ValueError('Precision not defined, must be one of the following {fp32, bf16}')
+    return torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16, enabled=precision == 'bf16')
+
+
+class MixedPrecision(torch.nn.Module):
+    """Runs `module` under autocast(precision) and returns fp32 outputs, for losses that call the encoder themselves"""
+    def __init__(self, module, precision='fp32', device='cpu'):
+        super(MixedPrecision, self).__init__()
+        self.module = module
+        self.precision = precision
+        self.device = device
+
+    def forward(self, *args):
+        with autocast(self.precision, self.device):
+            return self.module(*args).float()
+
+
+def encode(encoder, x, precision='fp32', device='cpu', batch_size=500):
+    """fp32 encodings of the windows x, computed `batch_size` windows at a time with the forward in `precision`"""
+    encoder.eval()
+    with torch.no_grad(), autocast(precision, device):
+        return torch.cat([encoder(batch.to(device)).float().cpu()
+                          for batch in torch.split(torch.as_tensor(x, dtype=torch.float32), batch_size)], 0)
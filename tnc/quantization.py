@@ -0,0 +1,118 @@
+"""
+Int8 quantization of trained encoders for CPU inference.
+GRU, LSTM and Linear layers are quantized dynamically: int8 weights, activations quantized on the fly. The convolutions
+of the WFEncoder trunk are quantized statically, with activation ranges calibrated on training windows. Each
+convolution gets its own QuantStub/DeQuantStub pair and the ELU and BatchNorm1d layers in between stay in float:
+BatchNorm1d has no quantized kernel, and the quantized ELU is slower than the float one.
+
+    python -m tnc.quantization --data waveform --cv 0
+"""
+
+import io
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QuantStub, DeQuantStub, get_default_qconfig, prepare, convert, quantize_dynamic
+
+from tnc.models import WFEncoder, StudentWFEncoder
+from tnc.export import load_trained_encoder, export_encoder, WINDOW_SIZES
+from tnc.utils import chopped_windows, linear_probe_accuracy
+
+DATA_PATHS = {'simulation': './data/simulated_data/', 'waveform': './data/waveform_data/processed',
+              'har': './data/HAR_data/'}
+ENGINES = [engine for engine in ['x86', 'fbgemm', 'qnnpack'] if engine in torch.backends.quantized.supported_engines]
+
+
+def quantize_encoder(encoder, calibration=None, static_trunk=True, batch_size=32):
+    """
+    Int8 copy of a trained encoder for CPU inference. The convolutions of a WFEncoder or StudentWFEncoder are statically
+    quantized when `static_trunk`, which needs calibration windows (n_windows, 2, window_size)
+    """
+    torch.backends.quantized.engine = ENGINES[0]
+    encoder = copy.deepcopy(encoder).cpu().eval()
+    if isinstance(encoder, (WFEncoder, StudentWFEncoder)) and static_trunk:
+        if calibration is None:
+            raise ValueError('Static quantization of the convolutions needs calibration windows')
+        for i, layer in enumerate(encoder.features):
+            if isinstance(layer, nn.Conv1d):
+                encoder.features[i] = nn.Sequential(QuantStub(), layer, DeQuantStub())
+                encoder.features[i].qconfig = get_default_qconfig(ENGINES[0])
+        prepare(encoder.features, inplace=True)
+        with torch.no_grad():
+            for batch in torch.split(torch.as_tensor(calibration, dtype=torch.float32), batch_size):
+                encoder.features(batch)
+        convert(encoder.features, inplace=True)
+    return quantize_dynamic(encoder, {nn.GRU, nn.LSTM, nn.Linear}, dtype=torch.qint8)
+
+
+def encode(encoder, x, batch_size=100):
+    with torch.no_grad():
+        return torch.cat([encoder(batch).reshape(len(batch), -1) for batch in torch.split(x, batch_size)], 0)
+
+
+def embedding_drift(encodings, quantized_encodings):
+    """Mean and minimum cosine similarity between the fp32 and the quantized encodings of the same windows"""
+    similarity = torch.nn.functional.cosine_similarity(encodings, quantized_encodings, dim=-1)
+    return similarity.mean().item(), similarity.min().item()
+
+
+def model_size(model):
+    """Size (MB) of the serialized state dict"""
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 2.**20
+
+
+def report(encoder, quantized, x, labels=None, recordings=None, batch_size=100):
+    """Drift, probe accuracy (when labels are given), latency and size of the quantized encoder against fp32"""
+    results = {}
+    for name, model in [('fp32', encoder), ('int8', quantized)]:
+        encode(model, x[:batch_size], batch_size)
+        start = time.time()
+        encodings = encode(model, x, batch_size)
+        results[name] = {'encodings': encodings, 'time': (time.time() - start) / len(x), 'size': model_size(model)}
+        if labels is not None:
+            results[name]['accuracy'] = linear_probe_accuracy(encodings.numpy(), labels, recordings)
+    results['drift'] = embedding_drift(results['fp32']['encodings'], results['int8']['encodings'])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize an encoder checkpoint to int8')
+    parser.add_argument('--data', type=str, default='waveform')
+    parser.add_argument('--cv', type=int, default=0)
+    parser.add_argument('--encoder', type=str, default='rnn', help='One of {rnn, tcn, causal, student}')
+    parser.add_argument('--path', type=str, default=None, help='Checkpoint folder in ./ckpt, if not the default one')
+    parser.add_argument('--n_calibration', type=int, default=200, help='Training windows used to calibrate')
+    parser.add_argument('--dynamic_only', action='store_true', help='Keep the convolutions in fp32')
+    parser.add_argument('--out', type=str, default=None)
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Channel reduction front-end of the RnnEncoder, as in tnc.tnc')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    args = parser.parse_args()
+
+    encoder, path = load_trained_encoder(args.data, args.cv, args.encoder, args.path,
+                                         reduced_channels=args.reduced_channels, reduction=args.reduction)
+    window_size = WINDOW_SIZES[args.data]
+    x_train, _, _ = chopped_windows(DATA_PATHS[args.data], 'train', window_size)
+    calibration = x_train[np.random.RandomState(0).permutation(len(x_train))[:args.n_calibration]]
+    quantized = quantize_encoder(encoder, calibration, static_trunk=not args.dynamic_only)
+
+    x_test, y_test, recordings = chopped_windows(DATA_PATHS[args.data], 'test', window_size)
+    results = report(encoder, quantized, x_test, y_test, recordings)
+    print('Embedding cosine similarity to fp32: mean %.4f \t min %.4f' % results['drift'])
+    for name in ['fp32', 'int8']:
+        print('%s: %8.3f ms/window \t %8.1f MB \t probe accuracy %.2f'
+              % (name, 1000*results[name]['time'], results[name]['size'], 100*results[name]['accuracy']))
+    print('Speedup x%.2f \t Size reduction x%.2f \t Probe accuracy change %+.2f'
+          % (results['fp32']['time'] / results['int8']['time'], results['fp32']['size'] / results['int8']['size'],
+             100*(results['int8']['accuracy'] - results['fp32']['accuracy'])))
+
+    out = args.out or './ckpt/%s/encoder_%d_int8.pt' % (path, args.cv)
+    export_encoder(quantized, x_test[:10], out, {'data': args.data, 'encoder_type': args.encoder, 'checkpoint': path,
+                                                 'cv': args.cv, 'encoding_size': encoder.encoding_size,
+                                                 'quantization': 'dynamic' if args.dynamic_only else 'static_trunk'})
+    print('Saved the quantized encoder to %s' % out)
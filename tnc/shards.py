@@ -0,0 +1,375 @@
+"""
+Out-of-core storage for variable length recordings.
+Recordings are appended to shard files on disk, and a manifest keeps the shard, offset, length and channel
+statistics of every recording. Labels are stored as run-length segments (see tnc.labels). Windows are read through a
+bounded LRU cache of fixed size chunks, so training only touches the regions of the dataset it samples, and no
+recording is truncated to a common length.
+Signals can optionally be stored with a lossy 16 bit codec (float16 or int16 scaled per chunk and channel), delta
+encoded along time and compressed with zlib. Chunks are compressed independently, so a window read only decompresses
+the chunks it overlaps.
+"""
+
+import os
+import copy
+import json
+import zlib
+import pickle
+import argparse
+from collections import OrderedDict
+import numpy as np
+import torch
+
+from tnc.labels import rle_encode, rle_decode
+
+MANIFEST = 'manifest.json'
+LABELS = 'labels.npy'
+CODECS = ['raw', 'float16', 'int16']
+
+
+def _dequantize(codes, scale, codec):
+    if codec == 'float16':
+        return codes.view(np.float16).astype(np.float32)
+    return codes.astype(np.float32) * scale
+
+
+def encode_chunk(x, codec, level=1):
+    """
+    Compress a (chunk_size, n_channels) block of samples. Returns the compressed bytes and the reconstructed block.
+    The 16 bit codes are delta encoded with wrap-around arithmetic, so the delta step itself is lossless.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if codec == 'int16':
+        scale = np.max(np.abs(x), 0) / 32767
+        scale = np.where(scale > 0, scale, 1).astype(np.float32)
+        codes = np.round(x / scale).astype(np.int16)
+    elif codec == 'float16':
+        # Values beyond the float16 range (65504) are not representable with this codec
+        scale = np.zeros(0, dtype=np.float32)
+        codes = x.astype(np.float16).view(np.int16)
+    else:
+        raise ValueError('Codec not defined, must be one of the following {float16, int16}')
+    deltas = codes.copy()
+    deltas[1:] = codes[1:] - codes[:-1]
+    return scale.tobytes() + zlib.compress(deltas.tobytes(), level), _dequantize(codes, scale, codec)
+
+
+def decode_chunk(blob, codec, n_channels):
+    """Reconstruct a float32 (chunk_size, n_channels) block from the bytes written by encode_chunk"""
+    header_size = 4*n_channels if codec == 'int16' else 0
+    scale = np.frombuffer(blob[:header_size], dtype=np.float32)
+    deltas = np.frombuffer(zlib.decompress(blob[header_size:]), dtype=np.int16).reshape((-1, n_channels))
+    return _dequantize(np.cumsum(deltas, axis=0, dtype=np.int16), scale, codec)
+
+
+class ShardWriter():
+    """
+    Append recordings of shape (n_channels, length), with optional per sample labels or label segments, to shard
+    files of at most `shard_size` samples. Samples are stored time-major, so a time range of a recording is contiguous
+    on disk. With a `codec` other than raw, every chunk of a shard is compressed separately (see encode_chunk), the
+    byte offsets of the chunks are saved next to the shard and the reconstruction error is written to the manifest
+    """
+    def __init__(self, path, shard_size=2**24, chunk_size=4096, dtype='float32', codec='raw', level=1):
+        if codec not in CODECS:
+            raise ValueError('Codec not defined, must be one of the following {raw, float16, int16}')
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.shard_size = shard_size
+        self.chunk_size = chunk_size
+        self.dtype = np.dtype(dtype) if codec == 'raw' else np.dtype(np.float32)
+        self.codec = codec
+        self.level = level
+        self.n_channels = None
+        self.records = []
+        self.shards = []
+        self.segments = []
+        self._n_segments = 0
+        self._shard_len = 0
+        self._signal_file = None
+        # Samples of the current shard waiting for a full chunk, and byte offsets of the chunks written so far
+        self._pending = []
+        self._n_pending = 0
+        self._chunk_offsets = [0]
+        self._sq_error, self._max_error, self._n_samples = 0., 0., 0
+
+    def _next_shard(self):
+        self._close_files()
+        name = 'shard_%05d' % len(self.shards)
+        self.shards.append(name)
+        self._signal_file = open(os.path.join(self.path, '%s.bin' % name), 'wb')
+        self._shard_len = 0
+        self._chunk_offsets = [0]
+
+    def _write_chunks(self, flush=False):
+        pending = np.concatenate(self._pending, 0) if self._pending else np.zeros((0, self.n_channels))
+        n_chunks = len(pending) // self.chunk_size
+        if flush and len(pending) % self.chunk_size:
+            n_chunks += 1
+        for i in range(n_chunks):
+            x = pending[i*self.chunk_size:(i + 1)*self.chunk_size]
+            blob, reconstruction = encode_chunk(x, self.codec, self.level)
+            self._signal_file.write(blob)
+            self._chunk_offsets.append(self._chunk_offsets[-1] + len(blob))
+            error = np.abs(reconstruction - x)
+            self._sq_error = self._sq_error + np.sum(error**2, 0)
+            self._max_error = np.maximum(self._max_error, np.max(error, 0))
+            self._n_samples += len(x)
+        rest = pending[n_chunks*self.chunk_size:]
+        self._pending, self._n_pending = [rest], len(rest)
+
+    def _close_files(self):
+        if self._signal_file is not None:
+            if self.codec != 'raw':
+                self._write_chunks(flush=True)
+                np.save(os.path.join(self.path, '%s_chunks.npy' % self.shards[-1]), np.array(self._chunk_offsets))
+            self._signal_file.close()
+
+    def add(self, signal, labels=None, segments=None):
+        signal = np.asarray(signal)
+        if self.n_channels is None:
+            self.n_channels = signal.shape[0]
+        elif signal.shape[0] != self.n_channels:
+            raise ValueError('All recordings must have %d channels' % self.n_channels)
+        length = signal.shape[-1]
+        if self._signal_file is None or (self._shard_len > 0 and self._shard_len + length > self.shard_size):
+            self._next_shard()
+        if segments is None:
+            segments = np.zeros((0, 3), dtype=np.int64) if labels is None else rle_encode(labels)
+        if self.codec == 'raw':
+            self._signal_file.write(np.ascontiguousarray(signal.T, dtype=self.dtype).tobytes())
+        else:
+            self._pending.append(np.asarray(signal.T, dtype=np.float64))
+            self._n_pending += length
+            if self._n_pending >= self.chunk_size:
+                self._write_chunks()
+        self.segments.append(np.asarray(segments, dtype=np.int64).reshape((-1, 3)))
+        self.records.append({'shard': len(self.shards) - 1, 'offset': self._shard_len, 'length': length,
+                             'segments': [self._n_segments, self._n_segments + len(self.segments[-1])],
+                             'mean': np.mean(signal, -1).tolist(), 'std': np.std(signal, -1).tolist()})
+        self._n_segments += len(self.segments[-1])
+        self._shard_len += length
+
+    def close(self):
+        self._close_files()
+        self._signal_file = None
+        np.save(os.path.join(self.path, LABELS), np.concatenate(self.segments + [np.zeros((0, 3), dtype=np.int64)]))
+        manifest = {'n_channels': self.n_channels, 'dtype': self.dtype.name, 'chunk_size': self.chunk_size,
+                    'codec': self.codec, 'shards': self.shards, 'records': self.records}
+        if self.codec != 'raw':
+            # A writer closed without records has no channels, its manifest is empty like with the raw codec
+            n_channels = self.n_channels or 0
+            manifest['reconstruction_error'] = {
+                'max_abs': np.broadcast_to(self._max_error, n_channels).tolist(),
+                'rmse': np.broadcast_to(np.sqrt(self._sq_error / max(self._n_samples, 1)), n_channels).tolist()}
+        with open(os.path.join(self.path, MANIFEST), 'w') as f:
+            json.dump(manifest, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ChunkCache():
+    """LRU cache of chunks, bounded by the total size of the cached arrays"""
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.chunks = OrderedDict()
+
+    def get(self, key, load):
+        if key in self.chunks:
+            self.chunks.move_to_end(key)
+            return self.chunks[key]
+        chunk = load()
+        self.chunks[key] = chunk
+        self.n_bytes += chunk.nbytes
+        while self.n_bytes > self.max_bytes and len(self.chunks) > 1:
+            _, evicted = self.chunks.popitem(last=False)
+            self.n_bytes -= evicted.nbytes
+        return chunk
+
+
+class RecordingView():
+    """Lazy (n_channels, length) view of one recording, sliced like a tensor"""
+    def __init__(self, store, ind):
+        self.store = store
+        self.ind = ind
+        self.shape = (store.n_channels, int(store.lengths[ind]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        channels, time = key
+        if isinstance(time, slice):
+            start, stop, step = time.indices(self.shape[-1])
+            x = self.store.read(self.ind, start, stop)[:, ::step]
+        else:
+            x = self.store.read(self.ind, time, time + 1)[:, 0]
+        return torch.from_numpy(np.ascontiguousarray(x[channels]))
+
+
+class ShardedTimeSeries():
+    """
+    Collection of recordings stored with ShardWriter. Indexing with an integer returns a RecordingView, indexing with
+    a slice or an index array returns a subset that shares the chunk cache. `sample_index` and `sample_crops` draw
+    positions uniformly over time, i.e. recordings are picked in proportion to their length.
+    """
+    def __init__(self, path, cache_size=256):
+        with open(os.path.join(path, MANIFEST)) as f:
+            manifest = json.load(f)
+        self.path = path
+        self.n_channels = manifest['n_channels']
+        self.dtype = np.dtype(manifest['dtype'])
+        self.chunk_size = manifest['chunk_size']
+        self.codec = manifest.get('codec', 'raw')
+        self.reconstruction_error = manifest.get('reconstruction_error')
+        self.shards = manifest['shards']
+        self.records = manifest['records']
+        self.segments = np.load(os.path.join(path, LABELS))
+        self.cache = ChunkCache(cache_size * 2**20)
+        self._memmaps = {}
+        self._set_inds(np.arange(len(self.records)))
+
+    def __getstate__(self):
+        # DataLoader workers reopen the shards and start with an empty cache instead of receiving copies of them
+        state = self.__dict__.copy()
+        state['_memmaps'] = {}
+        state['cache'] = ChunkCache(self.cache.max_bytes)
+        return state
+
+    def _set_inds(self, inds):
+        self.inds = np.asarray(inds, dtype=int)
+        self.lengths = np.array([self.records[i]['length'] for i in self.inds], dtype=int)
+        self._cumulative_lengths = np.cumsum(self.lengths)
+
+    @property
+    def shape(self):
+        return (len(self), self.n_channels, int(self.lengths.max()))
+
+    def __len__(self):
+        return len(self.inds)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return RecordingView(self, int(key) % len(self))
+        subset = copy.copy(self)
+        subset._set_inds(self.inds[key])
+        return subset
+
+    def _memmap(self, shard):
+        if shard not in self._memmaps:
+            if self.codec == 'raw':
+                mm = np.memmap(os.path.join(self.path, '%s.bin' % self.shards[shard]), dtype=self.dtype, mode='r')
+                self._memmaps[shard] = mm.reshape((-1, self.n_channels))
+            else:
+                mm = np.memmap(os.path.join(self.path, '%s.bin' % self.shards[shard]), dtype=np.uint8, mode='r')
+                self._memmaps[shard] = (mm, np.load(os.path.join(self.path, '%s_chunks.npy' % self.shards[shard])))
+        return self._memmaps[shard]
+
+    def _load_chunk(self, shard, chunk):
+        cs = self.chunk_size
+        if self.codec == 'raw':
+            return np.array(self._memmap(shard)[chunk*cs:(chunk + 1)*cs])
+        mm, offsets = self._memmap(shard)
+        return decode_chunk(mm[offsets[chunk]:offsets[chunk + 1]].tobytes(), self.codec, self.n_channels)
+
+    def read(self, ind, start, stop):
+        """Signal of recording `ind` between start and stop, shape (n_channels, stop - start)"""
+        record = self.records[self.inds[ind]]
+        start, stop = max(0, start), min(record['length'], stop)
+        out = np.empty((max(0, stop - start), self.n_channels), dtype=self.dtype)
+        if stop <= start:
+            return out.T
+        a, b = record['offset'] + start, record['offset'] + stop
+        cs = self.chunk_size
+        for chunk in range(a // cs, (b - 1) // cs + 1):
+            data = self.cache.get((record['shard'], chunk), lambda: self._load_chunk(record['shard'], chunk))
+            lo, hi = max(a, chunk*cs), min(b, (chunk + 1)*cs)
+            out[lo - a:hi - a] = data[lo - chunk*cs:hi - chunk*cs]
+        return out.T
+
+    def label_segments(self, ind):
+        """Label segments (start, length, class) of recording `ind`"""
+        first, last = self.records[self.inds[ind]]['segments']
+        return self.segments[first:last]
+
+    def read_labels(self, ind, start, stop):
+        """Per sample labels of recording `ind` between start and stop (-1 where there are no labels)"""
+        start, stop = max(0, start), min(int(self.lengths[ind]), stop)
+        return rle_decode(self.label_segments(ind), start, stop)
+
+    def read_padded(self, inds, starts, stops):
+        """
+        Windows of different lengths as one zero padded (n, n_channels, max_length) tensor and the length of each
+        window, to be encoded with `RnnEncoder(x, lengths=lengths)` without computing over the padding
+        """
+        lengths = [min(stop, self.lengths[i]) - max(start, 0) for i, start, stop in zip(inds, starts, stops)]
+        windows = torch.zeros((len(lengths), self.n_channels, max(lengths)))
+        for n, (i, start, stop) in enumerate(zip(inds, starts, stops)):
+            windows[n, :, :lengths[n]] = torch.from_numpy(self.read(i, start, stop).astype(np.float32))
+        return windows, torch.LongTensor(lengths)
+
+    def sample_index(self):
+        """Random recording, picked with a probability proportional to its length"""
+        return int(np.searchsorted(self._cumulative_lengths, np.random.randint(self._cumulative_lengths[-1]),
+                                   side='right'))
+
+    def sample_crops(self, n, length):
+        """n crops of `length` samples, with start positions drawn uniformly over all the valid positions"""
+        valid = np.maximum(self.lengths - length + 1, 0)
+        if valid.sum() == 0:
+            raise ValueError('No recording is longer than %d samples' % length)
+        inds = np.random.choice(len(self), n, p=valid / valid.sum())
+        starts = (np.random.rand(n) * valid[inds]).astype(int)
+        return np.stack([self.read(i, t, t + length) for i, t in zip(inds, starts)])
+
+
+def write_dense(path, x, y=None, lengths=None, **kwargs):
+    """Write dense (n, n_channels, T) arrays to a sharded store, keeping only the first lengths[i] samples of each"""
+    with ShardWriter(path, **kwargs) as writer:
+        for i in range(len(x)):
+            length = x.shape[-1] if lengths is None else lengths[i]
+            writer.add(x[i][:, :length], None if y is None else y[i][:length])
+
+
+def write_afdb_records(path, records_path, **kwargs):
+    """Write the per record files produced by data/afib_data.py to a sharded store"""
+    with open(os.path.join(records_path, 'stats.json')) as f:
+        record_ids = json.load(f)['record_ids']
+    with ShardWriter(path, **kwargs) as writer:
+        for record_id in record_ids:
+            writer.add(np.load(os.path.join(records_path, '%s_signal.npy' % record_id), mmap_mode='r'),
+                       segments=np.load(os.path.join(records_path, '%s_segments.npy' % record_id)))
+
+
+def _load_array(path):
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a dataset to a sharded store')
+    parser.add_argument('--out', type=str, required=True)
+    parser.add_argument('--x', type=str, help='Signals, .pkl or .npy of shape (n, n_channels, T)')
+    parser.add_argument('--y', type=str, help='Per sample labels, .pkl or .npy of shape (n, T)')
+    parser.add_argument('--lengths', type=str, help='.npy of recording lengths, for padded arrays')
+    parser.add_argument('--afdb_records', type=str, help='Records folder written by data/afib_data.py')
+    parser.add_argument('--chunk_size', type=int, default=4096)
+    parser.add_argument('--codec', type=str, default='raw', help='One of {raw, float16, int16}')
+    parser.add_argument('--level', type=int, default=1, help='zlib compression level of the 16 bit codecs')
+    args = parser.parse_args()
+    options = {'chunk_size': args.chunk_size, 'codec': args.codec, 'level': args.level}
+    if args.afdb_records:
+        write_afdb_records(args.out, args.afdb_records, **options)
+    else:
+        write_dense(args.out, _load_array(args.x), y=None if args.y is None else _load_array(args.y),
+                    lengths=None if args.lengths is None else np.load(args.lengths), **options)
+    if args.codec != 'raw':
+        print('Reconstruction error: ', ShardedTimeSeries(args.out).reconstruction_error)
@@ -0,0 +1,93 @@
+"""
+Online encoding of live streams with a StreamingRnnEncoder.
+Converts trained bidirectional RnnEncoder checkpoints to streaming encoders, and compares the cost of updating the
+encoding of a stream sample by sample with re-running the encoder over the last window.
+"""
+
+import os
+import time
+import argparse
+import torch
+
+from tnc.models import RnnEncoder, StreamingRnnEncoder
+
+CONFIGS = {'simulation': {'hidden_size': 100, 'in_channel': 3, 'encoding_size': 10, 'window_size': 50},
+           'har': {'hidden_size': 100, 'in_channel': 561, 'encoding_size': 10, 'window_size': 4}}
+
+
+def convert_checkpoint(data, cv=0, device='cpu'):
+    """Convert ./ckpt/<data>/checkpoint_<cv>.pth.tar to a streaming encoder saved in ./ckpt/<data>_streaming"""
+    config = CONFIGS[data]
+    encoder = RnnEncoder(hidden_size=config['hidden_size'], in_channel=config['in_channel'],
+                         encoding_size=config['encoding_size'], device=device)
+    checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar' % (data, cv), map_location=device)
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    streaming = StreamingRnnEncoder.from_rnn_encoder(encoder)
+    if not os.path.exists('./ckpt/%s_streaming' % data):
+        os.mkdir('./ckpt/%s_streaming' % data)
+    torch.save({'encoder_state_dict': streaming.state_dict(), 'backward_step': streaming.backward_step,
+                'source': checkpoint.get('epoch')}, './ckpt/%s_streaming/checkpoint_%d.pth.tar' % (data, cv))
+    return streaming
+
+
+def load_streaming_encoder(data, cv=0, device='cpu'):
+    """Load a converted checkpoint, or one trained with `tnc.tnc --causal`"""
+    config = CONFIGS[data]
+    for path in ['%s_streaming' % data, '%s_causal' % data]:
+        if os.path.exists('./ckpt/%s/checkpoint_%d.pth.tar' % (path, cv)):
+            checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar' % (path, cv), map_location=device)
+            encoder = StreamingRnnEncoder(hidden_size=config['hidden_size'], in_channel=config['in_channel'],
+                                          encoding_size=config['encoding_size'], device=device,
+                                          backward_step=checkpoint.get('backward_step', False))
+            encoder.load_state_dict(checkpoint['encoder_state_dict'])
+            encoder.eval()
+            return encoder
+    raise ValueError('No streaming checkpoint for %s, convert one with --convert or train with --causal' % data)
+
+
+def encode_stream(encoder, x, chunk_size=1):
+    """Encodings of a (n_streams, n_channels, T) signal after every chunk of `chunk_size` new samples"""
+    encodings, state = [], None
+    with torch.no_grad():
+        for start in range(0, x.shape[-1], chunk_size):
+            encoding, state = encoder.step(x[:, :, start:start + chunk_size], state)
+            encodings.append(encoding)
+    return torch.stack(encodings, 1)
+
+
+def benchmark(encoder, window_encoder, x, window_size, n_steps=500):
+    """Seconds per new sample of streaming updates and of re-encoding the last window at stride 1"""
+    with torch.no_grad():
+        _, state = encoder.step(x[:, :, :window_size])
+        start = time.time()
+        for t in range(window_size, window_size + n_steps):
+            _, state = encoder.step(x[:, :, t:t + 1], state)
+        streaming_time = (time.time() - start) / n_steps
+        start = time.time()
+        for t in range(window_size, window_size + n_steps):
+            window_encoder(x[:, :, t + 1 - window_size:t + 1])
+        window_time = (time.time() - start) / n_steps
+    return streaming_time, window_time
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Streaming RNN encoders')
+    parser.add_argument('--data', type=str, default='simulation')
+    parser.add_argument('--cv', type=int, default=0)
+    parser.add_argument('--convert', action='store_true', help='Convert the bidirectional checkpoint first')
+    parser.add_argument('--window_size', type=int, default=None, help='Window re-encoded by the baseline')
+    parser.add_argument('--n_streams', type=int, default=1)
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+    if args.convert:
+        convert_checkpoint(args.data, args.cv)
+    encoder = load_streaming_encoder(args.data, args.cv)
+    config = CONFIGS[args.data]
+    window_size = args.window_size or config['window_size']
+    window_encoder = RnnEncoder(hidden_size=config['hidden_size'], in_channel=config['in_channel'],
+                                encoding_size=config['encoding_size'])
+    window_encoder.eval()
+    x = torch.randn(args.n_streams, config['in_channel'], window_size + 501)
+    streaming_time, window_time = benchmark(encoder, window_encoder, x, window_size)
+    print('Per sample update: streaming %.3f ms \t window re-encoding (%d samples) %.3f ms'
+          % (1000*streaming_time, window_size, 1000*window_time))
@@ -13,11 +13,17 @@ import sys
 import numpy as np
 import pickle
 import os
+import copy
 import random
 
-from tnc.models import RnnEncoder, WFEncoder
+from tnc.models import RnnEncoder, WFEncoder, StreamingRnnEncoder, TCNEncoder, TCN_CONFIGS
 from tnc.utils import plot_distribution, track_encoding
 from tnc.evaluations import WFClassificationExperiment, ClassificationPerformanceExperiment
+from tnc.shards import ShardedTimeSeries
+from tnc.labels import load_states
+from tnc.neighborhood import epsilon_table
+from tnc.precision import autocast
+from tnc.autotune import apply_profile, dataset_name
 from statsmodels.tsa.stattools import adfuller
 
 if not sys.warnoptions:
@@ -48,9 +54,21 @@ class Discriminator(torch.nn.Module):
         p = self.model(x_all)
         return p.view((-1,))
 
+    def pairwise(self, x, x_tild):
+        """
+        Logits of all the (x[i], x_tild[j]) pairs, shape (len(x), len(x_tild)). The first layer is split into its x and
+        x_tild halves, so each embedding is projected once instead of once per pair.
+        """
+        layer = self.model[0]
+        h_x = torch.nn.functional.linear(x, layer.weight[:, :self.input_size], layer.bias)
+        h_tild = torch.nn.functional.linear(x_tild, layer.weight[:, self.input_size:])
+        h = h_x.unsqueeze(1) + h_tild.unsqueeze(0)
+        return self.model[3](self.model[2](self.model[1](h))).squeeze(-1)
+
 
 class TNCDataset(data.Dataset):
-    def __init__(self, x, mc_sample_size, window_size, augmentation, epsilon=3, state=None, adf=False):
+    def __init__(self, x, mc_sample_size, window_size, augmentation, epsilon=3, state=None, adf=False,
+                 epsilon_table=None, return_meta=False):
         super(TNCDataset, self).__init__()
         self.time_series = x
         self.T = x.shape[-1]
@@ -61,6 +79,11 @@ class TNCDataset(data.Dataset):
         self.state = state
         self.augmentation = augmentation
         self.adf = adf
+        # Precomputed epsilon of every recording (see tnc.neighborhood), used instead of the ADF test when given
+        self.epsilon_table = epsilon_table
+        # Also return (series index, anchor time, delta, non-neighbor times, neighbor times), used by the
+        # NonNeighborBank and the pairwise scoring mode
+        self.return_meta = return_meta
         if not self.adf:
             self.epsilon = epsilon
             self.delta = 5*window_size*epsilon
@@ -69,22 +92,35 @@ class TNCDataset(data.Dataset):
         return len(self.time_series)*self.augmentation
 
     def __getitem__(self, ind):
-        ind = ind%len(self.time_series)
-        t = np.random.randint(2*self.window_size, self.T-2*self.window_size)
-        x_t = self.time_series[ind][:,t-self.window_size//2:t+self.window_size//2]
-        plt.savefig('./plots/%s_seasonal.png'%ind)
-        X_close = self._find_neighours(self.time_series[ind], t)
-        X_distant = self._find_non_neighours(self.time_series[ind], t)
-
-        if self.state is None:
+        if isinstance(self.time_series, ShardedTimeSeries):
+            # Sample uniformly over time, so that long recordings are not under-represented
+            ind = self.time_series.sample_index()
+        else:
+            ind = ind%len(self.time_series)
+        x = self.time_series[ind]
+        T = x.shape[-1]
+        t = np.random.randint(2*self.window_size, T-2*self.window_size)
+        x_t = x[:,t-self.window_size//2:t+self.window_size//2]
+        if self.epsilon_table is not None:
+            self.epsilon = self.epsilon_table.lookup(ind, t)
+            self.delta = 5*self.epsilon*self.window_size
+        X_close, t_p = self._find_neighours(x, t, return_times=True)
+        X_distant, t_n = self._find_non_neighours(x, t, return_times=True)
+
+        if isinstance(self.time_series, ShardedTimeSeries) and self.state is None:
+            labels = self.time_series.read_labels(ind, t-self.window_size//2, t+self.window_size//2)
+            y_t = -1 if np.any(labels < 0) else np.round(np.mean(labels))
+        elif self.state is None:
             y_t = -1
         else:
             y_t = torch.round(torch.mean(self.state[ind][t-self.window_size//2:t+self.window_size//2]))
+        if self.return_meta:
+            return x_t, X_close, X_distant, y_t, (ind, t, self.delta, torch.as_tensor(t_n), torch.as_tensor(t_p))
         return x_t, X_close, X_distant, y_t
 
-    def _find_neighours(self, x, t):
-        T = self.time_series.shape[-1]
-        if self.adf:
+    def _find_neighours(self, x, t, return_times=False):
+        T = x.shape[-1]
+        if self.adf and self.epsilon_table is None:
             gap = self.window_size
             corr = []
             for w_t in range(self.window_size,4*self.window_size, gap):
@@ -103,10 +139,12 @@ class TNCDataset(data.Dataset):
         t_p = [int(t+np.random.randn()*self.epsilon*self.window_size) for _ in range(self.mc_sample_size)]
         t_p = [max(self.window_size//2+1,min(t_pp,T-self.window_size//2)) for t_pp in t_p]
         x_p = torch.stack([x[:, t_ind-self.window_size//2:t_ind+self.window_size//2] for t_ind in t_p])
+        if return_times:
+            return x_p, np.array(t_p)
         return x_p
 
-    def _find_non_neighours(self, x, t):
-        T = self.time_series.shape[-1]
+    def _find_non_neighours(self, x, t, return_times=False):
+        T = x.shape[-1]
         if t>T/2:
             t_n = np.random.randint(self.window_size//2, max((t - self.delta + 1), self.window_size//2+1), self.mc_sample_size)
         else:
@@ -117,12 +155,125 @@ class TNCDataset(data.Dataset):
             rand_t = np.random.randint(0,self.window_size//5)
             if t > T / 2:
                 x_n = x[:,rand_t:rand_t+self.window_size].unsqueeze(0)
+                t_n = np.array([rand_t + self.window_size//2])
             else:
                 x_n = x[:, T - rand_t - self.window_size:T - rand_t].unsqueeze(0)
+                t_n = np.array([T - rand_t - self.window_size//2])
+        if return_times:
+            return x_n, t_n
         return x_n
 
 
-def epoch_run(loader, disc_model, encoder, device, w=0, optimizer=None, train=True):
+class NonNeighborBank():
+    """
+    FIFO bank of the embeddings of recent non-neighbor windows, with the series and the time they come from, used as
+    extra negatives for the discriminator.
+    With refresh='staleness', the embeddings computed for the loss are stored as they are and entries older than
+    `max_staleness` training steps are not sampled anymore. With refresh='momentum', the stored embeddings are
+    computed by a momentum copy of the encoder, which changes slowly enough for old entries to stay consistent, at the
+    cost of a second encoder forward over the pushed windows. `push_size` bounds the number of non-neighbors pushed
+    (and so key encoded) per training step, all of them when None.
+    """
+    def __init__(self, size, encoding_size, device, refresh='staleness', max_staleness=100, momentum=0.99,
+                 push_size=None):
+        if refresh not in ['staleness', 'momentum']:
+            raise ValueError('Bank refresh not defined, must be one of the following {staleness, momentum}')
+        self.size = size
+        self.device = device
+        self.refresh = refresh
+        self.max_staleness = max_staleness
+        self.momentum = momentum
+        self.push_size = push_size
+        self.embeddings = torch.zeros((size, encoding_size), device=device)
+        self.series = torch.full((size,), -1, dtype=torch.long, device=device)
+        self.times = torch.zeros((size,), dtype=torch.long, device=device)
+        self.steps = torch.full((size,), -1, dtype=torch.long, device=device)
+        self.step = 0
+        self._head = 0
+        self.key_encoder = None
+
+    def momentum_update(self, encoder):
+        """Move the key encoder towards the encoder (created as a copy of it on the first call)"""
+        if self.key_encoder is None:
+            self.key_encoder = copy.deepcopy(encoder)
+            self.key_encoder.eval()
+            for param in self.key_encoder.parameters():
+                param.requires_grad = False
+            return
+        with torch.no_grad():
+            for key, value in zip(self.key_encoder.state_dict().values(), encoder.state_dict().values()):
+                if key.dtype.is_floating_point:
+                    key.mul_(self.momentum).add_(value, alpha=1 - self.momentum)
+                else:
+                    key.copy_(value)
+
+    def push(self, embeddings, series, times):
+        """Add a batch of embeddings, overwriting the oldest entries"""
+        self.step += 1
+        embeddings = embeddings.detach()[-self.size:]
+        inds = (self._head + torch.arange(len(embeddings), device=self.device)) % self.size
+        self.embeddings[inds] = embeddings
+        self.series[inds] = series[-self.size:].to(self.device)
+        self.times[inds] = times[-self.size:].to(self.device)
+        self.steps[inds] = self.step
+        self._head = (self._head + len(embeddings)) % self.size
+
+    def sample(self, series, times, delta, n):
+        """
+        Up to n bank embeddings per anchor. Entries from the anchor series that are closer than delta to the anchor
+        could be neighbors and are left out. Returns the anchor index and the embedding of every drawn negative
+        """
+        valid = self.steps >= 0
+        if self.refresh == 'staleness':
+            valid = valid & (self.step - self.steps < self.max_staleness)
+        valid = torch.nonzero(valid).view(-1)
+        if len(valid) == 0:
+            return None, None
+        draw = valid[torch.randint(len(valid), (len(series), n), device=self.device)]
+        series, times, delta = series.to(self.device), times.to(self.device), delta.to(self.device)
+        close = (self.series[draw] == series[:, None]) & \
+                (torch.abs(self.times[draw] - times[:, None]) < delta[:, None])
+        anchors = torch.arange(len(series), device=self.device)[:, None].expand_as(draw)
+        return anchors[~close], self.embeddings[draw[~close]]
+
+
+class AdaptiveMCBudget():
+    """
+    Number of neighbor and non-neighbor samples per anchor, adapted to the precision of the loss estimate.
+    After every training batch, the standard error of the batch loss is compared to `tolerance` times the loss, and the
+    budget is scaled by the ratio of the two squared (the standard error falls as one over the square root of the
+    number of samples). The budget is smoothed with an exponential moving average and kept within [min_size, max_size].
+    """
+    def __init__(self, min_size, max_size, tolerance=0.05, momentum=0.9):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self.momentum = momentum
+        self._size = float(max_size)
+        self.history = []
+
+    @property
+    def size(self):
+        return int(np.clip(np.ceil(self._size), self.min_size, self.max_size))
+
+    def update(self, loss, standard_error):
+        required = self.size * (standard_error / max(self.tolerance*loss, 1e-12))**2
+        self._size = np.clip(self.momentum*self._size + (1 - self.momentum)*required, self.min_size, self.max_size)
+        self.history.append(self.size)
+        return self.size
+
+
+def epoch_run(loader, disc_model, encoder, device, w=0, optimizer=None, train=True, mc_budget=None, bank=None,
+              bank_negatives=0, pairwise=False, precision='fp32', accumulation_steps=1):
+    """
+    With `pairwise`, every anchor is encoded once and scored against all the neighbor and non-neighbor embeddings of
+    the batch with Discriminator.pairwise. Windows sampled for other anchors count as extra negatives when they are
+    known to be distant, i.e. from another series or further than delta from the anchor, and are ignored otherwise.
+    The loader must return the sample metadata (TNCDataset(return_meta=True)) for the pairwise mode and the bank.
+    With precision='bf16', the encoder and discriminator forwards run under bfloat16 autocast (see tnc.precision).
+    During training, the gradients of `accumulation_steps` consecutive batches are averaged before every optimizer
+    step, for an effective batch size of accumulation_steps times the loader batch size.
+    """
     if train:
         encoder.train()
         disc_model.train()
@@ -130,59 +281,168 @@ def epoch_run(loader, disc_model, encoder, device, w=0, optimizer=None, train=Tr
         encoder.eval()
         disc_model.eval()
     # loss_fn = torch.nn.BCELoss()
-    loss_fn = torch.nn.BCEWithLogitsLoss()
+    loss_fn = torch.nn.BCEWithLogitsLoss(reduction='none')
     encoder.to(device)
     disc_model.to(device)
     epoch_loss = 0
     epoch_acc = 0
     batch_count = 0
-    for x_t, x_p, x_n, _ in loader:
+    for batch in loader:
+        x_t, x_p, x_n = batch[:3]
+        if mc_budget is not None:
+            # The dataset draws max_size samples, only the current budget is encoded
+            x_p, x_n = x_p[:, :mc_budget.size], x_n[:, :mc_budget.size]
         mc_sample = x_p.shape[1]
+        n_distant = x_n.shape[1]
         batch_size, f_size, len_size = x_t.shape
         x_p = x_p.reshape((-1, f_size, len_size))
         x_n = x_n.reshape((-1, f_size, len_size))
-        x_t = np.repeat(x_t, mc_sample, axis=0)
-        neighbors = torch.ones((len(x_p))).to(device)
-        non_neighbors = torch.zeros((len(x_n))).to(device)
+        if not pairwise:
+            x_t = np.repeat(x_t, mc_sample, axis=0)
         x_t, x_p, x_n = x_t.to(device), x_p.to(device), x_n.to(device)
-
-        z_t = encoder(x_t)
-        z_p = encoder(x_p)
-        z_n = encoder(x_n)
-
-        d_p = disc_model(z_t, z_p)
-        d_n = disc_model(z_t, z_n)
-
-        p_loss = loss_fn(d_p, neighbors)
-        n_loss = loss_fn(d_n, non_neighbors)
-        n_loss_u = loss_fn(d_n, neighbors)
-        loss = (p_loss + w*n_loss_u + (1-w)*n_loss)/2
+        if len(batch) > 4:
+            series, t, delta, t_n, t_p = batch[4]
+            t_n, t_p = t_n[:, :n_distant], t_p[:, :mc_sample]
+
+        with autocast(precision, device):
+            z_t = encoder(x_t)
+            z_p = encoder(x_p)
+            z_n = encoder(x_n)
+        z_t, z_p, z_n = z_t.float(), z_p.float(), z_n.float()
+
+        if pairwise:
+            z_anchor = z_t
+            owner = torch.cat([torch.arange(batch_size).repeat_interleave(mc_sample),
+                               torch.arange(batch_size).repeat_interleave(n_distant)])
+            is_neighbor = torch.cat([torch.ones(len(z_p), dtype=torch.bool), torch.zeros(len(z_n), dtype=torch.bool)])
+            candidate_times = torch.cat([t_p.reshape(-1), t_n.reshape(-1)])
+            own = owner.unsqueeze(0) == torch.arange(batch_size).unsqueeze(1)
+            distant = (series[owner].unsqueeze(0) != series.unsqueeze(1)) | \
+                      (torch.abs(candidate_times.unsqueeze(0) - t.unsqueeze(1)) >= delta.unsqueeze(1))
+            with autocast(precision, device):
+                logits = disc_model.pairwise(z_t, torch.cat([z_p, z_n])).float()
+            own, distant, is_neighbor = own.to(device), distant.to(device), is_neighbor.to(device)
+            d_p = logits[own & is_neighbor]
+            d_n = logits[(own & ~is_neighbor) | (~own & distant)]
+            own_d_n = logits[own & ~is_neighbor]
+        else:
+            z_anchor = z_t.view(batch_size, mc_sample, -1)[:, 0]
+            with autocast(precision, device):
+                d_p = disc_model(z_t, z_p).float()
+                d_n = disc_model(z_t, z_n).float()
+            own_d_n = d_n
+
+        p_losses = loss_fn(d_p, torch.ones_like(d_p))
+        n_losses = w*loss_fn(d_n, torch.ones_like(d_n)) + (1-w)*loss_fn(d_n, torch.zeros_like(d_n))
+        if train and bank is not None:
+            if bank_negatives > 0:
+                anchors, z_b = bank.sample(series, t, delta, bank_negatives)
+                if anchors is not None and len(anchors) > 0:
+                    # Bank negatives get the same w debiasing as the fresh ones
+                    d_b = disc_model(z_anchor[anchors], z_b)
+                    n_losses = torch.cat([n_losses, w*loss_fn(d_b, torch.ones_like(d_b)) +
+                                          (1-w)*loss_fn(d_b, torch.zeros_like(d_b))])
+            # Random subset of the non-neighbors of the batch, the only windows the key encoder has to encode
+            keep = torch.randperm(len(x_n))[:bank.push_size]
+            if bank.refresh == 'momentum':
+                bank.momentum_update(encoder)
+                with torch.no_grad():
+                    z_k = bank.key_encoder(x_n[keep.to(device)])
+            else:
+                z_k = z_n[keep.to(device)]
+            bank.push(z_k, torch.repeat_interleave(series, n_distant)[keep], t_n.reshape(-1)[keep])
+        loss = (torch.mean(p_losses) + torch.mean(n_losses))/2
+        if train and mc_budget is not None:
+            with torch.no_grad():
+                variance = torch.var(p_losses)/len(p_losses) + torch.var(n_losses)/len(n_losses)
+            mc_budget.update(loss.item(), np.sqrt(variance.item())/2)
 
         if train:
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            group_start = batch_count - batch_count % accumulation_steps
+            if batch_count == group_start:
+                optimizer.zero_grad()
+            # The last group of the epoch may have less than accumulation_steps batches
+            (loss / min(accumulation_steps, len(loader) - group_start)).backward()
+            if batch_count + 1 == min(group_start + accumulation_steps, len(loader)):
+                optimizer.step()
         p_acc = torch.sum(torch.nn.Sigmoid()(d_p) > 0.5).item() / len(z_p)
-        n_acc = torch.sum(torch.nn.Sigmoid()(d_n) < 0.5).item() / len(z_n)
+        n_acc = torch.sum(torch.nn.Sigmoid()(own_d_n) < 0.5).item() / len(z_n)
         epoch_acc = epoch_acc + (p_acc+n_acc)/2
         epoch_loss += loss.item()
         batch_count += 1
     return epoch_loss/batch_count, epoch_acc/batch_count
 
 
+def _sequence_encoder(data, encoder_type='rnn', causal=False, reduced_channels=None, reduction='linear'):
+    """
+    Encoder of the simulation and HAR data: bidirectional RnnEncoder (with an optional channel reduction front-end),
+    StreamingRnnEncoder or TCNEncoder
+    """
+    if encoder_type not in ['rnn', 'tcn']:
+        raise ValueError('Encoder type not defined, must be one of the following {rnn, tcn}')
+    if causal and encoder_type != 'rnn':
+        raise ValueError('The causal encoder is a StreamingRnnEncoder, it cannot be combined with encoder_type=%s'
+                         % encoder_type)
+    if reduced_channels is not None and (causal or encoder_type != 'rnn'):
+        raise ValueError('The channel reduction front-end is only available for the bidirectional RnnEncoder')
+    if encoder_type == 'tcn':
+        return TCNEncoder(device=device, **TCN_CONFIGS[data])
+    if causal:
+        return StreamingRnnEncoder(hidden_size=100, in_channel=TCN_CONFIGS[data]['in_channel'], encoding_size=10,
+                                   device=device)
+    return RnnEncoder(hidden_size=100, in_channel=TCN_CONFIGS[data]['in_channel'], encoding_size=10, device=device,
+                      reduced_channels=reduced_channels, reduction=reduction)
+
+
+def _reduction_suffix(reduced_channels, reduction):
+    """Checkpoint folder suffix of encoders with a channel reduction front-end"""
+    if reduced_channels is None:
+        return ''
+    return '_%s%d' % ('pca' if reduction == 'pca' else 'r', reduced_channels)
+
+
 def learn_encoder(x, encoder, window_size, w, lr=0.001, decay=0.005, mc_sample_size=20,
-                  n_epochs=100, path='simulation', device='cpu', augmentation=1, n_cross_val=1, cont=False):
+                  n_epochs=100, path='simulation', device='cpu', augmentation=1, n_cross_val=1, cont=False,
+                  neighborhood='adf', epsilon=3, adaptive_mc=False, min_mc_sample_size=None, bank_size=0,
+                  bank_negatives=None, bank_refresh='staleness', bank_push_size=None, pairwise=False, causal=False,
+                  encoder_type='rnn', reduced_channels=None, reduction='linear', precision='fp32', batch_size=None,
+                  accumulation_steps=1, checkpoint_activations=False):
+    """
+    `neighborhood` sets the neighborhood range: 'adf' runs the ADF test for every sample, 'fixed' uses `epsilon`, and
+    the estimators of tnc.neighborhood (variance_ratio, acf, kpss) use a cached table computed once for the dataset.
+    With `adaptive_mc`, the number of samples per anchor is adapted between min_mc_sample_size (mc_sample_size/4 by
+    default) and mc_sample_size (see AdaptiveMCBudget). With `bank_size` > 0, every anchor also gets
+    bank_negatives (mc_sample_size by default) negatives from a NonNeighborBank refreshed with `bank_refresh`, and at
+    most `bank_push_size` non-neighbors per batch are pushed to it. The momentum refresh encodes the pushed windows a
+    second time with the key encoder, bank_push_size bounds that cost.
+    `pairwise` scores all the anchors of a batch against all its samples (see epoch_run). `causal` trains a
+    StreamingRnnEncoder instead of the bidirectional RnnEncoder on the simulation and HAR data, and
+    encoder_type='tcn' a TCNEncoder. `reduced_channels` adds a channel reduction front-end to the RnnEncoder, learned
+    or fitted with PCA on the training recordings depending on `reduction`. precision='bf16' runs the forwards under
+    bfloat16 autocast. `batch_size` overrides the default batch size of the dataset, and every optimizer step
+    averages the gradients of `accumulation_steps` batches. When python -m tnc.autotune was run on the machine, the
+    loader workers, threads and, unless `batch_size` is given, the batch size come from its profile.
+    `checkpoint_activations` recomputes the convolution blocks of the WFEncoder in the backward pass instead of
+    storing their activations; with small batches, the BatchNorm1d statistics are still computed on every batch and
+    not on the accumulated ones
+    """
     accuracies, losses = [], []
+    # Batch size, loader workers and threads of python -m tnc.autotune, when it was run on this machine
+    tuned = apply_profile('tnc', dataset_name(path), 'causal' if causal else encoder_type, reduced_channels, reduction)
+    table = None
+    if neighborhood not in ['adf', 'fixed']:
+        table = epsilon_table(x, window_size, neighborhood, cache_dir='./ckpt/%s' % path)
     for cv in range(n_cross_val):
         if 'waveform' in path:
-            encoder = WFEncoder(encoding_size=64).to(device)
-            batch_size = 5
+            encoder = WFEncoder(encoding_size=64, checkpoint_activations=checkpoint_activations).to(device)
+            default_batch_size = 5
         elif 'simulation' in path:
-            encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device)
-            batch_size = 10
+            encoder = _sequence_encoder('simulation', encoder_type, causal, reduced_channels, reduction)
+            default_batch_size = 10
         elif 'har' in path:
-            encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device)
-            batch_size = 10
+            encoder = _sequence_encoder('har', encoder_type, causal, reduced_channels, reduction)
+            default_batch_size = 10
+        loader_batch_size = batch_size or tuned.get('batch_size', default_batch_size)
         if not os.path.exists('./ckpt/%s'%path):
             os.mkdir('./ckpt/%s'%path)
         if cont:
@@ -192,30 +452,55 @@ def learn_encoder(x, encoder, window_size, w, lr=0.001, decay=0.005, mc_sample_s
         disc_model = Discriminator(encoder.encoding_size, device)
         params = list(disc_model.parameters()) + list(encoder.parameters())
         optimizer = torch.optim.Adam(params, lr=lr, weight_decay=decay)
+        mc_budget = None
+        if adaptive_mc:
+            mc_budget = AdaptiveMCBudget(min_mc_sample_size or max(1, mc_sample_size//4), mc_sample_size)
+        bank = None
+        if bank_size > 0:
+            bank = NonNeighborBank(bank_size, encoder.encoding_size, device, refresh=bank_refresh,
+                                   push_size=bank_push_size)
+            bank_negatives = mc_sample_size if bank_negatives is None else bank_negatives
         inds = list(range(len(x)))
         random.shuffle(inds)
         x = x[inds]
+        if table is not None:
+            table = table[inds]
         n_train = int(0.8*len(x))
+        if getattr(encoder, 'reduction', None) == 'pca' and encoder.reduced_channels is not None and not cont:
+            encoder.fit_reduction(x[:n_train])
         performance = []
         best_acc = 0
         best_loss = np.inf
 
         for epoch in range(n_epochs+1):
-            trainset = TNCDataset(x=torch.Tensor(x[:n_train]), mc_sample_size=mc_sample_size,
-                                  window_size=window_size, augmentation=augmentation, adf=True)
-            train_loader = data.DataLoader(trainset, batch_size=batch_size, shuffle=True, num_workers=3)
-            validset = TNCDataset(x=torch.Tensor(x[n_train:]), mc_sample_size=mc_sample_size,
-                                  window_size=window_size, augmentation=augmentation, adf=True)
-            valid_loader = data.DataLoader(validset, batch_size=batch_size, shuffle=True)
+            x_train, x_valid = x[:n_train], x[n_train:]
+            if not isinstance(x, ShardedTimeSeries):
+                x_train, x_valid = torch.Tensor(x_train), torch.Tensor(x_valid)
+            trainset = TNCDataset(x=x_train, mc_sample_size=mc_sample_size, window_size=window_size,
+                                  augmentation=augmentation, epsilon=epsilon, adf=neighborhood == 'adf',
+                                  epsilon_table=None if table is None else table[:n_train],
+                                  return_meta=bank is not None or pairwise)
+            train_loader = data.DataLoader(trainset, batch_size=loader_batch_size, shuffle=True,
+                                           num_workers=tuned.get('num_workers', 3))
+            validset = TNCDataset(x=x_valid, mc_sample_size=mc_sample_size, window_size=window_size,
+                                  augmentation=augmentation, epsilon=epsilon, adf=neighborhood == 'adf',
+                                  epsilon_table=None if table is None else table[n_train:], return_meta=pairwise)
+            valid_loader = data.DataLoader(validset, batch_size=loader_batch_size, shuffle=True)
 
             epoch_loss, epoch_acc = epoch_run(train_loader, disc_model, encoder, optimizer=optimizer,
-                                              w=w, train=True, device=device)
-            test_loss, test_acc = epoch_run(valid_loader, disc_model, encoder, train=False, w=w, device=device)
+                                              w=w, train=True, device=device, mc_budget=mc_budget, bank=bank,
+                                              bank_negatives=bank_negatives, pairwise=pairwise, precision=precision,
+                                              accumulation_steps=accumulation_steps)
+            test_loss, test_acc = epoch_run(valid_loader, disc_model, encoder, train=False, w=w, device=device,
+                                            mc_budget=mc_budget, pairwise=pairwise, precision=precision)
             performance.append((epoch_loss, test_loss, epoch_acc, test_acc))
             if epoch%10 == 0:
                 print('(cv:%s)Epoch %d Loss =====> Training Loss: %.5f \t Training Accuracy: %.5f \t Test Loss: %.5f \t Test Accuracy: %.5f'
                       % (cv, epoch, epoch_loss, epoch_acc, test_loss, test_acc))
-            if best_loss > test_loss or path=='har':
+                if mc_budget is not None:
+                    print('(cv:%s)Epoch %d MC sample size =====> current: %d \t epoch average: %.1f'
+                          % (cv, epoch, mc_budget.size, np.mean(mc_budget.history[-len(train_loader):])))
+            if best_loss > test_loss or 'har' in path:
                 best_acc = test_acc
                 best_loss = test_loss
                 state = {
@@ -253,7 +538,11 @@ def learn_encoder(x, encoder, window_size, w, lr=0.001, decay=0.005, mc_sample_s
     return encoder
 
 
-def main(is_train, data_type, cv, w, cont):
+def main(is_train, data_type, cv, w, cont, shards=None, neighborhood='adf', adaptive_mc=False, bank_size=0,
+         bank_refresh='staleness', bank_push_size=None, pairwise=False, causal=False, encoder_type='rnn',
+         reduced_channels=None, reduction='linear', precision='fp32', batch_size=None, accumulation_steps=1,
+         checkpoint_activations=False):
+    suffix = '_causal' if causal else '_tcn' if encoder_type == 'tcn' else _reduction_suffix(reduced_channels, reduction)
     if not os.path.exists("./plots"):
         os.mkdir("./plots")
     if not os.path.exists("./ckpt/"):
@@ -261,32 +550,44 @@ def main(is_train, data_type, cv, w, cont):
 
     if data_type == 'simulation':
         window_size = 50
-        encoder = RnnEncoder(hidden_size=100, in_channel=3, encoding_size=10, device=device)
+        encoder = _sequence_encoder('simulation', encoder_type, causal, reduced_channels, reduction)
         path = './data/simulated_data/'
 
         if is_train:
-            with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
-                x = pickle.load(f)
+            if shards:
+                x = ShardedTimeSeries(shards)
+            else:
+                with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
+                    x = pickle.load(f)
             learn_encoder(x, encoder, w=w, lr=1e-3, decay=1e-5, window_size=window_size, n_epochs=100,
-                          mc_sample_size=40, path='simulation', device=device, augmentation=5, n_cross_val=cv)
+                          mc_sample_size=40, path='simulation%s' % suffix, device=device,
+                          augmentation=5, n_cross_val=cv, causal=causal, encoder_type=encoder_type,
+                          reduced_channels=reduced_channels, reduction=reduction,
+                          neighborhood=neighborhood, adaptive_mc=adaptive_mc,
+                          bank_size=bank_size, bank_refresh=bank_refresh,
+                          bank_push_size=bank_push_size, pairwise=pairwise,
+                          precision=precision, batch_size=batch_size, accumulation_steps=accumulation_steps,
+                          checkpoint_activations=checkpoint_activations)
         else:
             # Plot the distribution of the encodings and use the learnt encoders to train a downstream classifier
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
-            checkpoint = torch.load('./ckpt/%s/checkpoint_0.pth.tar' % (data_type))
+            y_test = load_states(path, 'test')
+            checkpoint = torch.load('./ckpt/%s%s/checkpoint_0.pth.tar' % (data_type, suffix))
             encoder.load_state_dict(checkpoint['encoder_state_dict'])
             encoder = encoder.to(device)
-            track_encoding(x_test[10,:,50:650], y_test[10,50:650], encoder, window_size, 'simulation')
+            track_encoding(x_test[10,:,50:650], y_test[10,50:650], encoder, window_size, 'simulation%s' % suffix)
             for cv_ind in range(cv):
-                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='simulation',
+                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='simulation%s' % suffix,
                                   title='TNC', device=device, cv=cv_ind)
-                exp = ClassificationPerformanceExperiment(cv=cv_ind)
+                exp = ClassificationPerformanceExperiment(path='simulation%s' % suffix, cv=cv_ind,
+                                                          encoder_type=encoder_type, reduced_channels=reduced_channels,
+                                                          reduction=reduction, causal=causal)
                 # Run cross validation for classification
                 for lr in [0.001, 0.01, 0.1]:
                     print('===> lr: ', lr)
-                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='simulation', n_epochs=150, lr_e2e=lr, lr_cls=lr)
+                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='simulation%s' % suffix, n_epochs=150,
+                                                                 lr_e2e=lr, lr_cls=lr)
                     print('TNC acc: %.2f \t TNC auc: %.2f \t E2E acc: %.2f \t E2E auc: %.2f'%(tnc_acc, tnc_auc, e2e_acc, e2e_auc))
 
     if data_type == 'waveform':
@@ -295,18 +596,25 @@ def main(is_train, data_type, cv, w, cont):
         encoder = WFEncoder(encoding_size=64).to(device)
 
         if is_train:
-            with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
-                x = pickle.load(f)
-            T = x.shape[-1]
-            x_window = np.concatenate(np.split(x[:, :, :T // 5 * 5], 5, -1), 0)
-            learn_encoder(torch.Tensor(x_window), encoder, w=w, lr=1e-5, decay=1e-4, n_epochs=150, window_size=window_size,
-                          path='waveform', mc_sample_size=10, device=device, augmentation=7, n_cross_val=cv, cont = cont)
+            if shards:
+                x_window = ShardedTimeSeries(shards)
+            else:
+                with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
+                    x = pickle.load(f)
+                T = x.shape[-1]
+                x_window = torch.Tensor(np.concatenate(np.split(x[:, :, :T // 5 * 5], 5, -1), 0))
+            learn_encoder(x_window, encoder, w=w, lr=1e-5, decay=1e-4, n_epochs=150, window_size=window_size,
+                          path='waveform', mc_sample_size=10, device=device, augmentation=7, n_cross_val=cv, cont = cont,
+                          neighborhood=neighborhood, adaptive_mc=adaptive_mc,
+                          bank_size=bank_size, bank_refresh=bank_refresh,
+                          bank_push_size=bank_push_size, pairwise=pairwise,
+                          precision=precision, batch_size=batch_size, accumulation_steps=accumulation_steps,
+                          checkpoint_activations=checkpoint_activations)
 
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
+            y_test = load_states(path, 'test')
             checkpoint = torch.load('./ckpt/%s/checkpoint_0.pth.tar' % (data_type))
             encoder.load_state_dict(checkpoint['encoder_state_dict'])
             encoder = encoder.to(device)
@@ -320,32 +628,44 @@ def main(is_train, data_type, cv, w, cont):
     if data_type == 'har':
         window_size = 4
         path = './data/HAR_data/'
-        encoder = RnnEncoder(hidden_size=100, in_channel=561, encoding_size=10, device=device)
+        encoder = _sequence_encoder('har', encoder_type, causal, reduced_channels, reduction)
 
         if is_train:
-            with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
-                x = pickle.load(f)
-            learn_encoder(torch.Tensor(x), encoder, w=w, lr=1e-3, decay=1e-5, n_epochs=150, window_size=window_size,
-                          path='har', mc_sample_size=20, device=device, augmentation=5, n_cross_val=cv)
+            if shards:
+                x = ShardedTimeSeries(shards)
+            else:
+                with open(os.path.join(path, 'x_train.pkl'), 'rb') as f:
+                    x = torch.Tensor(pickle.load(f))
+            learn_encoder(x, encoder, w=w, lr=1e-3, decay=1e-5, n_epochs=150, window_size=window_size,
+                          path='har%s' % suffix, mc_sample_size=20, device=device, augmentation=5,
+                          n_cross_val=cv, causal=causal, encoder_type=encoder_type,
+                          reduced_channels=reduced_channels, reduction=reduction,
+                          neighborhood=neighborhood, adaptive_mc=adaptive_mc,
+                          bank_size=bank_size, bank_refresh=bank_refresh,
+                          bank_push_size=bank_push_size, pairwise=pairwise,
+                          precision=precision, batch_size=batch_size, accumulation_steps=accumulation_steps,
+                          checkpoint_activations=checkpoint_activations)
 
         else:
             with open(os.path.join(path, 'x_test.pkl'), 'rb') as f:
                 x_test = pickle.load(f)
-            with open(os.path.join(path, 'state_test.pkl'), 'rb') as f:
-                y_test = pickle.load(f)
-            checkpoint = torch.load('./ckpt/%s/checkpoint_0.pth.tar' % (data_type))
+            y_test = load_states(path, 'test')
+            checkpoint = torch.load('./ckpt/%s%s/checkpoint_0.pth.tar' % (data_type, suffix))
             encoder.load_state_dict(checkpoint['encoder_state_dict'])
             encoder = encoder.to(device)
-            track_encoding(x_test[0,:,:], y_test[0,:], encoder, window_size, 'har')
+            track_encoding(x_test[0,:,:], y_test[0,:], encoder, window_size, 'har%s' % suffix)
             for cv_ind in range(cv):
-                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='har', device=device,
-                                  augment=100, cv=cv_ind, title='TNC')
-                exp = ClassificationPerformanceExperiment(n_states=6, encoding_size=10, path='har', hidden_size=100,
-                                                          in_channel=561, window_size=4, cv=cv_ind)
+                plot_distribution(x_test, y_test, encoder, window_size=window_size, path='har%s' % suffix,
+                                  device=device, augment=100, cv=cv_ind, title='TNC')
+                exp = ClassificationPerformanceExperiment(n_states=6, encoding_size=10, path='har%s' % suffix,
+                                                          hidden_size=100, in_channel=561, window_size=4, cv=cv_ind,
+                                                          encoder_type=encoder_type, reduced_channels=reduced_channels,
+                                                          reduction=reduction, causal=causal)
                 # Run cross validation for classification
                 for lr in [0.001, 0.01, 0.1]:
                     print('===> lr: ', lr)
-                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='har', n_epochs=50, lr_e2e=lr, lr_cls=lr)
+                    tnc_acc, tnc_auc, e2e_acc, e2e_auc = exp.run(data='har%s' % suffix, n_epochs=50, lr_e2e=lr,
+                                                                 lr_cls=lr)
                     print('TNC acc: %.2f \t TNC auc: %.2f \t E2E acc: %.2f \t E2E auc: %.2f'%(tnc_acc, tnc_auc, e2e_acc, e2e_auc))
 
 
@@ -357,8 +677,35 @@ if __name__ == '__main__':
     parser.add_argument('--w', type=float, default=0.05)
     parser.add_argument('--train', action='store_true')
     parser.add_argument('--cont', action='store_true')
+    parser.add_argument('--shards', type=str, default=None, help='Train on a sharded store instead of x_train.pkl')
+    parser.add_argument('--neighborhood', type=str, default='adf',
+                        help='Neighborhood range estimator, one of {adf, fixed, variance_ratio, acf, kpss}')
+    parser.add_argument('--adaptive_mc', action='store_true',
+                        help='Adapt the number of neighbor samples per anchor to the variance of the loss')
+    parser.add_argument('--bank_size', type=int, default=0, help='Size of the non-neighbor bank, 0 to disable it')
+    parser.add_argument('--bank_refresh', type=str, default='staleness',
+                        help='One of {staleness, momentum}, momentum encodes the pushed windows a second time')
+    parser.add_argument('--bank_push_size', type=int, default=None,
+                        help='Non-neighbors pushed to the bank per batch, all of them by default')
+    parser.add_argument('--pairwise', action='store_true', help='Score all anchors against all samples of a batch')
+    parser.add_argument('--causal', action='store_true', help='Train a causal streaming encoder (simulation, har)')
+    parser.add_argument('--encoder', type=str, default='rnn', help='Encoder of the simulation and HAR data, {rnn, tcn}')
+    parser.add_argument('--reduced_channels', type=int, default=None,
+                        help='Project the input channels to this dimension before the GRU (simulation, har)')
+    parser.add_argument('--reduction', type=str, default='linear', help='Channel reduction, one of {linear, pca}')
+    parser.add_argument('--precision', type=str, default='fp32', help='Precision of the forwards, one of {fp32, bf16}')
+    parser.add_argument('--batch_size', type=int, default=None, help='Batch size, if not the autotuned or the default one')
+    parser.add_argument('--accumulation_steps', type=int, default=1,
+                        help='Number of batches whose gradients are accumulated before every optimizer step')
+    parser.add_argument('--checkpoint_activations', action='store_true',
+                        help='Recompute the waveform encoder activations in the backward pass to save memory')
     args = parser.parse_args()
     print('TNC model with w=%f'%args.w)
-    main(args.train, args.data, args.cv, args.w, args.cont)
+    main(args.train, args.data, args.cv, args.w, args.cont, shards=args.shards, neighborhood=args.neighborhood,
+         adaptive_mc=args.adaptive_mc, bank_size=args.bank_size, bank_refresh=args.bank_refresh,
+         bank_push_size=args.bank_push_size, pairwise=args.pairwise, causal=args.causal, encoder_type=args.encoder,
+         reduced_channels=args.reduced_channels, reduction=args.reduction, precision=args.precision,
+         batch_size=args.batch_size, accumulation_steps=args.accumulation_steps,
+         checkpoint_activations=args.checkpoint_activations)
 
 
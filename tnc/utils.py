@@ -1,5 +1,6 @@
 import os
 import pickle
+import hashlib
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -12,16 +13,18 @@ from torch.utils import data
 import torch
 from sklearn.manifold import TSNE
 from sklearn.decomposition import PCA
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.linear_model import LogisticRegression
+
+from tnc.labels import load_states, chopped_window_labels
 
 
 def create_simulated_dataset(window_size=50, path='./data/simulated_data/', batch_size=100):
     if not os.listdir(path):
         raise ValueError('Data does not exist')
     x = pickle.load(open(os.path.join(path, 'x_train.pkl'), 'rb'))
-    y = pickle.load(open(os.path.join(path, 'state_train.pkl'), 'rb'))
+    y = load_states(path, 'train')
     x_test = pickle.load(open(os.path.join(path, 'x_test.pkl'), 'rb'))
-    y_test = pickle.load(open(os.path.join(path, 'state_test.pkl'), 'rb'))
+    y_test = load_states(path, 'test')
 
     n_train = int(0.8*len(x))
     n_valid = len(x) - n_train
@@ -53,10 +56,18 @@ def track_encoding(sample, label, encoder, window_size, path, sliding_gap=5):
     device = 'cuda'
     encoder.to(device)
     encoder.eval()
+    if hasattr(encoder, 'encode_series'):
+        # Encoders with a dense mode (TCNEncoder) encode all the windows in one pass, the window centered at t ends
+        # at t + window_size//2 - 1
+        with torch.no_grad():
+            dense = encoder.encode_series(torch.Tensor(sample).unsqueeze(0).to(device))[0]
     for t in range(window_size//2,T-window_size//2,sliding_gap):
         windows = sample[:, t-(window_size//2):t+(window_size//2)]
         windows_label.append((np.bincount(label[t-(window_size//2):t+(window_size//2)].astype(int)).argmax()))
-        encodings.append(encoder(torch.Tensor(windows).unsqueeze(0).to(device)).view(-1,))
+        if hasattr(encoder, 'encode_series'):
+            encodings.append(dense[t + window_size//2 - 1])
+        else:
+            encodings.append(encoder(torch.Tensor(windows).unsqueeze(0).to(device)).view(-1,))
     for t in range(window_size//(2*sliding_gap)):
         # fix offset
         encodings.append(encodings[-1])
@@ -128,84 +139,211 @@ def track_encoding(sample, label, encoder, window_size, path, sliding_gap=5):
     plt.savefig(os.path.join("./plots/%s" % path, "embedding_trajectory.pdf"))
 
 
-def plot_distribution(x_test, y_test, encoder, window_size, path, device, title="", augment=4, cv=0):
+def project_2d(x, method='tsne', pca_dim=50, random_state=0):
+    """
+    2D projection for plotting. Inputs are reduced to `pca_dim` dimensions with PCA before t-SNE or UMAP, which
+    makes the neighbour search of both methods much cheaper on raw windows
+    """
+    x = x.reshape((len(x), -1))
+    if method == 'pca':
+        return PCA(n_components=2).fit_transform(x)
+    if x.shape[-1] > pca_dim:
+        x = PCA(n_components=min(pca_dim, len(x)), random_state=random_state).fit_transform(x)
+    if method == 'tsne':
+        return TSNE(n_components=2, random_state=random_state).fit_transform(x)
+    elif method == 'umap':
+        import umap
+        return umap.UMAP(n_components=2, random_state=random_state).fit_transform(x)
+    raise ValueError('Projection method not defined, must be one of the following {tsne, pca, umap}')
+
+
+def stratified_subsample(labels, n, random_state=0):
+    """Indices of at most n elements, allocated to each label in proportion to its frequency (at least one each)"""
+    if len(labels) <= n:
+        return np.arange(len(labels))
+    rng = np.random.RandomState(random_state)
+    classes, counts = np.unique(labels, return_counts=True)
+    alloc = np.minimum(counts, np.maximum(1, np.floor(n * counts / len(labels)).astype(int)))
+    inds = [rng.choice(np.where(labels == c)[0], m, replace=False) for c, m in zip(classes, alloc)]
+    return np.sort(np.concatenate(inds))
+
+
+_signal_projection_cache = {}
+
+
+def _signal_projection(x_test, y_test, window_size, dataset, augment, max_points, method, pca_dim):
+    """
+    Windows to plot and the projection of their raw signals. The projection does not depend on the encoder, so it is
+    computed once per dataset and cached in memory and under ./plots
+    """
+    fingerprint = hashlib.md5(np.ascontiguousarray(x_test[:, :, ::max(1, x_test.shape[-1] // 1000)]).tobytes())
+    fingerprint.update(str((x_test.shape, window_size, augment, max_points, method, pca_dim)).encode())
+    key = '%s_%s' % (dataset, fingerprint.hexdigest()[:12])
+    cache_file = os.path.join('./plots', 'signal_projection_%s.npz' % key)
+    if key not in _signal_projection_cache:
+        if os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            _signal_projection_cache[key] = tuple(cached[name] for name in ['sample_inds', 'starts', 'states',
+                                                                              'embedding'])
+        else:
+            sample_inds, starts, states = sample_windows(x_test, y_test, window_size, len(x_test) * augment,
+                                                         random_state=0)
+            subset = stratified_subsample(states, max_points)
+            sample_inds, starts, states = sample_inds[subset], starts[subset], states[subset]
+            t = starts[:, np.newaxis] + np.arange(window_size)
+            windows = x_test[sample_inds[:, np.newaxis], :, t]
+            embedding = project_2d(windows, method=method, pca_dim=pca_dim)
+            if os.path.exists('./plots'):
+                np.savez(cache_file, sample_inds=sample_inds, starts=starts, states=states, embedding=embedding)
+            _signal_projection_cache[key] = (sample_inds, starts, states, embedding)
+    return _signal_projection_cache[key]
+
+
+def plot_distribution(x_test, y_test, encoder, window_size, path, device, title="", augment=4, cv=0, method='tsne',
+                      max_points=3000, pca_dim=50):
     checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
     encoder.load_state_dict(checkpoint['encoder_state_dict'])
     encoder = encoder.to(device)
-    n_test = len(x_test)
-    inds = np.random.randint(0, x_test.shape[-1] - window_size, n_test * augment)
-    windows = np.array([x_test[int(i % n_test), :, ind:ind + window_size] for i, ind in enumerate(inds)])
-    windows_state = [np.round(np.mean(y_test[i % n_test, ind:ind + window_size], axis=-1)) for i, ind in
-                     enumerate(inds)]
-    encodings = encoder(torch.Tensor(windows).to(device))
-
-    tsne = TSNE(n_components=2)
-    embedding = tsne.fit_transform(encodings.detach().cpu().numpy())
-    # pca = PCA(n_components=2)
-    # embedding = pca.fit_transform(encodings.detach().cpu().numpy())
-    # original_embedding = PCA(n_components=2).fit_transform(windows.reshape((len(windows), -1)))
-    original_embedding = TSNE(n_components=2).fit_transform(windows.reshape((len(windows), -1)))
-
+    # The same windows (at most max_points of them, stratified by state) are plotted for every encoder of a dataset
+    sample_inds, starts, windows_state, original_embedding = _signal_projection(
+        x_test, y_test, window_size, path.split('_')[0], augment, max_points, method, pca_dim)
+    encodings = encode_windows(encoder, x_test, sample_inds, starts, window_size, device)
+    embedding = project_2d(encodings, method=method, pca_dim=pca_dim)
 
     df_original = pd.DataFrame({"f1": original_embedding[:, 0], "f2": original_embedding[:, 1], "state": windows_state})
     df_encoding = pd.DataFrame({"f1": embedding[:, 0], "f2": embedding[:, 1], "state": windows_state})
-    # df_encoding = pd.DataFrame({"f1": embedding[:, 0], "f2": embedding[:, 1], "state": y_test[np.arange(4*n_test)%n_test, inds]})
-
 
     # Save plots
     if not os.path.exists(os.path.join("./plots/%s"%path)):
         os.mkdir(os.path.join("./plots/%s"%path))
-    # plt.figure()
     fig, ax = plt.subplots()
-    ax.set_title("Origianl signals TSNE", fontweight="bold")
-    # sns.jointplot(x="f1", y="f2", data=df_original, kind="kde", hue='state')
+    ax.set_title("Origianl signals %s" % method.upper(), fontweight="bold")
     sns.scatterplot(x="f1", y="f2", data=df_original, hue="state")
     plt.savefig(os.path.join("./plots/%s"%path, "signal_distribution.pdf"))
 
     fig, ax = plt.subplots()
-    # plt.figure()
     ax.set_title("%s"%title, fontweight="bold", fontsize=18)
     if 'waveform' in path:
         sns.scatterplot(x="f1", y="f2", data=df_encoding, hue="state", palette="deep")
     else:
         sns.scatterplot(x="f1", y="f2", data=df_encoding, hue="state")
-    # sns.jointplot(x="f1", y="f2", data=df_encoding, kind="kde", hue='state')
     plt.savefig(os.path.join("./plots/%s"%path, "encoding_distribution_%d.pdf"%cv))
 
 
-def model_distribution(x_train, y_train, x_test, y_test, encoder, window_size, path, device):
-    checkpoint = torch.load('./ckpt/%s/checkpoint.pth.tar'%path)
-    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+def sample_windows(x, y, window_size, n_windows, random_state=None):
+    """
+    Draw n_windows random windows, cycling over the samples of x. Returns the sample index and start time of each
+    window, and its state (the rounded mean of y over the window, computed from prefix sums)
+    """
+    n = len(x)
+    rng = np.random if random_state is None else np.random.RandomState(random_state)
+    sample_inds = np.arange(n_windows) % n
+    starts = rng.randint(0, x.shape[-1] - window_size, n_windows)
+    y_sum = np.concatenate([np.zeros((n, 1)), np.cumsum(y, -1)], -1)
+    states = np.round((y_sum[sample_inds, starts + window_size] - y_sum[sample_inds, starts]) / window_size)
+    return sample_inds, starts, states
+
+
+def encode_windows(encoder, x, sample_inds, starts, window_size, device, batch_size=256):
+    """Encode the windows x[sample_inds, :, starts:starts+window_size] in batches, without keeping the graph"""
     encoder.eval()
-    # n_train = len(x_train)
-    n_test = len(x_test)
-    augment = 100
-
-    # inds = np.random.randint(0, x_train.shape[-1] - window_size, n_train * 20)
-    # windows = np.array([x_train[int(i % n_train), :, ind:ind + window_size] for i, ind in enumerate(inds)])
-    # windows_label = [np.round(np.mean(y_train[i % n_train, ind:ind + window_size], axis=-1))
-    #                  for i, ind in enumerate(inds)]
-    inds = np.random.randint(0, x_test.shape[-1] - window_size, n_test * augment)
-    x_window_test = np.array([x_test[int(i % n_test), :, ind:ind + window_size] for i, ind in enumerate(inds)])
-    y_window_test = np.array([np.round(np.mean(y_test[i % n_test, ind:ind + window_size], axis=-1)) for i, ind in
-                     enumerate(inds)])
-    train_count = []
-    if 'waveform' in path:
-        encoder.to('cpu')
-        x_window_test = torch.Tensor(x_window_test)
-    else:
-        encoder.to(device)
-        x_window_test = torch.Tensor(x_window_test).to(device)
-
-    encodings_test = encoder(x_window_test).detach().cpu().numpy()
-
-    neigh = KNeighborsClassifier(n_neighbors=10)
-    neigh.fit(encodings_test, y_window_test)
-    # preds = neigh.predict(encodings_test)
-    _, neigh_inds = neigh.kneighbors(encodings_test)
-    neigh_ind_labels = [np.mean(y_window_test[ind]) for ind in (neigh_inds)]
-    label_var = [(y_window_test[ind]==y_window_test[i]).sum() for i, ind in enumerate(neigh_inds)]
-    dist = (label_var)/10
+    offsets = np.arange(window_size)
+    encodings = []
+    with torch.no_grad():
+        for i in range(0, len(starts), batch_size):
+            t = starts[i:i + batch_size, np.newaxis] + offsets
+            windows = x[sample_inds[i:i + batch_size, np.newaxis], :, t].transpose((0, 2, 1))
+            encodings.append(encoder(torch.Tensor(windows).to(device)).cpu().numpy())
+    return np.concatenate(encodings, 0)
+
+
+def chopped_windows(path, split, window_size):
+    """
+    Non-overlapping windows of the recordings of a split, in the order of chopped_window_labels, with their labels
+    and the index of the recording each window comes from
+    """
+    with open(os.path.join(path, 'x_%s.pkl' % split), 'rb') as f:
+        x = np.asarray(pickle.load(f), dtype=np.float32)
+    T = x.shape[-1] // window_size * window_size
+    n_windows = T // window_size
+    x_window = torch.Tensor(np.concatenate(np.split(x[:, :, :T], n_windows, -1), 0))
+    return x_window, chopped_window_labels(path, split, window_size, T), np.tile(np.arange(len(x)), n_windows)
+
+
+def linear_probe_accuracy(encodings, labels, recordings):
+    """
+    Accuracy of a logistic regression on the encodings, trained on the windows of the first half of the recordings
+    and tested on the other half. Unlabeled windows (-1) are ignored
+    """
+    n_recordings = recordings.max() + 1
+    train = np.logical_and(recordings < n_recordings // 2, labels >= 0)
+    test = np.logical_and(recordings >= n_recordings // 2, labels >= 0)
+    clf = LogisticRegression(max_iter=1000).fit(encodings[train], labels[train])
+    return np.mean(clf.predict(encodings[test]) == labels[test])
+
+
+def neighborhood_purity(encodings, labels, k=10, max_memory=512):
+    """
+    k-nearest neighbour label purity of the encodings: the fraction of the k nearest neighbours of each window (the
+    window itself excluded) that share its label. Neighbours are found with blocked matrix products, with blocks
+    sized to stay within about `max_memory` MB. Returns the mean purity, the mean purity per class and the purity of
+    every window.
+    """
+    labels = np.asarray(labels).reshape(-1)
+    # Each block holds the distances and the argpartition indices
+    block_size = max(1, int(max_memory * 2**20) // (16 * len(encodings)))
+    _, neigh_inds = knn_search(encodings, encodings, k, block_size=block_size, exclude_self=True)
+    purity = np.mean(labels[neigh_inds] == labels[:, np.newaxis], -1)
+    class_purity = {c: np.mean(purity[labels == c]) for c in np.unique(labels)}
+    return {'purity': np.mean(purity), 'class_purity': class_purity, 'window_purity': purity}
+
+
+def model_distribution(x_train, y_train, x_test, y_test, encoder, window_size, path, device, augment=100, k=10,
+                       cv=0):
+    """Neighbourhood purity of the encodings of random test windows, for the checkpoint of the given cv index"""
+    checkpoint = torch.load('./ckpt/%s/checkpoint_%d.pth.tar'%(path, cv))
+    encoder.load_state_dict(checkpoint['encoder_state_dict'])
+    encoder.to(device)
+    sample_inds, starts, y_window_test = sample_windows(x_test, y_test, window_size, len(x_test) * augment)
+    encodings_test = encode_windows(encoder, x_test, sample_inds, starts, window_size, device)
+
+    metrics = neighborhood_purity(encodings_test, y_window_test, k=k)
+    print('%d-NN label purity: %.4f' % (k, metrics['purity']))
+    for c, purity in metrics['class_purity'].items():
+        print('\tState %d: %.4f' % (c, purity))
+    return metrics
+
+
+def knn_search(queries, data, k, block_size=1024, exclude_self=False):
+    """
+    Exact euclidean k-nearest neighbours of each query among the rows of data, sorted by distance.
+    Distances are computed with one matrix product per block of queries and the neighbours are picked with
+    argpartition, so memory stays O(block_size * len(data)). With exclude_self, the queries are the rows of data and
+    a point is not returned as its own neighbour.
+    """
+    data = np.asarray(data)
+    dtype = np.float64 if data.dtype == np.float64 else np.float32
+    data = data.astype(dtype, copy=False).reshape((len(data), -1))
+    queries = np.asarray(queries).astype(dtype, copy=False).reshape((len(queries), -1))
+    k = min(k, len(data) - int(exclude_self))
+    data_norms = np.einsum('ij,ij->i', data, data)
+    distances = np.empty((len(queries), k), dtype=dtype)
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), block_size):
+        q = queries[start:start + block_size]
+        rows = np.arange(len(q))
+        dist = np.dot(q, data.T)
+        dist *= -2
+        dist += data_norms[np.newaxis, :]
+        dist += np.einsum('ij,ij->i', q, q)[:, np.newaxis]
+        if exclude_self:
+            dist[rows, start + rows] = np.inf
+        ind = np.argpartition(dist, k - 1, axis=-1)[:, :k]
+        dist = np.take_along_axis(dist, ind, -1)
+        order = np.argsort(dist, axis=-1)
+        distances[start:start + len(q)] = np.take_along_axis(dist, order, -1)
+        indices[start:start + len(q)] = np.take_along_axis(ind, order, -1)
+    return np.sqrt(np.maximum(distances, 0)), indices
 
 
 def confidence_ellipse(mean, cov, ax, n_std=1.0, facecolor='none', **kwargs):